@@ -1,3 +1,20 @@
+import argparse
+import logging
+
 from src.batch.backtest_all_combinations import run
 
-run()
+logging.basicConfig(level=logging.INFO)
+
+parser = argparse.ArgumentParser(description="Backtest every cell of the grid.")
+parser.add_argument("--max_workers", type=int)
+parser.add_argument(
+    "--instrument",
+    action="store_true",
+    help="Log the time spent per stage of the backtests",
+)
+args = parser.parse_args()
+
+results = run(max_workers=args.max_workers, instrument=args.instrument)
+failures = [r for r in results if not r.succeeded]
+if failures:
+    logging.error("%d of %d cells failed", len(failures), len(results))
@@ -0,0 +1,31 @@
+import argparse
+import dataclasses
+
+from src.benchmark.benchmarks import (
+    BenchmarkParams,
+    compare_results,
+    run_benchmarks,
+    save_results,
+)
+
+parser = argparse.ArgumentParser(description="Benchmark the backtest hot path.")
+parser.add_argument("--output", default="benchmark_results.json")
+parser.add_argument("--compare", help="Previous results to compare against")
+parser.add_argument("--only", nargs="+", help="Names of the benchmarks to run")
+for field in dataclasses.fields(BenchmarkParams):
+    parser.add_argument(f"--{field.name}", type=field.type, default=field.default)
+args = parser.parse_args()
+
+params = BenchmarkParams(
+    **{
+        field.name: getattr(args, field.name)
+        for field in dataclasses.fields(BenchmarkParams)
+    }
+)
+results = run_benchmarks(params, args.only)
+for name, timing in results.items():
+    print(f"{name:30} min {timing.min_s:8.4f}s  mean {timing.mean_s:8.4f}s")
+save_results(args.output, params, results)
+
+if args.compare:
+    print(compare_results(args.compare, args.output))
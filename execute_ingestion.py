@@ -0,0 +1,34 @@
+import argparse
+import logging
+
+from src.batch.ingestion import IngestionConfig, run_ingestion
+
+logging.basicConfig(level=logging.INFO)
+
+parser = argparse.ArgumentParser(
+    description="Build the processed daily data from the raw Sharadar exports."
+)
+parser.add_argument("raw_dir", help="Directory of the raw CSV or zipped CSV exports")
+parser.add_argument("output_dir", help="Directory of the processed data")
+parser.add_argument("--env", default="prod")
+parser.add_argument("--num_buckets", type=int, default=16)
+parser.add_argument("--chunk_size", type=int, default=500_000)
+parser.add_argument("--max_workers", type=int)
+parser.add_argument(
+    "--no_monolithic",
+    action="store_true",
+    help="Only write the dataset partitioned by year, not daily_data_{env}.feather",
+)
+args = parser.parse_args()
+
+config = IngestionConfig(
+    args.raw_dir,
+    args.output_dir,
+    env=args.env,
+    num_buckets=args.num_buckets,
+    chunk_size=args.chunk_size,
+    write_monolithic=not args.no_monolithic,
+)
+result = run_ingestion(config, max_workers=args.max_workers)
+if not result.changed:
+    logging.info("Already up to date with %s", args.raw_dir)
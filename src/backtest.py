@@ -1,25 +1,58 @@
+import dataclasses
 import datetime
 import os
-from datetime import timedelta
+from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
-from src.backtest_helpers import *
-from src.data_types import *
-from src.serialization_lib import get_feather_filename, write_df_to_feather
+from src.backtest_helpers import get_last_available_prices, get_ticker_prices
+from src.data_types import (
+    CappedWeighting,
+    EvaluationMetric,
+    MarketCapBand,
+    ResultDetail,
+    StockBasketWeightApproach,
+    StockUniverse,
+)
+from src.instrumentation import StageTimings, as_timings
+from src.market_data import MarketDataStore
+from src.portfolio import Portfolio
+from src.rank_index import RankIndex
+from src.result_cache import (
+    BacktestCheckpoint,
+    ResultCache,
+    backtest_cache_key,
+    backtest_checkpoint_key,
+    backtest_data_fingerprint,
+)
+from src.trading_calendar import TradingCalendar
+from src.serialization_lib import (
+    get_feather_filename,
+    read_result_df_from_feather,
+    write_df_to_feather,
+)
+from src.weighting import get_basket_weights
 
 DATA_PROCESSED_BASE_PATH = "/Volumes/SDCard/TipBackTest/processed_data"
 
+DAYS_PER_YEAR = 365.25
+
 
 @dataclasses.dataclass
 class BackTestResult:
     df: pd.DataFrame
-    df_debug: pd.DataFrame
+    # None for `ResultDetail.NONE`
+    df_debug: Optional[pd.DataFrame]
     base_metric: EvaluationMetric
     test_metric: EvaluationMetric
     rebalance_days: int
     portfolio_size: int
-    stocks_universe: StockUniverse
+    stocks_universe: Union[StockUniverse, MarketCapBand]
+    # Portfolio values on every trading day, if asked for (see `daily_values`)
+    df_daily: Optional[pd.DataFrame] = None
+    # Time spent per stage, if asked for (see `timings`)
+    timings: Optional[StageTimings] = None
 
 
 def _save_to_disk(
@@ -27,23 +60,29 @@ def _save_to_disk(
     test_metric: EvaluationMetric,
     rebalance_days: int,
     portfolio_size: int,
-    stocks_universe: StockUniverse,
+    stocks_universe: Union[StockUniverse, MarketCapBand],
     df_res: pd.DataFrame,
-    df_debug: pd.DataFrame,
+    df_debug: Optional[pd.DataFrame],
+    df_daily: Optional[pd.DataFrame],
     base_path: str,
     env: str,
 ) -> None:
-    filename = get_feather_filename(
-        "df_debug",
-        base_metric,
-        test_metric,
-        rebalance_days,
-        portfolio_size,
-        stocks_universe,
-        env,
-    )
-    filename = os.path.join(base_path, filename)
-    write_df_to_feather(df_debug, filename)
+    for prefix, df in [("df_debug", df_debug), ("df_daily", df_daily)]:
+        filename = get_feather_filename(
+            prefix,
+            base_metric,
+            test_metric,
+            rebalance_days,
+            portfolio_size,
+            stocks_universe,
+            env,
+        )
+        filename = os.path.join(base_path, filename)
+        if df is not None:
+            write_df_to_feather(df, filename)
+        elif os.path.exists(filename):
+            # Left by a previous run with more detail, it no longer matches df_res
+            os.remove(filename)
 
     filename = get_feather_filename(
         "df_res",
@@ -58,114 +97,408 @@ def _save_to_disk(
     write_df_to_feather(df_res, filename)
 
 
-def compute_backtest_dfs(
+def load_backtest_result(
     base_metric: EvaluationMetric,
     test_metric: EvaluationMetric,
-    stocks_universe: StockUniverse,
-    weight_strategy: StockBasketWeightApproach,
     rebalance_days: int,
     portfolio_size: int,
-    initial_portfolio_value: int,
-    daily_data: pd.DataFrame,
-    daily_data_base_sorted: pd.DataFrame,
-    daily_data_test_sorted: pd.DataFrame,
+    stocks_universe: Union[StockUniverse, MarketCapBand],
     base_path: str = DATA_PROCESSED_BASE_PATH,
-    save_to_disk: bool = True,
     env: str = "prod",
-):
-    assert daily_data["date"].is_monotonic_increasing
-    assert (
-        daily_data_base_sorted[base_metric.sorted_column()]
-        .dropna()
-        .is_monotonic_increasing
-    )
-    assert (
-        daily_data_test_sorted[test_metric.sorted_column()]
-        .dropna()
-        .is_monotonic_increasing
+    with_debug: bool = False,
+) -> BackTestResult:
+    """
+    The result saved to disk by `compute_backtest_dfs`, with its daily values if
+    they were saved and, if asked, its df_debug.
+    """
+    dfs = {}
+    for prefix in ["df_res", "df_debug", "df_daily"]:
+        filename = os.path.join(
+            base_path,
+            get_feather_filename(
+                prefix,
+                base_metric,
+                test_metric,
+                rebalance_days,
+                portfolio_size,
+                stocks_universe,
+                env,
+            ),
+        )
+        if prefix == "df_debug" and not with_debug:
+            dfs[prefix] = None
+        elif prefix == "df_res" or os.path.exists(filename):
+            dfs[prefix] = read_result_df_from_feather(filename)
+        else:
+            dfs[prefix] = None
+    return BackTestResult(
+        dfs["df_res"],
+        dfs["df_debug"],
+        base_metric,
+        test_metric,
+        rebalance_days,
+        portfolio_size,
+        stocks_universe,
+        dfs["df_daily"],
     )
 
-    start_date = datetime.datetime.strptime(min(daily_data["date"]), "%Y-%m-%d")
-    end_date = datetime.datetime.strptime(max(daily_data["date"]), "%Y-%m-%d")
 
-    rebalance_dates = get_rebalance_dates(
-        start_date, end_date, timedelta(days=rebalance_days)
-    )
+def _as_market_data_store(df: Union[pd.DataFrame, MarketDataStore]) -> MarketDataStore:
+    if isinstance(df, MarketDataStore):
+        return df
+    assert df["date"].is_monotonic_increasing
+    return MarketDataStore(df)
 
-    base_portfolio_value = initial_portfolio_value
-    test_portfolio_value = initial_portfolio_value
 
-    start_date = rebalance_dates[0]
+def _as_rank_index(
+    rank_index: Optional[RankIndex],
+    daily_data: MarketDataStore,
+    metric: EvaluationMetric,
+) -> RankIndex:
+    if rank_index is None:
+        return RankIndex.build(daily_data, metric)
+    assert rank_index.metric == metric
+    assert rank_index.is_valid_for(daily_data)
+    return rank_index
 
-    # Get data for start date
-    daily_data_df = filter_df_by_date(daily_data, start_date)
-    base_sorted_df = filter_df_by_date(daily_data_base_sorted, start_date)
-    test_sorted_df = filter_df_by_date(daily_data_test_sorted, start_date)
 
-    # Filter based on the universe of stocks we are interested in.
-    base_sorted_df_in_universe = filter_stocks_by_universe(
-        base_sorted_df, stocks_universe
-    )
-    test_sorted_df_in_universe = filter_stocks_by_universe(
-        test_sorted_df, stocks_universe
+def _can_resume(
+    checkpoint: BacktestCheckpoint,
+    daily_data: MarketDataStore,
+    rebalance_dates: List[datetime.datetime],
+    base_metric: EvaluationMetric,
+    test_metric: EvaluationMetric,
+) -> bool:
+    """
+    Whether `daily_data` extends the data `checkpoint` was taken on: the same
+    rebalance dates and the same data up to the checkpoint.
+    """
+    num_rebalances = checkpoint.num_rebalances
+    return (
+        num_rebalances <= len(rebalance_dates)
+        and rebalance_dates[num_rebalances - 1] == checkpoint.date
+        and checkpoint.data_fingerprint
+        == backtest_data_fingerprint(
+            daily_data, base_metric, test_metric, checkpoint.date
+        )
     )
 
-    # Get base stocks from the universe selected for each metric
-    base_portfolio = get_top_n_stocks_by_metric(
-        base_sorted_df_in_universe, portfolio_size, base_metric
-    )
-    test_portfolio = get_top_n_stocks_by_metric(
-        test_sorted_df_in_universe, portfolio_size, test_metric
-    )
 
-    # Compute number of shares we can buy of each stock
-    base_share_allocation = get_share_allocation(
-        daily_data_df, base_portfolio, base_portfolio_value, weight_strategy
+def _buy_top_n_stocks(
+    daily_data: MarketDataStore,
+    date: datetime.datetime,
+    rank_index: RankIndex,
+    n: int,
+    in_universe: np.ndarray,
+    investment_amount: float,
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+) -> Portfolio:
+    """
+    Like `get_top_n_stocks_by_rank` followed by `get_share_allocation`, on the
+    ticker codes and prices of the ranked rows.
+    """
+    ranked_rows = rank_index.ranked_rows(daily_data, date)
+    positions = ranked_rows[in_universe[ranked_rows]][:n]
+    rows = daily_data.row_range(date)
+    weights = get_basket_weights(
+        weight_strategy,
+        daily_data.df["marketcap"].values[rows][positions],
+        _volatility_of(daily_data, weight_strategy, rows, positions),
     )
-    test_share_allocation = get_share_allocation(
-        daily_data_df, test_portfolio, test_portfolio_value, weight_strategy
+    return Portfolio.buy(
+        daily_data.tickers,
+        daily_data.ticker_codes[rows][positions],
+        daily_data.df["price"].values[rows][positions],
+        investment_amount,
+        weights,
     )
 
-    # SANITY CHECK: compute these values rather than assigning them for consistency.
-    base_price, base_tickers_closed = get_stock_basket_price(
-        base_sorted_df, daily_data, base_share_allocation
-    )
-    test_price, test_tickers_closed = get_stock_basket_price(
-        test_sorted_df, daily_data, test_share_allocation
+
+def _volatility_of(
+    daily_data: MarketDataStore,
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+    rows: slice,
+    positions: np.ndarray,
+) -> Optional[np.ndarray]:
+    # Only build the volatility of the store for the strategies that use it
+    if isinstance(weight_strategy, CappedWeighting):
+        weight_strategy = weight_strategy.approach
+    if weight_strategy != StockBasketWeightApproach.INVERSE_VOLATILITY:
+        return None
+    return daily_data.volatility[rows][positions]
+
+
+def _daily_values_frame(
+    daily_data: MarketDataStore,
+    holding_periods: List[
+        Tuple[Portfolio, Portfolio, datetime.datetime, Optional[datetime.datetime]]
+    ],
+) -> pd.DataFrame:
+    """
+    The values of the base and test portfolios held over each (start date, end
+    date) holding period, built into a single frame at the end (one per period
+    would cost as much as the values themselves).
+    """
+    dates, base_values, test_values = [], [], []
+    for base_portfolio, test_portfolio, start_date, end_date in holding_periods:
+        period_dates, values = base_portfolio.daily_values(
+            daily_data, start_date, end_date
+        )
+        dates.append(period_dates)
+        base_values.append(values)
+        test_values.append(
+            test_portfolio.daily_values(daily_data, start_date, end_date)[1]
+        )
+    return pd.DataFrame(
+        {
+            "base_value": np.concatenate(base_values),
+            "test_value": np.concatenate(test_values),
+        },
+        index=pd.DatetimeIndex(np.concatenate(dates)),
     )
 
-    # SANITY CHECK
-    assert initial_portfolio_value == base_price
-    assert initial_portfolio_value == test_price
-    assert base_portfolio_value == base_price
-    assert test_portfolio_value == test_price
 
-    res = {}
-    debug = {}
+def _num_rows(
+    daily_data: MarketDataStore, date: datetime.datetime, timings: StageTimings
+) -> int:
+    # Rows scanned by the stages of a rebalance, only counted when timing them
+    if not timings.enabled:
+        return 0
+    rows = daily_data.row_range(date)
+    return rows.stop - rows.start
 
-    res[start_date] = {
-        "base_price": base_price,
-        "test_price": test_price,
-    }
 
-    prev_base_price = base_price
-    prev_test_price = test_price
-    prev_date = start_date
+def _append_rows(df: pd.DataFrame, df_new: pd.DataFrame) -> pd.DataFrame:
+    if len(df_new) == 0:
+        return df
+    if len(df) == 0:
+        return df_new
+    return pd.concat([df, df_new])
 
-    # Skip the first date (start_date) because it is handeled above
-    for date in rebalance_dates[1:]:
-        # Filter DFs for optimization purposes
-        daily_data_df = filter_df_by_date(daily_data, date)
-        base_sorted_df = filter_df_by_date(daily_data_base_sorted, date)
-        test_sorted_df = filter_df_by_date(daily_data_test_sorted, date)
 
-        # Compute value of previous portfolio at today's date
-        base_price, base_tickers_closed = get_stock_basket_price(
-            base_sorted_df, daily_data, base_share_allocation
+def compute_backtest_dfs(
+    base_metric: EvaluationMetric,
+    test_metric: EvaluationMetric,
+    stocks_universe: Union[StockUniverse, MarketCapBand],
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+    rebalance_days: int,
+    portfolio_size: int,
+    initial_portfolio_value: int,
+    daily_data: Union[pd.DataFrame, MarketDataStore],
+    base_rank_index: Optional[RankIndex] = None,
+    test_rank_index: Optional[RankIndex] = None,
+    base_path: str = DATA_PROCESSED_BASE_PATH,
+    save_to_disk: bool = True,
+    env: str = "prod",
+    cache: Optional[ResultCache] = None,
+    detail: ResultDetail = ResultDetail.FULL,
+    daily_values: bool = False,
+    timings: Optional[StageTimings] = None,
+):
+    """
+    The data can be passed as a DataFrame or, to avoid re-partitioning it on every
+    call (e.g. when sweeping parameters), as a prebuilt `MarketDataStore`.
+
+    Stocks are ranked by each metric with a `RankIndex` of `daily_data`, built
+    here unless passed in (e.g. loaded with `RankIndex.load_or_build`).
+
+    Baskets are weighted by `weight_strategy` (see `get_basket_weights`).
+
+    `detail` controls how much of `df_debug` is built (and saved): nothing for
+    `ResultDetail.NONE`, when only the portfolio values are needed (e.g. large
+    sweeps), up to the per ticker prices of every rebalance for the default
+    `ResultDetail.FULL`.
+
+    With `daily_values`, the result also holds the value of both portfolios on
+    every trading day (`BackTestResult.df_daily`), e.g. for drawdowns. Between
+    rebalances these come from a price matrix of the held stocks times their
+    number of shares, which costs about one pass over the data.
+
+    With a `cache`, a result previously computed from the same data, parameters
+    and code is returned (and saved to disk if asked) instead of recomputed.
+    Otherwise, if the cache has a checkpoint of the same backtest on data that
+    `daily_data` extends (new trading days appended), only the rebalances after
+    the checkpoint are computed. Closed tickers are valued at their last price
+    in the data, so a ticker that stops trading before the checkpoint and trades
+    again in the new days is valued differently than by a full recompute.
+
+    With `timings`, the wall time, calls and rows scanned of every stage (e.g.
+    selecting the portfolios, valuing them, writing the results) are added to
+    it and attached to the result (see `StageTimings`).
+    """
+    result_timings = timings
+    timings = as_timings(timings)
+    with timings.stage("prepare_data"):
+        daily_data = _as_market_data_store(daily_data)
+
+    if cache is not None:
+        with timings.stage("cache_get"):
+            cache_key = backtest_cache_key(
+                daily_data,
+                base_metric,
+                test_metric,
+                stocks_universe,
+                weight_strategy,
+                rebalance_days,
+                portfolio_size,
+                initial_portfolio_value,
+                detail,
+                daily_values,
+                base_rank_index,
+                test_rank_index,
+            )
+            cached = cache.get(cache_key)
+        if cached is not None:
+            df_res, df_debug, df_daily = cached
+            if save_to_disk:
+                with timings.stage("save_to_disk"):
+                    _save_to_disk(
+                        base_metric,
+                        test_metric,
+                        rebalance_days,
+                        portfolio_size,
+                        stocks_universe,
+                        df_res,
+                        df_debug,
+                        df_daily,
+                        base_path,
+                        env,
+                    )
+            return BackTestResult(
+                df_res,
+                df_debug,
+                base_metric,
+                test_metric,
+                rebalance_days,
+                portfolio_size,
+                stocks_universe,
+                df_daily,
+                result_timings,
+            )
+
+    with timings.stage("rank_index"):
+        base_rank_index = _as_rank_index(base_rank_index, daily_data, base_metric)
+        test_rank_index = _as_rank_index(test_rank_index, daily_data, test_metric)
+
+    start_date = daily_data.start_date
+    end_date = daily_data.end_date
+
+    # Rebalance on sessions in the data, so every rebalance date has prices.
+    with timings.stage("rebalance_schedule"):
+        rebalance_dates = TradingCalendar.from_store(daily_data).rebalance_schedule(
+            start_date, end_date, rebalance_days
+        )
+
+    resumed = None
+    if cache is not None:
+        checkpoint_key = backtest_checkpoint_key(
+            base_metric,
+            test_metric,
+            stocks_universe,
+            weight_strategy,
+            rebalance_days,
+            portfolio_size,
+            initial_portfolio_value,
+            detail,
+            daily_values,
         )
-        test_price, test_tickers_closed = get_stock_basket_price(
-            test_sorted_df, daily_data, test_share_allocation
+        with timings.stage("checkpoint_get"):
+            resumed = cache.get_checkpoint(checkpoint_key)
+            if resumed is not None and not _can_resume(
+                resumed[0], daily_data, rebalance_dates, base_metric, test_metric
+            ):
+                resumed = None
+
+    if resumed is not None:
+        # Pick up after the last rebalance of a previous run on less data.
+        checkpoint, prev_df_res, prev_df_debug, prev_df_daily = resumed
+        base_portfolio = Portfolio.from_share_allocation(
+            daily_data, checkpoint.base_share_allocation, checkpoint.date
         )
+        test_portfolio = Portfolio.from_share_allocation(
+            daily_data, checkpoint.test_share_allocation, checkpoint.date
+        )
+        base_portfolio_value = checkpoint.base_portfolio_value
+        test_portfolio_value = checkpoint.test_portfolio_value
+        prev_base_price = checkpoint.base_price
+        prev_test_price = checkpoint.test_price
+        prev_date = checkpoint.date
+        new_rebalance_dates = rebalance_dates[checkpoint.num_rebalances :]
+
+        res = {}
+        debug = {}
+        holding_periods = []
+    else:
+        base_portfolio_value = initial_portfolio_value
+        test_portfolio_value = initial_portfolio_value
+
+        start_date = rebalance_dates[0]
+
+        # Buy the top stocks from the universe selected for each metric
+        with timings.stage("select", _num_rows(daily_data, start_date, timings)):
+            in_universe = daily_data.universe_membership.mask_on_date(
+                start_date, stocks_universe
+            )
+            base_portfolio = _buy_top_n_stocks(
+                daily_data,
+                start_date,
+                base_rank_index,
+                portfolio_size,
+                in_universe,
+                base_portfolio_value,
+                weight_strategy,
+            )
+            test_portfolio = _buy_top_n_stocks(
+                daily_data,
+                start_date,
+                test_rank_index,
+                portfolio_size,
+                in_universe,
+                test_portfolio_value,
+                weight_strategy,
+            )
+
+        # SANITY CHECK: compute these values rather than assigning them for consistency.
+        base_price, base_tickers_closed, _ = base_portfolio.mark_to_market(
+            daily_data, start_date
+        )
+        test_price, test_tickers_closed, _ = test_portfolio.mark_to_market(
+            daily_data, start_date
+        )
+
+        # SANITY CHECK
+        assert initial_portfolio_value == base_price
+        assert initial_portfolio_value == test_price
+        assert base_portfolio_value == base_price
+        assert test_portfolio_value == test_price
+
+        res = {}
+        debug = {}
+        holding_periods = []
+
+        res[start_date] = {
+            "base_price": base_price,
+            "test_price": test_price,
+        }
+
+        prev_base_price = base_price
+        prev_test_price = test_price
+        prev_date = start_date
+
+        # Skip the first date (start_date) because it is handeled above
+        new_rebalance_dates = rebalance_dates[1:]
+
+    for date in new_rebalance_dates:
+        rows = _num_rows(daily_data, date, timings)
+
+        # Compute value of previous portfolio at today's date
+        with timings.stage("mark_to_market", 2 * rows):
+            base_price, base_tickers_closed, base_prices = (
+                base_portfolio.mark_to_market(daily_data, date)
+            )
+            test_price, test_tickers_closed, test_prices = (
+                test_portfolio.mark_to_market(daily_data, date)
+            )
 
         # Compute teh change in the portfolio value
         base_change = base_price / prev_base_price
@@ -182,88 +515,144 @@ def compute_backtest_dfs(
             "test_price": test_price,
         }
 
-        # Get data for the previous date to compute `base_portfolio_per_ticker_change` for debugging below
-        prev_base_sorted_df = filter_df_by_date(daily_data_base_sorted, prev_date)
-
-        # DEBUG ONLY
-        debug[date] = {
-            "prev_date": prev_date,
-            "curr_date": date,
-            "base_portfolio_prev_price": prev_base_price,
-            "base_portfolio_curr_price": base_price,
-            "base_portfolio_tickers_closed": base_tickers_closed,
-            "base_portfolio_per_ticker_data": get_per_stock_change(
-                daily_data_df,
-                prev_base_sorted_df,
+        if detail != ResultDetail.NONE:
+            debug[date] = {
+                "prev_date": prev_date,
+                "curr_date": date,
+                "base_portfolio_prev_price": prev_base_price,
+                "base_portfolio_curr_price": base_price,
+                "base_portfolio_tickers_closed": base_tickers_closed,
+            }
+        if detail == ResultDetail.FULL:
+            with timings.stage("debug"):
+                # Bought on the previous date, so the entry prices are the previous prices
+                debug[date]["base_portfolio_per_ticker_data"] = (
+                    base_portfolio.to_stock_rebalance_instances(
+                        base_portfolio.entry_prices, base_prices
+                    )
+                )
+
+        if daily_values:
+            holding_periods.append((base_portfolio, test_portfolio, prev_date, date))
+
+        # Get the newley selected portfolio from the universe of stocks we are interested in.
+        prev_base_portfolio = base_portfolio
+        prev_test_portfolio = test_portfolio
+        with timings.stage("select", rows):
+            in_universe = daily_data.universe_membership.mask_on_date(
+                date, stocks_universe
+            )
+            base_portfolio = _buy_top_n_stocks(
                 daily_data,
-                base_portfolio,
-            ),
-        }
-
-        # Filter based on the universe of stocks we are interested in.
-        base_sorted_df_in_universe = filter_stocks_by_universe(
-            base_sorted_df, stocks_universe
-        )
-        test_sorted_df_in_universe = filter_stocks_by_universe(
-            test_sorted_df, stocks_universe
-        )
-
-        # Get the newley selected portfolio.
-        base_portfolio = get_top_n_stocks_by_metric(
-            base_sorted_df_in_universe, portfolio_size, base_metric
-        )
-        test_portfolio = get_top_n_stocks_by_metric(
-            test_sorted_df_in_universe, portfolio_size, test_metric
-        )
-
-        base_share_allocation = get_share_allocation(
-            daily_data_df, base_portfolio, base_portfolio_value, weight_strategy
-        )
-        test_share_allocation = get_share_allocation(
-            daily_data_df, test_portfolio, test_portfolio_value, weight_strategy
-        )
+                date,
+                base_rank_index,
+                portfolio_size,
+                in_universe,
+                base_portfolio_value,
+                weight_strategy,
+            )
+            test_portfolio = _buy_top_n_stocks(
+                daily_data,
+                date,
+                test_rank_index,
+                portfolio_size,
+                in_universe,
+                test_portfolio_value,
+                weight_strategy,
+            )
 
         # Get new portfolio price
-        base_price, base_tickers_closed = get_stock_basket_price(
-            base_sorted_df, daily_data, base_share_allocation
-        )
-        test_price, test_tickers_closed = get_stock_basket_price(
-            test_sorted_df, daily_data, test_share_allocation
-        )
+        with timings.stage("mark_to_market", 2 * rows):
+            base_price, base_tickers_closed, _ = base_portfolio.mark_to_market(
+                daily_data, date
+            )
+            test_price, test_tickers_closed, _ = test_portfolio.mark_to_market(
+                daily_data, date
+            )
 
         # SANITY CHECK: since we just got these stocks, none of them should be closed...
         assert len(base_tickers_closed) == 0
         assert len(test_tickers_closed) == 0
 
+        with timings.stage("turnover"):
+            res[date]["base_turnover"] = prev_base_portfolio.turnover(
+                base_portfolio, base_prices
+            )
+            res[date]["test_turnover"] = prev_test_portfolio.turnover(
+                test_portfolio, test_prices
+            )
+
         # Cache the last price of the current portfolio (previous date)
         prev_base_price = base_price
         prev_test_price = test_price
         prev_date = date
 
         # DEBUG ONLY: Adding this to the debug DF for easier debugging...
-        debug[date].update(
-            {
-                "new_base_portfolio_per_ticker_data": get_per_stock_change(
-                    base_sorted_df, None, daily_data, base_portfolio
+        if detail == ResultDetail.FULL:
+            with timings.stage("debug"):
+                debug[date]["new_base_portfolio_per_ticker_data"] = (
+                    base_portfolio.to_stock_rebalance_instances(
+                        np.full(len(base_portfolio), np.nan),
+                        base_portfolio.entry_prices,
+                    )
+                )
+
+    with timings.stage("build_frames"):
+        df_res = pd.DataFrame.from_dict(res, orient="index")
+        df_debug = None
+        if detail != ResultDetail.NONE:
+            df_debug = pd.DataFrame.from_dict(debug, orient="index")
+    df_daily = None
+    if daily_values:
+        # The last portfolio is held through the end of the data
+        holding_periods.append((base_portfolio, test_portfolio, prev_date, None))
+        with timings.stage("daily_values", len(daily_data)):
+            df_daily = _daily_values_frame(daily_data, holding_periods)
+    if resumed is not None:
+        df_res = _append_rows(prev_df_res, df_res)
+        if df_debug is not None:
+            df_debug = _append_rows(prev_df_debug, df_debug)
+        if df_daily is not None:
+            # The previous run held its last portfolio through the end of its data
+            df_daily = _append_rows(
+                prev_df_daily[prev_df_daily.index < checkpoint.date], df_daily
+            )
+
+    if cache is not None:
+        with timings.stage("cache_put"):
+            cache.put(cache_key, df_res, df_debug, df_daily)
+            cache.put_checkpoint(
+                checkpoint_key,
+                BacktestCheckpoint(
+                    date=prev_date,
+                    num_rebalances=len(rebalance_dates),
+                    data_fingerprint=backtest_data_fingerprint(
+                        daily_data, base_metric, test_metric, prev_date
+                    ),
+                    base_share_allocation=base_portfolio.to_share_allocation(),
+                    test_share_allocation=test_portfolio.to_share_allocation(),
+                    base_portfolio_value=base_portfolio_value,
+                    test_portfolio_value=test_portfolio_value,
+                    base_price=prev_base_price,
+                    test_price=prev_test_price,
                 ),
-            }
-        )
-
-    df_res = pd.DataFrame.from_dict(res, orient="index")
-    df_debug = pd.DataFrame.from_dict(debug, orient="index")
+                cache_key,
+            )
 
     if save_to_disk:
-        _save_to_disk(
-            base_metric,
-            test_metric,
-            rebalance_days,
-            portfolio_size,
-            stocks_universe,
-            df_res,
-            df_debug,
-            base_path,
-            env,
-        )
+        with timings.stage("save_to_disk"):
+            _save_to_disk(
+                base_metric,
+                test_metric,
+                rebalance_days,
+                portfolio_size,
+                stocks_universe,
+                df_res,
+                df_debug,
+                df_daily,
+                base_path,
+                env,
+            )
 
     return BackTestResult(
         df_res,
@@ -273,4 +662,320 @@ def compute_backtest_dfs(
         rebalance_days,
         portfolio_size,
         stocks_universe,
+        df_daily,
+        result_timings,
+    )
+
+
+def compute_multi_strategy_backtest(
+    metrics: List[EvaluationMetric],
+    portfolio_sizes: List[int],
+    stocks_universe: Union[StockUniverse, MarketCapBand],
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+    rebalance_days: List[int],
+    initial_portfolio_value: int,
+    daily_data: Union[pd.DataFrame, MarketDataStore],
+    rank_indexes: Optional[Dict[EvaluationMetric, RankIndex]] = None,
+) -> pd.DataFrame:
+    """
+    Backtest every (metric, portfolio size) strategy, walking the rebalance
+    schedule of each rebalance period once.
+
+    The date slice, universe filter, ranked stocks (once per metric, for the
+    largest portfolio size) and price lookups of a rebalance date are shared by
+    all the strategies, so evaluating many strategies costs about as much as
+    evaluating one. Strategies follow the same steps as `compute_backtest_dfs`.
+
+    Returns:
+        A tidy DataFrame with one row per (rebalance_days, metric, portfolio_size,
+        date) holding the basket price before (`price`) and after (`price_prev`,
+        carried into the next period) rebalancing, like `BackTestResult.df`.
+    """
+    daily_data = _as_market_data_store(daily_data)
+    rank_indexes = rank_indexes or {}
+    rank_indexes = {
+        m: _as_rank_index(rank_indexes.get(m), daily_data, m) for m in metrics
+    }
+    strategies = [(metric, size) for metric in metrics for size in portfolio_sizes]
+    max_portfolio_size = max(portfolio_sizes)
+
+    schedules = TradingCalendar.from_store(daily_data).rebalance_schedules(
+        daily_data.start_date, daily_data.end_date, rebalance_days
+    )
+
+    rows = []
+    for period in rebalance_days:
+        rebalance_dates = schedules[period]
+
+        # Per strategy state
+        tickers = {}
+        num_shares = {}
+        prev_price = {}
+        portfolio_value = {s: initial_portfolio_value for s in strategies}
+
+        for date in rebalance_dates:
+            daily_data_df = daily_data.on_date(date)
+            ticker_values = daily_data_df["ticker"].to_numpy()
+            price_values = daily_data_df["price"].values
+            marketcap_values = daily_data_df["marketcap"].values
+
+            # Value every held portfolio with one batched price lookup
+            curr_price = {}
+            if tickers:
+                unique_tickers, inverse = np.unique(
+                    np.concatenate([tickers[s] for s in strategies]),
+                    return_inverse=True,
+                )
+                prices, missing = get_ticker_prices(daily_data_df, unique_tickers)
+                prices[missing] = get_last_available_prices(
+                    daily_data.last_available_prices, list(unique_tickers[missing])
+                )
+                held_prices = prices[inverse]
+
+                start = 0
+                for s in strategies:
+                    end = start + len(tickers[s])
+                    curr_price[s] = round(
+                        float(np.sum(held_prices[start:end] * num_shares[s])), 2
+                    )
+                    portfolio_value[s] = round(
+                        portfolio_value[s] * curr_price[s] / prev_price[s], 2
+                    )
+                    start = end
+
+            # Select and buy the new portfolios
+            in_universe = daily_data.universe_membership.mask_on_date(
+                date, stocks_universe
+            )
+            for metric in metrics:
+                ranked = rank_indexes[metric].ranked_rows(daily_data, date)
+                ranked = ranked[in_universe[ranked]][:max_portfolio_size]
+                if len(ranked) == 0:
+                    raise Exception(f"No stocks to select by {metric} on {date}")
+
+                for size in portfolio_sizes:
+                    s = (metric, size)
+                    positions = ranked[:size]
+                    prices = price_values[positions]
+                    tickers[s] = ticker_values[positions]
+                    weights = get_basket_weights(
+                        weight_strategy,
+                        marketcap_values[positions],
+                        _volatility_of(
+                            daily_data,
+                            weight_strategy,
+                            daily_data.row_range(date),
+                            positions,
+                        ),
+                    )
+                    if weights is None:
+                        num_shares[s] = (portfolio_value[s] / len(positions)) / prices
+                    else:
+                        num_shares[s] = portfolio_value[s] * weights / prices
+                    new_price = round(float(np.sum(prices * num_shares[s])), 2)
+                    rows.append(
+                        (
+                            period,
+                            str(metric),
+                            size,
+                            date,
+                            prev_price.get(s, np.nan),
+                            curr_price.get(s, new_price),
+                        )
+                    )
+                    prev_price[s] = new_price
+
+    return pd.DataFrame(
+        rows,
+        columns=[
+            "rebalance_days",
+            "metric",
+            "portfolio_size",
+            "date",
+            "price_prev",
+            "price",
+        ],
+    )
+
+
+class _HoldingPeriodReturns:
+    """
+    The portfolio selected by a metric on a date and its return held to a later
+    date, each computed once and shared by all the backtests holding it (e.g.
+    the overlapping windows of `compute_rolling_start_backtests`).
+    """
+
+    def __init__(
+        self,
+        daily_data: MarketDataStore,
+        rank_indexes: Dict[EvaluationMetric, RankIndex],
+        stocks_universe: Union[StockUniverse, MarketCapBand],
+        weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+        investment_amount: float,
+    ):
+        self.daily_data = daily_data
+        self.rank_indexes = rank_indexes
+        self.stocks_universe = stocks_universe
+        self.weight_strategy = weight_strategy
+        self.investment_amount = investment_amount
+        self._in_universe: Dict[datetime.datetime, np.ndarray] = {}
+        # (metric, size, date) -> (portfolio bought on date, its value on date)
+        self._portfolios: Dict[Tuple, Tuple[Portfolio, float]] = {}
+        # (metric, size, start date, end date) -> value at end / value at start
+        self._returns: Dict[Tuple, float] = {}
+
+    def _portfolio(
+        self, metric: EvaluationMetric, size: int, date: datetime.datetime
+    ) -> Tuple[Portfolio, float]:
+        key = (metric, size, date)
+        if key not in self._portfolios:
+            if date not in self._in_universe:
+                self._in_universe[date] = (
+                    self.daily_data.universe_membership.mask_on_date(
+                        date, self.stocks_universe
+                    )
+                )
+            portfolio = _buy_top_n_stocks(
+                self.daily_data,
+                date,
+                self.rank_indexes[metric],
+                size,
+                self._in_universe[date],
+                self.investment_amount,
+                self.weight_strategy,
+            )
+            value, _, _ = portfolio.mark_to_market(self.daily_data, date)
+            self._portfolios[key] = (portfolio, value)
+        return self._portfolios[key]
+
+    def growth(
+        self,
+        metric: EvaluationMetric,
+        size: int,
+        start_date: datetime.datetime,
+        end_date: datetime.datetime,
+    ) -> float:
+        key = (metric, size, start_date, end_date)
+        if key not in self._returns:
+            portfolio, value = self._portfolio(metric, size, start_date)
+            end_value, _, _ = portfolio.mark_to_market(self.daily_data, end_date)
+            self._returns[key] = end_value / value
+        return self._returns[key]
+
+
+def compute_rolling_start_backtests(
+    base_metric: EvaluationMetric,
+    test_metric: EvaluationMetric,
+    stocks_universe: Union[StockUniverse, MarketCapBand],
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+    rebalance_days: List[int],
+    portfolio_sizes: List[int],
+    daily_data: Union[pd.DataFrame, MarketDataStore],
+    start_every_days: int = 30,
+    horizon_days: Optional[int] = None,
+    initial_portfolio_value: int = 10000,
+    base_rank_index: Optional[RankIndex] = None,
+    test_rank_index: Optional[RankIndex] = None,
+) -> pd.DataFrame:
+    """
+    Backtest every (rebalance_days, portfolio_size) configuration from a start
+    date every `start_every_days`, rather than only from the first date of the
+    data, so results (especially of long rebalance periods) do not hinge on one
+    arbitrary start date.
+
+    A portfolio only depends on the date it is selected on, and its return only
+    on how long it is held, so both are computed once and shared by all the
+    windows (and portfolio sizes) that hold it rather than re-running the full
+    loop of `compute_backtest_dfs` per start. Windows follow its steps, up to the
+    rounding of the portfolio values to cents between rebalances.
+
+    Args:
+        horizon_days: Length of every window. By default, windows run through
+            the last date of the data and start at least `rebalance_days`
+            before it.
+
+    Returns:
+        One row per configuration and window: the window's start and end dates
+        (the end date values the last portfolio held), its number of rebalances
+        and the final value and CAGR of both portfolios. The rows of a
+        configuration are the distribution of its outcomes over start dates.
+    """
+    daily_data = _as_market_data_store(daily_data)
+    returns = _HoldingPeriodReturns(
+        daily_data,
+        {
+            base_metric: _as_rank_index(base_rank_index, daily_data, base_metric),
+            test_metric: _as_rank_index(test_rank_index, daily_data, test_metric),
+        },
+        stocks_universe,
+        weight_strategy,
+        initial_portfolio_value,
+    )
+    calendar = TradingCalendar.from_store(daily_data)
+    data_start = daily_data.start_date
+    data_end = daily_data.end_date
+
+    rows = []
+    for period in rebalance_days:
+        window_days = period if horizon_days is None else horizon_days
+        last_start = data_end - datetime.timedelta(days=window_days)
+        if last_start < data_start:
+            raise Exception(f"The data is shorter than a window of {window_days} days.")
+        start_dates = calendar.rebalance_schedule(
+            data_start, last_start + datetime.timedelta(days=1), start_every_days
+        )
+        for start_date in start_dates:
+            if horizon_days is None:
+                end_date = data_end
+            else:
+                end_date = calendar.previous_session(
+                    start_date + datetime.timedelta(days=horizon_days)
+                )
+            rebalance_dates = calendar.rebalance_schedule(start_date, end_date, period)
+            # Held from every rebalance date to the next one, and the last
+            # portfolio to the end of the window
+            holding_dates = rebalance_dates + [end_date]
+            if rebalance_dates[-1] == end_date:
+                holding_dates = rebalance_dates
+            years = (end_date - start_date).days / DAYS_PER_YEAR
+
+            for size in portfolio_sizes:
+                values = {}
+                for metric in [base_metric, test_metric]:
+                    growth = np.prod(
+                        [
+                            returns.growth(metric, size, d0, d1)
+                            for d0, d1 in zip(holding_dates[:-1], holding_dates[1:])
+                        ]
+                    )
+                    values[metric] = round(initial_portfolio_value * growth, 2)
+                rows.append(
+                    (
+                        period,
+                        size,
+                        start_date,
+                        end_date,
+                        len(rebalance_dates),
+                        values[base_metric],
+                        values[test_metric],
+                        (values[base_metric] / initial_portfolio_value) ** (1 / years)
+                        - 1,
+                        (values[test_metric] / initial_portfolio_value) ** (1 / years)
+                        - 1,
+                    )
+                )
+
+    return pd.DataFrame(
+        rows,
+        columns=[
+            "rebalance_days",
+            "portfolio_size",
+            "start_date",
+            "end_date",
+            "num_rebalances",
+            "base_value",
+            "test_value",
+            "base_cagr",
+            "test_cagr",
+        ],
     )
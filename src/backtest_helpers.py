@@ -1,23 +1,66 @@
 import datetime
-from typing import List, Optional, Set, Tuple
+import functools
+from typing import List, Optional, Set, Tuple, Union
 
-import holidays
 import numpy as np
 import pandas as pd
 
-from src.backtest_helpers import *
-from src.data_types import *
+from src.data_types import (
+    CappedWeighting,
+    EvaluationMetric,
+    MarketCapBand,
+    ShareAllocation,
+    StockBasketWeightApproach,
+    StockRebalanceInstance,
+    StockUniverse,
+)
+from src.market_data import LastAvailablePrices
+from src.weighting import get_basket_weights
+
+
+def get_ticker_prices(
+    df: pd.DataFrame, tickers: List[str]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Resolve the prices of all `tickers` against `df` in a single indexed lookup.
+
+    ASSUMPTION: df is filtered by date, so each ticker appears at most once.
+
+    Returns:
+        The prices (NaN where missing) and a boolean mask of the tickers that
+        are not in `df`, both aligned with `tickers`.
+    """
+    ticker_index = pd.Index(df["ticker"].values)
+    assert ticker_index.is_unique, "Duplicate tickers found in dataframe."
+    positions = ticker_index.get_indexer(tickers)
+    missing = positions == -1
+    prices = np.full(len(positions), np.nan)
+    prices[~missing] = df["price"].values[positions[~missing]]
+    return prices, missing
 
 
 def get_ticker_price(df: pd.DataFrame, ticker: str) -> int:
-    row = df[df.ticker == ticker]
-    assert len(row) == 1, f"{len(row)} not found in dataframe."
-    return row["price"].iloc[0]
+    prices, missing = get_ticker_prices(df, [ticker])
+    assert not missing[0], f"{ticker} not found in dataframe."
+    return prices[0]
+
+
+@functools.lru_cache(maxsize=None)
+def us_holidays():
+    """
+    `holidays.US()`, built (and `holidays`, which is slow to import, imported)
+    on first use rather than when this module is imported.
+    """
+    import holidays
+
+    return holidays.US()
 
 
 def get_closest_previous_work_day(
-    check_day: datetime.datetime, holidays=holidays.US()
+    check_day: datetime.datetime, holidays=None
 ) -> datetime.datetime:
+    if holidays is None:
+        holidays = us_holidays()
     if check_day.weekday() <= 4 and check_day not in holidays:
         return check_day
     offset = max(1, (check_day.weekday() + 6) % 7 - 3)
@@ -54,55 +97,194 @@ def sort_df_by_metric(df: pd.DataFrame, metric: EvaluationMetric) -> pd.DataFram
         raise Exception(f"Unsupported evaluation metric {metric}")
 
 
+def _to_days(dates: pd.Series) -> np.ndarray:
+    # Days since the epoch, from "%Y-%m-%d" strings or datetimes, parsing each
+    # distinct date once
+    codes, unique_dates = pd.factorize(dates)
+    days = pd.to_datetime(unique_dates).values.astype("datetime64[D]").astype(np.int64)
+    return days[codes]
+
+
+def _to_codes(tickers: pd.Series, ticker_index: pd.Index) -> np.ndarray:
+    # Position of every ticker in `ticker_index` (-1 if not in it), looking up
+    # each distinct ticker once
+    codes, unique_tickers = pd.factorize(tickers)
+    return ticker_index.get_indexer(unique_tickers)[codes]
+
+
+def asof_join_filings(
+    df: pd.DataFrame,
+    df_filings: pd.DataFrame,
+    columns: List[str],
+    date_column: str = "datekey",
+    lag_days: int = 1,
+    max_age_days: Optional[int] = None,
+    chunk_size: int = 5_000_000,
+) -> pd.DataFrame:
+    """
+    Point in time join of fundamentals filings (e.g. the as reported dimensions
+    of Sharadar SF1) onto daily rows (e.g. `daily_data`): every row gets the
+    values of the last filing of its ticker available on its date, so metrics
+    derived from them (e.g. evebit, pe, pb) never use a filing before it was
+    public.
+
+    All tickers are matched at once, by binary search of the (ticker, date) of
+    every row in the filings sorted by (ticker, availability date), `chunk_size`
+    rows at a time to bound the memory used on top of the result.
+
+    Args:
+        df: Rows with "ticker" and "date" columns, in any order.
+        df_filings: Filings with "ticker", `date_column` and `columns`.
+        columns: The columns of the filings to join, replacing any column of
+            the same name in `df`.
+        date_column: Of the filings, the date they were filed ("datekey") or
+            the end of the period they report on ("reportperiod", with a
+            `lag_days` long enough for them to be filed).
+        lag_days: Calendar days after `date_column` a filing becomes available,
+            by default the next day since filings are often made after the
+            close. Filings available on the same day are ordered by
+            "reportperiod" (if any), the latest one winning.
+        max_age_days: Filings older than this (from when they became
+            available) are ignored, e.g. for companies that stopped filing.
+
+    Returns:
+        `df` with `columns` and `date_column` of the matched filings, NaN
+        where no filing was available.
+    """
+    filing_tickers = pd.Index(df_filings["ticker"].unique())
+    filing_codes = _to_codes(df_filings["ticker"], filing_tickers)
+    available = _to_days(df_filings[date_column]) + lag_days
+    sort_keys = [available, filing_codes]
+    if "reportperiod" in df_filings:
+        sort_keys.insert(0, _to_days(df_filings["reportperiod"]))
+    order = np.lexsort(sort_keys)
+    filing_codes = filing_codes[order]
+    available = available[order]
+
+    # (ticker, day) as one sortable integer, days shifted to be non negative
+    shift = np.int64(1 << 32)
+    filing_keys = filing_codes * shift + (available + (1 << 31))
+
+    match = np.full(len(df), -1, dtype=np.int64)
+    for start in range(0, len(df), chunk_size):
+        rows = df.iloc[start : start + chunk_size]
+        codes = _to_codes(rows["ticker"], filing_tickers)
+        days = _to_days(rows["date"])
+        keys = codes * shift + (days + (1 << 31))
+        # The last filing at or before each row's key
+        positions = np.searchsorted(filing_keys, keys, side="right") - 1
+        is_match = (codes != -1) & (positions >= 0)
+        is_match[is_match] = filing_codes[positions[is_match]] == codes[is_match]
+        if max_age_days is not None:
+            is_match[is_match] = (
+                days[is_match] - available[positions[is_match]] <= max_age_days
+            )
+        match[start : start + len(rows)] = np.where(
+            is_match, order[np.maximum(positions, 0)], -1
+        )
+
+    joined_columns = list(dict.fromkeys(columns + [date_column]))
+    df_joined = (
+        df_filings[joined_columns]
+        .iloc[np.maximum(match, 0)]
+        .reset_index(drop=True)
+        .mask(pd.Series(match == -1), axis=0)
+    )
+    # By position, since the index of `df` need not be unique
+    df = df.drop(columns=[c for c in joined_columns if c in df])
+    for column in joined_columns:
+        df[column] = df_joined[column].to_numpy()
+    return df
+
+
 def filter_df_by_date(df: pd.DataFrame, date: datetime.datetime) -> pd.DataFrame:
     return df[df.date == date.strftime("%Y-%m-%d")]
 
 
+def get_universe_mask(
+    df: pd.DataFrame, stocks_universe: Union[StockUniverse, MarketCapBand]
+) -> pd.Series:
+    if isinstance(stocks_universe, StockUniverse):
+        stocks_universe = stocks_universe.market_cap_band()
+    return stocks_universe.contains(df["marketcap"])
+
+
 def filter_stocks_by_universe(
-    df: pd.DataFrame, stocks_universe: StockUniverse
+    df: pd.DataFrame, stocks_universe: Union[StockUniverse, MarketCapBand]
 ) -> pd.DataFrame:
-    if stocks_universe.value == StockUniverse.SMALL.value:
-        return df[df["marketcap"] < 1]
-    elif stocks_universe.value == StockUniverse.MID.value:
-        return df[(df["marketcap"] >= 1) & (df["marketcap"] <= 10)]
-    elif stocks_universe.value == StockUniverse.LARGE.value:
-        return df[(df["marketcap"] >= 10)]
-    else:
-        raise Exception(f"Unsupported stock universe {stocks_universe}")
+    return df[get_universe_mask(df, stocks_universe)]
 
 
-def get_top_n_stocks_by_metric(
-    df: pd.DataFrame, n: int, metric: EvaluationMetric
-) -> List[str]:
-    df_res = None
+def get_metric_mask(df: pd.DataFrame, metric: EvaluationMetric) -> pd.Series:
+    """
+    Stocks for which `metric` is meaningful (e.g. positive earnings).
+    """
     if metric.value == EvaluationMetric.EV_EBIT.value:
-        # assert df['evebit'].dropna().is_monotonic_increasing
-        df_res = df[(df["evebit"] > 0) & (df["ev"] > 0)]
+        return (df["evebit"] > 0) & (df["ev"] > 0)
     elif metric.value == EvaluationMetric.P_E.value:
-        # assert df['pe'].is_monotonic_increasing
-        df_res = df[df["pe"] > 0]
+        return df["pe"] > 0
     elif metric.value == EvaluationMetric.P_B.value:
-        # assert df['pb'].is_monotonic_increasing
-        df_res = df[df["pb"] > 0]
+        return df["pb"] > 0
     elif metric.value == EvaluationMetric.DIV_YIELD.value:
         raise Exception("EvaluationMetric.DIV_YIELD not yet supported.")
     else:
         raise Exception(f"Unsupported evaluation metric {metric}")
 
+
+def get_metric_mask_columns(metric: EvaluationMetric) -> List[str]:
+    """
+    The columns `get_metric_mask` reads.
+    """
+    if metric.value == EvaluationMetric.EV_EBIT.value:
+        return ["evebit", "ev"]
+    elif metric.value in [EvaluationMetric.P_E.value, EvaluationMetric.P_B.value]:
+        return [metric.sorted_column()]
+    else:
+        raise Exception(f"Unsupported evaluation metric {metric}")
+
+
+def get_top_n_stocks_by_metric(
+    df: pd.DataFrame, n: int, metric: EvaluationMetric
+) -> List[str]:
+    # assert df[metric.sorted_column()].dropna().is_monotonic_increasing
+    df_res = df[get_metric_mask(df, metric)]
     return list(df_res[:n]["ticker"])
 
 
-def get_last_available_price(df: pd.DataFrame, ticker: str) -> int:
+# ASSUMPTION: df is filtered by date, `ranked_rows` are its rows ranked by a
+# metric (see `RankIndex.ranked_rows`) and `in_universe` masks its rows.
+def get_top_n_stocks_by_rank(
+    df: pd.DataFrame,
+    ranked_rows: np.ndarray,
+    n: int,
+    in_universe: np.ndarray,
+) -> List[str]:
+    return list(df["ticker"].values[ranked_rows[in_universe[ranked_rows]][:n]])
+
+
+def get_last_available_price(
+    df: Union[pd.DataFrame, LastAvailablePrices], ticker: str
+) -> int:
+    if isinstance(df, LastAvailablePrices):
+        return df.get_price(ticker)
     # assert df.index.is_monotonic_increasing
     # assert df.index.dtype == 'datetime64[ns]' and df.index.is_monotonic_increasing
     # assert_date_index_is_sorted(df)
     return df[df.ticker == ticker].iloc[-1]["price"]
 
 
+def get_last_available_prices(
+    df: Union[pd.DataFrame, LastAvailablePrices], tickers: List[str]
+) -> np.ndarray:
+    if isinstance(df, LastAvailablePrices):
+        return df.get_prices(tickers)
+    return np.array([get_last_available_price(df, ticker) for ticker in tickers])
+
+
 def get_per_stock_change(
     df: pd.DataFrame,
     df_prev: Optional[pd.DataFrame],
-    df_full: pd.DataFrame,
+    df_full: Union[pd.DataFrame, LastAvailablePrices],
     tickers: List[str],
 ) -> List[StockRebalanceInstance]:
     """
@@ -113,61 +295,68 @@ def get_per_stock_change(
     Args:
         df_full: Used to get the prices for stocks that are not available (acquired or closed).
     """
-    res = []
-    stocks_of_interest = df.loc[df["ticker"].isin(tickers)]
-    missing_stocks = set(tickers) - set(stocks_of_interest["ticker"])
-
-    for _idx, r in stocks_of_interest.iterrows():
-        ticker = r["ticker"]
-        price = r["price"]
-        prev_price = (
-            get_ticker_price(df_prev, ticker) if df_prev is not None else np.nan
-        )
-        res.append(StockRebalanceInstance(ticker, prev_price, price))
-
-    for missing_ticker in missing_stocks:
-        prev_price = (
-            get_ticker_price(df_prev, missing_ticker) if df_prev is not None else np.nan
-        )
-        price = get_last_available_price(df_full, missing_ticker)
-        res.append(StockRebalanceInstance(missing_ticker, prev_price, price))
+    tickers = sorted(set(tickers))
+    prices, missing = get_ticker_prices(df, tickers)
+    prices[missing] = get_last_available_prices(
+        df_full, [t for t, m in zip(tickers, missing) if m]
+    )
+    if df_prev is not None:
+        prev_prices, prev_missing = get_ticker_prices(df_prev, tickers)
+        assert not prev_missing.any(), "Tickers not found in previous dataframe."
+    else:
+        prev_prices = np.full(len(tickers), np.nan)
 
-    res.sort(key=lambda t: t.ticker)
-    return res
+    return [
+        StockRebalanceInstance(ticker, prev_price, price)
+        for ticker, prev_price, price in zip(tickers, prev_prices, prices)
+    ]
 
 
 # ASSUMPTION: df is filtered by date.
 def get_share_allocation(
     df: pd.DataFrame,
-    tickers: List[str],  # portfolio
+    tickers: List[str],  # portfolio, best first
     investment_amount: int,
-    weight_approach: StockBasketWeightApproach,
+    weight_approach: Union[StockBasketWeightApproach, CappedWeighting],
+    volatility: Optional[np.ndarray] = None,
 ) -> List[ShareAllocation]:
-    if weight_approach != StockBasketWeightApproach.EQUAL_WEIGHTING:
-        raise Exception(f"{weight_approach} not supported yet.")
-
-    amount_per_stock = investment_amount / len(tickers)
-    res = []
-    for ticker in tickers:
-        price = get_ticker_price(df, ticker)
-        num_shares = amount_per_stock / price
-        res.append(ShareAllocation(ticker, num_shares))
-    return res
+    """
+    Args:
+        volatility: Of every row of df (e.g. `MarketDataStore.volatility` of the
+            date's rows), only needed to weigh by inverse volatility.
+    """
+    ticker_index = pd.Index(df["ticker"].values)
+    assert ticker_index.is_unique, "Duplicate tickers found in dataframe."
+    positions = ticker_index.get_indexer(tickers)
+    assert (positions != -1).all(), "Tickers not found in dataframe."
+    prices = df["price"].values[positions]
+    weights = get_basket_weights(
+        weight_approach,
+        df["marketcap"].values[positions],
+        None if volatility is None else volatility[positions],
+    )
+    if weights is None:
+        num_shares = (investment_amount / len(tickers)) / prices
+    else:
+        num_shares = investment_amount * weights / prices
+    return [ShareAllocation(t, n) for t, n in zip(tickers, num_shares)]
 
 
 def get_portfolio_value(
     df: pd.DataFrame, share_allocation: List[ShareAllocation]
 ) -> float:
-    total = 0
-    for allocation in share_allocation:
-        price = get_ticker_price(df, allocation.ticker)
-        total += price * allocation.num_shares
-    return total
+    tickers = [alloc.ticker for alloc in share_allocation]
+    prices, missing = get_ticker_prices(df, tickers)
+    assert not missing.any(), "Tickers not found in dataframe."
+    num_shares = np.array([alloc.num_shares for alloc in share_allocation])
+    return float(np.sum(prices * num_shares))
 
 
 def get_stock_basket_price(
     df: pd.DataFrame,
-    df_full: pd.DataFrame,  # Used to get the prices for stocks that closed
+    df_full: Union[
+        pd.DataFrame, LastAvailablePrices
+    ],  # Used to get the prices for stocks that closed
     share_allocation: List[ShareAllocation],
 ) -> Tuple[float, Set[str]]:
     """
@@ -175,14 +364,10 @@ def get_stock_basket_price(
         df_full: Used to get the prices for stocks that are not available (acquired or closed).
     """
     tickers = [alloc.ticker for alloc in share_allocation]
-    stocks_of_interest = df.loc[df["ticker"].isin(tickers)]
-    missing_stocks = set(tickers) - set(stocks_of_interest["ticker"])
-    basket_price = 0
-    for alloc in share_allocation:
-        ticker = alloc.ticker
-        if ticker in missing_stocks:
-            price = get_last_available_price(df_full, ticker)
-        else:
-            price = get_ticker_price(df, ticker)
-        basket_price += price * alloc.num_shares
-    return (round(basket_price, 2), missing_stocks)
+    prices, missing = get_ticker_prices(df, tickers)
+    missing_stocks = {t for t, m in zip(tickers, missing) if m}
+    prices[missing] = get_last_available_prices(
+        df_full, [t for t, m in zip(tickers, missing) if m]
+    )
+    num_shares = np.array([alloc.num_shares for alloc in share_allocation])
+    return (round(float(np.sum(prices * num_shares)), 2), missing_stocks)
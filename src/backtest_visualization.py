@@ -1,5 +1,4 @@
-from src.backtest import *
-from src.data_types import *
+from src.backtest import BackTestResult
 
 
 def plot_backtest(back_test_result: BackTestResult) -> None:
@@ -1,12 +1,30 @@
 # Preprocess a bunch of data sets in advance.
 
-from src.backtest import *
-from src.backtest_helpers import *
-from src.data_types import *
-from src.serialization_lib import *
+import os
+from typing import List, Optional
 
+from src.batch.sweep import SweepCellResult, SweepConfig, run_sweep
+from src.data_types import (
+    EvaluationMetric,
+    ResultDetail,
+    StockBasketWeightApproach,
+    StockUniverse,
+)
+from src.market_data import MarketDataStore
 
-def run():
+
+def run(
+    max_workers: Optional[int] = None,
+    detail: ResultDetail = ResultDetail.FULL,
+    instrument: bool = False,
+) -> List[SweepCellResult]:
+    """
+    Args:
+        detail: Of the saved df_debug, e.g. `ResultDetail.NONE` when only the
+            portfolio values are investigated across the grid.
+        instrument: Record the time per stage of every cell (see
+            `SweepCellResult.timings`) and log the totals over the grid.
+    """
     INITIAL_PORTFOLIO_VALUE = 10000
 
     PORTFOLIO_SIZE = [5, 10, 15, 30, 60]
@@ -28,38 +46,31 @@ def run():
     STOCKS_UNIVERSE = StockUniverse.LARGE
     PORTFOLIO_WEIGHT_STRATEGY = StockBasketWeightApproach.EQUAL_WEIGHTING
 
-    daily_data = read_df_from_feather(
-        os.path.join(DATA_PROCESSED_BASE_PATH, f"daily_data_prod.feather")
+    # Partition the data by date once instead of on every backtest, reading only
+    # the columns the backtests need.
+    daily_data = MarketDataStore.from_feather(
+        os.path.join(DATA_PROCESSED_BASE_PATH, f"daily_data_prod.feather"),
+        [BASE_METRIC, TEST_METRIC],
     )
-    daily_data_base_sorted = read_df_from_feather(
-        os.path.join(DATA_PROCESSED_BASE_PATH, f"daily_data_base_sorted_prod.feather")
+
+    config = SweepConfig(
+        BASE_METRIC,
+        TEST_METRIC,
+        STOCKS_UNIVERSE,
+        PORTFOLIO_WEIGHT_STRATEGY,
+        INITIAL_PORTFOLIO_VALUE,
+        DATA_PROCESSED_BASE_PATH,
+        detail=detail,
+        instrument=instrument,
+        # Only recompute the cells whose data, parameters or code changed.
+        cache_dir=os.path.join(DATA_PROCESSED_BASE_PATH, "result_cache"),
+        # One dataset the notebooks can slice, written while the cells compute.
+        write_dataset=True,
     )
-    daily_data_test_sorted = read_df_from_feather(
-        os.path.join(DATA_PROCESSED_BASE_PATH, f"daily_data_test_sorted_prod.feather")
+    return run_sweep(
+        config,
+        REBALANCE_DAYS,
+        PORTFOLIO_SIZE,
+        daily_data,
+        max_workers=max_workers,
     )
-
-    for rebalance_days in REBALANCE_DAYS:
-        for portfolio_size in PORTFOLIO_SIZE:
-            print(
-                f"rebalance_days:{rebalance_days}", f"portfolio_size:{portfolio_size}"
-            )
-            try:
-                compute_backtest_dfs(
-                    BASE_METRIC,
-                    TEST_METRIC,
-                    STOCKS_UNIVERSE,
-                    PORTFOLIO_WEIGHT_STRATEGY,
-                    rebalance_days,
-                    portfolio_size,
-                    INITIAL_PORTFOLIO_VALUE,
-                    daily_data,
-                    daily_data_base_sorted,
-                    daily_data_test_sorted,
-                )
-            except Exception as e:
-                print(
-                    "Caught exception while processing...",
-                    e,
-                    f"rebalance_days:{rebalance_days}",
-                    f"portfolio_size:{portfolio_size}",
-                )
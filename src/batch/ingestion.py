@@ -0,0 +1,543 @@
+# Ingest the raw Sharadar bulk exports (CSV or zipped CSV) into the processed daily
+# data, as a dataset partitioned by year, reprocessing only what changed since the
+# previous run.
+
+import dataclasses
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+logger = logging.getLogger(__name__)
+
+# Columns parsed as strings, all others as floats, so that every chunk of every
+# export has the same schema whatever values it happens to hold.
+STRING_COLUMNS = ["ticker", "date", "lastupdated"]
+PRICE_COLUMNS = ["ticker", "date", "closeadj"]
+
+_MANIFEST_FILENAME = "manifest.json"
+
+
+@dataclasses.dataclass
+class IngestionConfig:
+    raw_dir: str
+    output_dir: str
+    env: str = "prod"
+    # Glob patterns, relative to `raw_dir`, of the exports of each table. Rows of
+    # later files (by name) replace those of earlier ones for the same (date,
+    # ticker), so incremental exports can be dropped next to the full ones.
+    metrics_patterns: List[str] = dataclasses.field(
+        default_factory=lambda: ["SHARADAR?DAILY*"]
+    )
+    prices_patterns: List[str] = dataclasses.field(
+        default_factory=lambda: ["SHARADAR?SEP*", "SHARADAR?SFP*"]
+    )
+    # Tickers are hashed into this many partitions, joined in parallel
+    num_buckets: int = 16
+    # Rows of an export parsed at once
+    chunk_size: int = 500_000
+    # Also write the single `daily_data_{env}.feather` file the notebooks read
+    write_monolithic: bool = True
+
+    @property
+    def dataset_dir(self) -> str:
+        return os.path.join(self.output_dir, f"daily_data_{self.env}")
+
+    @property
+    def monolithic_filename(self) -> str:
+        return os.path.join(self.output_dir, f"daily_data_{self.env}.feather")
+
+    @property
+    def work_dir(self) -> str:
+        return os.path.join(self.output_dir, f"ingestion_{self.env}")
+
+
+@dataclasses.dataclass
+class IngestionResult:
+    # Ids ("table/filename") of the exports parsed by this run
+    staged_sources: List[str]
+    joined_buckets: List[int]
+    written_years: List[str]
+    removed_years: List[str]
+    wrote_monolithic: bool
+
+    @property
+    def changed(self) -> bool:
+        return bool(
+            self.staged_sources
+            or self.joined_buckets
+            or self.written_years
+            or self.removed_years
+        )
+
+
+def _ticker_buckets(tickers: pd.Series, num_buckets: int) -> np.ndarray:
+    # pandas hashes with a fixed key, so a ticker is in the same bucket in every
+    # process and run.
+    hashes = pd.util.hash_array(tickers.to_numpy(dtype=object))
+    return (hashes % np.uint64(num_buckets)).astype(np.int64)
+
+
+def _file_sha256(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fingerprint(filename: str) -> Dict[str, int]:
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _export_schema(filename: str, columns: Optional[List[str]]) -> pa.Schema:
+    header = pd.read_csv(filename, nrows=0).columns
+    if columns is not None:
+        missing = set(columns) - set(header)
+        if missing:
+            raise Exception(f"{filename} is missing the columns {sorted(missing)}")
+        header = [c for c in header if c in columns]
+    return pa.schema(
+        [(c, pa.string() if c in STRING_COLUMNS else pa.float64()) for c in header]
+    )
+
+
+def _stage_source(
+    filename: str,
+    staging_dir: str,
+    columns: Optional[List[str]],
+    num_buckets: int,
+    chunk_size: int,
+) -> Dict[str, str]:
+    """
+    Split an export into one Arrow file per ticker bucket, streaming it in chunks
+    of `chunk_size` rows so it is never fully in memory.
+
+    Returns:
+        The sha256 of the staged file of every bucket with rows.
+    """
+    schema = _export_schema(filename, columns)
+    writers = {}
+    try:
+        for chunk in pd.read_csv(
+            filename,
+            usecols=schema.names,
+            dtype={f.name: str if f.name in STRING_COLUMNS else float for f in schema},
+            chunksize=chunk_size,
+        ):
+            table = pa.Table.from_pandas(
+                chunk[schema.names], schema=schema, preserve_index=False
+            )
+            # The rows of each bucket as one slice of the table
+            buckets = _ticker_buckets(chunk["ticker"], num_buckets)
+            table = table.take(pa.array(np.argsort(buckets, kind="stable")))
+            counts = np.bincount(buckets, minlength=num_buckets)
+            starts = np.cumsum(counts) - counts
+            for bucket in np.flatnonzero(counts):
+                if bucket not in writers:
+                    writers[bucket] = pa.ipc.new_file(
+                        os.path.join(staging_dir, f"{bucket}.arrow"), schema
+                    )
+                writers[bucket].write_table(table.slice(starts[bucket], counts[bucket]))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return {
+        str(bucket): _file_sha256(os.path.join(staging_dir, f"{bucket}.arrow"))
+        for bucket in sorted(writers)
+    }
+
+
+def _read_staged(filenames: List[str]) -> Optional[pd.DataFrame]:
+    """
+    The rows of the staged files, those of later files replacing the ones of
+    earlier files for the same (date, ticker).
+    """
+    if not filenames:
+        return None
+    df = pa.concat_tables(
+        [feather.read_table(filename) for filename in filenames]
+    ).to_pandas()
+    return df.drop_duplicates(subset=["date", "ticker"], keep="last")
+
+
+def _join_bucket(
+    metrics_filenames: List[str], prices_filenames: List[str], joined_filename: str
+) -> List[str]:
+    """
+    Join the metrics and prices of a ticker bucket like `BackTest_GenerateData`
+    did for the whole data set, sorted by (date, ticker).
+
+    Returns:
+        The years with rows.
+    """
+    metrics = _read_staged(metrics_filenames)
+    prices = _read_staged(prices_filenames)
+    if metrics is None or prices is None:
+        if os.path.exists(joined_filename):
+            os.remove(joined_filename)
+        return []
+
+    df = metrics.merge(prices[PRICE_COLUMNS], on=["date", "ticker"], how="inner")
+    df.rename(columns={"closeadj": "price"}, inplace=True)
+    df.sort_values(by=["date", "ticker"], kind="mergesort", inplace=True)
+    schema = pa.schema(
+        [(c, pa.string() if c in STRING_COLUMNS else pa.float64()) for c in df.columns]
+    )
+    _write_atomically(
+        pa.Table.from_pandas(df, schema=schema, preserve_index=False), joined_filename
+    )
+    return sorted(df["date"].str[:4].unique().tolist())
+
+
+def _year_filename(dataset_dir: str, year: str) -> str:
+    return os.path.join(dataset_dir, f"year={year}", "part-0.feather")
+
+
+def _write_year(year: str, joined_filenames: List[str], dataset_dir: str) -> int:
+    """
+    Gather the rows of `year` from every joined bucket into its partition.
+
+    Returns:
+        The number of rows written.
+    """
+    import pyarrow.compute as pc
+
+    tables = []
+    for filename in joined_filenames:
+        table = feather.read_table(filename, memory_map=True)
+        # "%Y-%m-%d" dates sort like strings
+        in_year = pc.and_(
+            pc.greater_equal(table["date"], year),
+            pc.less(table["date"], str(int(year) + 1)),
+        )
+        tables.append(table.filter(in_year))
+    df = pa.concat_tables(tables).to_pandas()
+    df.sort_values(by=["date", "ticker"], kind="mergesort", inplace=True)
+    filename = _year_filename(dataset_dir, year)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    _write_atomically(
+        pa.Table.from_pandas(df, schema=tables[0].schema, preserve_index=False),
+        filename,
+    )
+    return len(df)
+
+
+def _tmp_filename(filename: str) -> str:
+    # Hidden, so a leftover one is not read as part of the dataset
+    return os.path.join(os.path.dirname(filename), f".{os.path.basename(filename)}.tmp")
+
+
+def _write_atomically(table: pa.Table, filename: str) -> None:
+    # A run killed while writing leaves the previous file rather than half of one
+    tmp_filename = _tmp_filename(filename)
+    feather.write_feather(table, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def _write_monolithic(dataset_dir: str, years: List[str], filename: str) -> None:
+    # One year in memory at a time
+    if not years and os.path.exists(filename):
+        os.remove(filename)
+    tmp_filename = _tmp_filename(filename)
+    writer = None
+    try:
+        for year in years:
+            table = feather.read_table(_year_filename(dataset_dir, year))
+            if writer is None:
+                writer = pa.ipc.new_file(
+                    tmp_filename,
+                    table.schema,
+                    options=pa.ipc.IpcWriteOptions(compression="lz4"),
+                )
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is not None:
+        os.replace(tmp_filename, filename)
+
+
+class _Manifest:
+    """
+    What the previous runs processed: the fingerprint of every staged export and
+    the hash of its staged bucket files, the input hash and years of every joined
+    bucket, and the outputs left to rewrite. Saved after every unit of work, so a
+    killed run resumes where it stopped.
+    """
+
+    def __init__(self, filename: str, num_buckets: int):
+        self.filename = filename
+        state = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                state = json.load(f)
+        # Without a manifest for these buckets, nothing on disk can be reused
+        self.reset = state.get("num_buckets") != num_buckets
+        if self.reset:
+            state = {}
+        self.num_buckets = num_buckets
+        self.sources: Dict[str, Dict] = state.get("sources", {})
+        self.buckets: Dict[str, Dict] = state.get("buckets", {})
+        self.pending_years: List[str] = state.get("pending_years", [])
+        self.monolithic_stale: bool = state.get("monolithic_stale", True)
+
+    def save(self) -> None:
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(
+                {
+                    "num_buckets": self.num_buckets,
+                    "sources": self.sources,
+                    "buckets": self.buckets,
+                    "pending_years": sorted(set(self.pending_years)),
+                    "monolithic_stale": self.monolithic_stale,
+                },
+                f,
+                indent=1,
+            )
+        os.replace(tmp_filename, self.filename)
+
+    def years(self) -> List[str]:
+        return sorted({y for bucket in self.buckets.values() for y in bucket["years"]})
+
+
+def _find_sources(config: IngestionConfig) -> Dict[str, str]:
+    """
+    The exports in `config.raw_dir`, by id ("table/filename") in the order their
+    rows override each other.
+    """
+    sources = {}
+    for table, patterns in [
+        ("metrics", config.metrics_patterns),
+        ("prices", config.prices_patterns),
+    ]:
+        filenames = {
+            filename
+            for pattern in patterns
+            for filename in glob.glob(os.path.join(config.raw_dir, pattern))
+            if os.path.isfile(filename)
+        }
+        for filename in sorted(filenames, key=os.path.basename):
+            sources[f"{table}/{os.path.basename(filename)}"] = filename
+    return sources
+
+
+def _staging_dir(config: IngestionConfig, source_id: str) -> str:
+    return os.path.join(config.work_dir, "staging", source_id)
+
+
+def _joined_filename(config: IngestionConfig, bucket: str) -> str:
+    return os.path.join(config.work_dir, "joined", f"{bucket}.feather")
+
+
+def _bucket_inputs(manifest: _Manifest, bucket: str) -> Dict[str, List[str]]:
+    """
+    The ids of the exports with rows in `bucket`, per table.
+    """
+    inputs = {"metrics": [], "prices": []}
+    for source_id, source in manifest.sources.items():
+        if bucket in source["buckets"]:
+            inputs[source_id.split("/")[0]].append(source_id)
+    return inputs
+
+
+def _stage(
+    config: IngestionConfig,
+    manifest: _Manifest,
+    executor: ProcessPoolExecutor,
+) -> List[str]:
+    sources = _find_sources(config)
+    for source_id in list(manifest.sources):
+        if source_id not in sources:
+            logger.info("Removing %s, its export is gone", source_id)
+            shutil.rmtree(_staging_dir(config, source_id), ignore_errors=True)
+            del manifest.sources[source_id]
+    manifest.save()
+
+    futures = {}
+    for source_id, filename in sources.items():
+        fingerprint = _fingerprint(filename)
+        previous = manifest.sources.get(source_id)
+        if previous is not None and previous["fingerprint"] == fingerprint:
+            continue
+        # Dropped from the manifest until staged again, in case the run is killed
+        manifest.sources.pop(source_id, None)
+        staging_dir = _staging_dir(config, source_id)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        futures[source_id] = (
+            fingerprint,
+            executor.submit(
+                _stage_source,
+                filename,
+                staging_dir,
+                None if source_id.startswith("metrics/") else PRICE_COLUMNS,
+                config.num_buckets,
+                config.chunk_size,
+            ),
+        )
+    manifest.save()
+
+    for source_id, (fingerprint, future) in futures.items():
+        manifest.sources[source_id] = {
+            "fingerprint": fingerprint,
+            "buckets": future.result(),
+        }
+        manifest.save()
+        logger.info("Staged %s", source_id)
+    # Keep the override order of `_find_sources`
+    manifest.sources = {s: manifest.sources[s] for s in sources}
+    manifest.save()
+    return list(futures)
+
+
+def _join(
+    config: IngestionConfig,
+    manifest: _Manifest,
+    executor: ProcessPoolExecutor,
+) -> List[int]:
+    os.makedirs(os.path.join(config.work_dir, "joined"), exist_ok=True)
+    futures = {}
+    for bucket in map(str, range(config.num_buckets)):
+        inputs = _bucket_inputs(manifest, bucket)
+        # Staged files are hashed, so a re-exported file only changes the
+        # buckets whose rows differ.
+        input_hash = hashlib.sha256(
+            "\n".join(
+                f"{source_id}:{manifest.sources[source_id]['buckets'][bucket]}"
+                for table in ["metrics", "prices"]
+                for source_id in inputs[table]
+            ).encode()
+        ).hexdigest()
+        previous = manifest.buckets.get(bucket)
+        if previous is not None and previous["input_hash"] == input_hash:
+            continue
+        futures[bucket] = (
+            input_hash,
+            executor.submit(
+                _join_bucket,
+                *[
+                    [
+                        os.path.join(_staging_dir(config, s), f"{bucket}.arrow")
+                        for s in inputs[table]
+                    ]
+                    for table in ["metrics", "prices"]
+                ],
+                _joined_filename(config, bucket),
+            ),
+        )
+
+    for bucket, (input_hash, future) in futures.items():
+        years = future.result()
+        previous = manifest.buckets.get(bucket, {"years": []})
+        # The years the bucket had rows in before are stale too
+        manifest.pending_years = sorted(
+            set(manifest.pending_years) | set(previous["years"]) | set(years)
+        )
+        manifest.buckets[bucket] = {"input_hash": input_hash, "years": years}
+        manifest.monolithic_stale = True
+        manifest.save()
+    if futures:
+        logger.info("Joined %d of %d buckets", len(futures), config.num_buckets)
+    return sorted(map(int, futures))
+
+
+def _write_years(
+    config: IngestionConfig,
+    manifest: _Manifest,
+    executor: ProcessPoolExecutor,
+) -> Tuple[List[str], List[str]]:
+    """
+    Returns:
+        The years written and the years removed.
+    """
+    years = set(manifest.years())
+    removed = []
+    futures = {}
+    for year in sorted(set(manifest.pending_years)):
+        if year not in years:
+            shutil.rmtree(
+                os.path.dirname(_year_filename(config.dataset_dir, year)),
+                ignore_errors=True,
+            )
+            removed.append(year)
+            continue
+        joined_filenames = [
+            _joined_filename(config, bucket)
+            for bucket, state in sorted(manifest.buckets.items())
+            if year in state["years"]
+        ]
+        futures[year] = executor.submit(
+            _write_year, year, joined_filenames, config.dataset_dir
+        )
+
+    for year, future in futures.items():
+        logger.info("Wrote %d rows of %s", future.result(), year)
+        manifest.pending_years.remove(year)
+        manifest.save()
+    for year in removed:
+        logger.info("Removed %s, it has no rows left", year)
+        manifest.pending_years.remove(year)
+    manifest.save()
+    return sorted(futures), removed
+
+
+def run_ingestion(
+    config: IngestionConfig, max_workers: Optional[int] = None
+) -> IngestionResult:
+    """
+    Bring the processed daily data up to date with the exports in
+    `config.raw_dir`, over a pool of `max_workers` processes (defaults to the
+    number of CPUs):
+
+    1. Every new or changed (by size or modification time) export is streamed in
+       chunks and split into ticker buckets.
+    2. Every ticker bucket whose staged files changed is joined (metrics with
+       prices) in parallel.
+    3. Every year a changed bucket has rows in is rewritten as a partition of
+       `config.dataset_dir` ("year=YYYY/part-0.feather").
+
+    The intermediate files and the manifest of what was processed are kept in
+    `config.work_dir`, so runs with unchanged exports do nothing and killed runs
+    resume where they stopped. The dataset can be read with
+    `MarketDataStore.from_feather` like the single file.
+    """
+    os.makedirs(config.work_dir, exist_ok=True)
+    manifest = _Manifest(
+        os.path.join(config.work_dir, _MANIFEST_FILENAME), config.num_buckets
+    )
+    if manifest.reset:
+        for name in ["staging", "joined"]:
+            shutil.rmtree(os.path.join(config.work_dir, name), ignore_errors=True)
+        shutil.rmtree(config.dataset_dir, ignore_errors=True)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        staged_sources = _stage(config, manifest, executor)
+        joined_buckets = _join(config, manifest, executor)
+        written_years, removed_years = _write_years(config, manifest, executor)
+
+    wrote_monolithic = False
+    if config.write_monolithic and (
+        manifest.monolithic_stale or not os.path.exists(config.monolithic_filename)
+    ):
+        _write_monolithic(
+            config.dataset_dir, manifest.years(), config.monolithic_filename
+        )
+        manifest.monolithic_stale = False
+        manifest.save()
+        wrote_monolithic = True
+
+    return IngestionResult(
+        staged_sources, joined_buckets, written_years, removed_years, wrote_monolithic
+    )
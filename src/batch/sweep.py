@@ -0,0 +1,405 @@
+# Run a grid of backtests (rebalance days x portfolio size) over a process pool.
+
+import dataclasses
+import json
+import logging
+import os
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from src.backtest import BackTestResult, compute_backtest_dfs
+from src.data_types import (
+    CappedWeighting,
+    EvaluationMetric,
+    MarketCapBand,
+    ResultDetail,
+    StockBasketWeightApproach,
+    StockUniverse,
+)
+from src.instrumentation import StageTimings
+from src.market_data import LastAvailablePrices, MarketDataStore
+from src.rank_index import RankIndex
+from src.result_cache import DEFAULT_MAX_SIZE_BYTES, ResultCache, backtest_cache_key
+from src.result_dataset import ResultWriter, result_dataset_dir
+from src.serialization_lib import read_df_from_feather
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class SweepConfig:
+    base_metric: EvaluationMetric
+    test_metric: EvaluationMetric
+    stocks_universe: Union[StockUniverse, MarketCapBand]
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting]
+    initial_portfolio_value: int
+    base_path: str
+    env: str = "prod"
+    detail: ResultDetail = ResultDetail.FULL
+    daily_values: bool = False
+    # Record the time spent per stage of every cell (see `StageTimings`)
+    instrument: bool = False
+    # Write the results into one dataset (see `result_dataset_dir`) from a
+    # background thread rather than one feather file per table and cell
+    write_dataset: bool = False
+    # Reuse results from (and add new ones to) a `ResultCache` in this directory
+    cache_dir: Optional[str] = None
+    cache_max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES
+    # Where the market data is written for the workers to memory map, by default
+    # the local temporary directory rather than next to the processed data
+    tmp_dir: Optional[str] = None
+
+    def result_cache(self) -> Optional[ResultCache]:
+        if self.cache_dir is None:
+            return None
+        return ResultCache(self.cache_dir, self.cache_max_size_bytes)
+
+
+@dataclasses.dataclass
+class SweepCellResult:
+    rebalance_days: int
+    portfolio_size: int
+    wall_time_s: float
+    error: Optional[str] = None
+    traceback: Optional[str] = None
+    # Found in the result cache rather than computed
+    cached: bool = False
+    # `StageTimings.to_dict()` of the cell, if `SweepConfig.instrument`
+    timings: Optional[Dict[str, Dict[str, float]]] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+# Per worker process state, set once by `_init_worker`.
+_WORKER_STATE: Dict[str, object] = {}
+
+
+# Copy-on-Write pandas never copies the frames it concatenates, and deprecates `copy`
+_CONCAT_WITHOUT_COPY = {"copy": False} if int(pd.__version__.split(".")[0]) < 3 else {}
+
+
+def _write_for_memory_mapping(store: MarketDataStore, directory: str) -> None:
+    """
+    The numeric columns of each dtype as one (columns x rows) .npy array, which
+    workers memory map as a single pandas block (pandas copies columns of the
+    same dtype held in separate arrays into one block), and the other columns
+    (e.g. tickers) as a feather file.
+    """
+    os.makedirs(directory)
+    layout = []
+    for dtype, columns in store.df.columns.groupby(store.df.dtypes).items():
+        columns = list(columns)
+        if isinstance(dtype, np.dtype) and dtype.kind in "biufM":
+            filename = f"{len(layout)}.npy"
+            np.save(
+                os.path.join(directory, filename),
+                np.stack([store.df[c].values for c in columns]),
+            )
+        else:
+            filename = f"{len(layout)}.feather"
+            store.df[columns].to_feather(os.path.join(directory, filename))
+        layout.append({"filename": filename, "columns": columns})
+    with open(os.path.join(directory, "layout.json"), "w") as f:
+        json.dump(layout, f)
+
+
+def _load_memory_mapped(directory: str) -> MarketDataStore:
+    """
+    The store written by `_write_for_memory_mapping`, with its numeric columns
+    read-only views of the mapped files, so every worker shares them through
+    the OS page cache rather than holding its own copy.
+    """
+    with open(os.path.join(directory, "layout.json")) as f:
+        layout = json.load(f)
+    frames = []
+    for file in layout:
+        filename = os.path.join(directory, file["filename"])
+        if filename.endswith(".npy"):
+            values = np.load(filename, mmap_mode="r")
+            frame = pd.DataFrame(values.T, columns=file["columns"], copy=False)
+        else:
+            frame = read_df_from_feather(filename)
+        frames.append(frame)
+    # One block per dtype, so pandas has nothing to consolidate (copy)
+    df = pd.concat(frames, axis=1, **_CONCAT_WITHOUT_COPY)
+    # Already partitioned by date, so this only rebuilds the offset table.
+    return MarketDataStore(df)
+
+
+def _init_worker(
+    config: SweepConfig, filenames: Dict[str, str], column_hashes: Dict[str, str]
+) -> None:
+    daily_data = _load_memory_mapped(filenames["daily_data"])
+    daily_data.last_available_prices = LastAvailablePrices.load(
+        filenames["last_available_prices"]
+    )
+    # Hashed once by the parent rather than by every worker
+    daily_data.column_hashes.update(column_hashes)
+    _WORKER_STATE["config"] = config
+    _WORKER_STATE["cache"] = config.result_cache()
+    _WORKER_STATE["daily_data"] = daily_data
+    for name, metric in [
+        ("base_rank_index", config.base_metric),
+        ("test_rank_index", config.test_metric),
+    ]:
+        rank_index = RankIndex.load(filenames[name], metric)
+        # e.g. replaced by a sweep over different data since the parent saved it
+        if not rank_index.is_valid_for(daily_data):
+            raise Exception(f"{filenames[name]} is not the rank index of the data.")
+        _WORKER_STATE[name] = rank_index
+
+
+def _timings_of(config: SweepConfig) -> Optional[StageTimings]:
+    return StageTimings() if config.instrument else None
+
+
+def _timings_dict(timings: Optional[StageTimings]) -> Optional[Dict]:
+    return None if timings is None else timings.to_dict()
+
+
+def _run_cell(
+    rebalance_days: int, portfolio_size: int
+) -> Tuple[SweepCellResult, Optional[BackTestResult]]:
+    """
+    Returns:
+        The cell result and, with `SweepConfig.write_dataset`, the backtest
+        result for the parent to write (otherwise saved to disk here).
+    """
+    config = _WORKER_STATE["config"]
+    timings = _timings_of(config)
+    start = time.perf_counter()
+    try:
+        result = compute_backtest_dfs(
+            config.base_metric,
+            config.test_metric,
+            config.stocks_universe,
+            config.weight_strategy,
+            rebalance_days,
+            portfolio_size,
+            config.initial_portfolio_value,
+            _WORKER_STATE["daily_data"],
+            _WORKER_STATE["base_rank_index"],
+            _WORKER_STATE["test_rank_index"],
+            base_path=config.base_path,
+            save_to_disk=not config.write_dataset,
+            env=config.env,
+            cache=_WORKER_STATE["cache"],
+            detail=config.detail,
+            daily_values=config.daily_values,
+            timings=timings,
+        )
+    except Exception as e:
+        cell_result = SweepCellResult(
+            rebalance_days,
+            portfolio_size,
+            time.perf_counter() - start,
+            error=f"{type(e).__name__}: {e}",
+            traceback=traceback.format_exc(),
+            timings=_timings_dict(timings),
+        )
+        return cell_result, None
+    cell_result = SweepCellResult(
+        rebalance_days,
+        portfolio_size,
+        time.perf_counter() - start,
+        timings=_timings_dict(timings),
+    )
+    # Timings are returned with the cell result, not pickled twice
+    result.timings = None
+    return cell_result, result if config.write_dataset else None
+
+
+def _run_cached_cells(
+    config: SweepConfig,
+    cells: List[Tuple[int, int]],
+    daily_data: MarketDataStore,
+    writer: Optional[ResultWriter],
+) -> Tuple[List[SweepCellResult], List[Tuple[int, int]]]:
+    """
+    Save to disk (or to `writer`) the cells already in the result cache.
+
+    Returns:
+        The results of the cached cells and the cells left to compute.
+    """
+    cache = config.result_cache()
+    if cache is None:
+        return [], cells
+
+    results = []
+    pending = []
+    for rebalance_days, portfolio_size in cells:
+        key = backtest_cache_key(
+            daily_data,
+            config.base_metric,
+            config.test_metric,
+            config.stocks_universe,
+            config.weight_strategy,
+            rebalance_days,
+            portfolio_size,
+            config.initial_portfolio_value,
+            config.detail,
+            config.daily_values,
+        )
+        if key not in cache:
+            pending.append((rebalance_days, portfolio_size))
+            continue
+        timings = _timings_of(config)
+        start = time.perf_counter()
+        result = compute_backtest_dfs(
+            config.base_metric,
+            config.test_metric,
+            config.stocks_universe,
+            config.weight_strategy,
+            rebalance_days,
+            portfolio_size,
+            config.initial_portfolio_value,
+            daily_data,
+            base_path=config.base_path,
+            save_to_disk=writer is None,
+            env=config.env,
+            cache=cache,
+            detail=config.detail,
+            daily_values=config.daily_values,
+            timings=timings,
+        )
+        if writer is not None:
+            writer.submit(result)
+        results.append(
+            SweepCellResult(
+                rebalance_days,
+                portfolio_size,
+                time.perf_counter() - start,
+                cached=True,
+                timings=_timings_dict(timings),
+            )
+        )
+    logger.info("%d of %d cells found in the result cache", len(results), len(cells))
+    return results, pending
+
+
+def _run_cells_in_pool(
+    config: SweepConfig,
+    cells: List[Tuple[int, int]],
+    daily_data: MarketDataStore,
+    max_workers: Optional[int],
+    writer: Optional[ResultWriter],
+) -> List[SweepCellResult]:
+    results = []
+    with tempfile.TemporaryDirectory(dir=config.tmp_dir) as tmp_dir:
+        filenames = {
+            "daily_data": os.path.join(tmp_dir, "daily_data"),
+            "last_available_prices": LastAvailablePrices.filename(
+                config.base_path, daily_data, config.env
+            ),
+            "base_rank_index": RankIndex.filename(
+                config.base_path, config.base_metric, daily_data, config.env
+            ),
+            "test_rank_index": RankIndex.filename(
+                config.base_path, config.test_metric, daily_data, config.env
+            ),
+        }
+        _write_for_memory_mapping(daily_data, filenames["daily_data"])
+        LastAvailablePrices.load_or_build(daily_data, config.base_path, config.env)
+        for metric in [config.base_metric, config.test_metric]:
+            RankIndex.load_or_build(daily_data, metric, config.base_path, config.env)
+
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(config, filenames, daily_data.column_hashes),
+        ) as executor:
+            futures = {executor.submit(_run_cell, r, p): (r, p) for (r, p) in cells}
+            for future in as_completed(futures):
+                try:
+                    result, backtest_result = future.result()
+                except Exception as e:
+                    # e.g. the worker process died
+                    result = SweepCellResult(
+                        *futures[future],
+                        wall_time_s=float("nan"),
+                        error=f"{type(e).__name__}: {e}",
+                        traceback=traceback.format_exc(),
+                    )
+                    backtest_result = None
+                if backtest_result is not None:
+                    writer.submit(backtest_result)
+                if result.succeeded:
+                    logger.info(
+                        "Finished rebalance_days:%d portfolio_size:%d in %.1fs",
+                        result.rebalance_days,
+                        result.portfolio_size,
+                        result.wall_time_s,
+                    )
+                else:
+                    logger.error(
+                        "Failed rebalance_days:%d portfolio_size:%d: %s",
+                        result.rebalance_days,
+                        result.portfolio_size,
+                        result.error,
+                    )
+                results.append(result)
+
+    return results
+
+
+def run_sweep(
+    config: SweepConfig,
+    rebalance_days: List[int],
+    portfolio_sizes: List[int],
+    daily_data: MarketDataStore,
+    max_workers: Optional[int] = None,
+) -> List[SweepCellResult]:
+    """
+    Compute (and save to disk) every (rebalance_days, portfolio_size) cell of the
+    grid over a pool of `max_workers` processes (defaults to the number of CPUs).
+
+    The read-only market data is written once as uncompressed arrays that every
+    worker memory maps (see `_write_for_memory_mapping`), in `config.tmp_dir`
+    (defaults to the local temporary directory), instead of being
+    pickled to each task or copied into each worker, and the
+    lookup tables are loaded from next to the processed data. Failed cells
+    do not stop the sweep; they are returned with their error and traceback.
+
+    With a `config.cache_dir`, cells already in the result cache are only saved
+    to disk, and only the others are computed (and added to the cache).
+
+    With `config.instrument`, every cell result holds its time per stage, and
+    the total per stage is logged.
+
+    With `config.write_dataset`, the results are written into the result dataset
+    (see `load_results`) by a `ResultWriter` thread while the next cells are
+    computed.
+    """
+    cells = [(r, p) for r in rebalance_days for p in portfolio_sizes]
+    # Shorter rebalance periods mean more rebalances, so start them first.
+    cells.sort(key=lambda cell: (cell[0], -cell[1]))
+
+    writer = None
+    if config.write_dataset:
+        writer = ResultWriter(result_dataset_dir(config.base_path, config.env))
+    try:
+        results, cells = _run_cached_cells(config, cells, daily_data, writer)
+        if cells:
+            results += _run_cells_in_pool(
+                config, cells, daily_data, max_workers, writer
+            )
+    finally:
+        if writer is not None:
+            writer.close()
+    results.sort(key=lambda r: (r.rebalance_days, r.portfolio_size))
+
+    if config.instrument:
+        timings = StageTimings()
+        for result in results:
+            if result.timings is not None:
+                timings.merge(StageTimings.from_dict(result.timings))
+        logger.info("Time per stage over the sweep:\n%s", timings.summary())
+    return results
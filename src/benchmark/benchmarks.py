@@ -0,0 +1,276 @@
+# Timings of the backtest hot path on synthetic data, saved as JSON so runs on
+# different commits can be compared.
+
+import dataclasses
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.backtest import compute_backtest_dfs, compute_rolling_start_backtests
+from src.backtest_helpers import (
+    filter_stocks_by_universe,
+    get_last_available_prices,
+    get_share_allocation,
+    get_stock_basket_price,
+    get_top_n_stocks_by_metric,
+    get_top_n_stocks_by_rank,
+    sort_df_by_metric,
+)
+from src.batch.sweep import SweepConfig, run_sweep
+from src.benchmark.synthetic_data import generate_daily_data
+from src.data_types import EvaluationMetric, StockBasketWeightApproach, StockUniverse
+from src.market_data import MarketDataStore
+from src.rank_index import RankIndex
+from src.serialization_lib import (
+    read_debug_per_ticker_df,
+    read_df_from_feather,
+    write_df_to_feather,
+)
+
+
+@dataclasses.dataclass
+class BenchmarkParams:
+    num_tickers: int = 1000
+    num_years: int = 5
+    delisting_rate: float = 0.2
+    seed: int = 0
+    repeats: int = 3
+    rebalance_days: int = 30
+    portfolio_size: int = 20
+    sweep_workers: int = 2
+
+
+@dataclasses.dataclass
+class Timing:
+    min_s: float
+    mean_s: float
+    repeats: int
+
+
+def _time(func: Callable[[], object], repeats: int) -> Timing:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return Timing(min(times), float(np.mean(times)), repeats)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _import(module: str) -> None:
+    """
+    Import `module` in a new interpreter, like a sweep worker or a short CLI
+    invocation starting up.
+    """
+    subprocess.run(
+        [sys.executable, "-c", f"import {module}"],
+        cwd=os.path.dirname(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ),
+        check=True,
+    )
+
+
+def run_benchmarks(
+    params: BenchmarkParams, only: Optional[List[str]] = None
+) -> Dict[str, Timing]:
+    """
+    Args:
+        only: Names of the benchmarks to run (all of them by default).
+
+    Returns:
+        The timing of every benchmark by name.
+    """
+    base_metric = EvaluationMetric.EV_EBIT
+    test_metric = EvaluationMetric.P_E
+    stocks_universe = StockUniverse.MID
+
+    df = generate_daily_data(
+        params.num_tickers, params.num_years, params.delisting_rate, params.seed
+    )
+    store = MarketDataStore(df)
+    base_rank_index = RankIndex.build(store, base_metric)
+    test_rank_index = RankIndex.build(store, test_metric)
+    last_available_prices = store.last_available_prices
+
+    # A date in the middle of the data and a portfolio picked on it, for the helpers.
+    date = store.dates[len(store.dates) // 2]
+    df_on_date = store.on_date(date)
+    df_sorted = sort_df_by_metric(
+        filter_stocks_by_universe(df_on_date, stocks_universe), base_metric
+    )
+    portfolio = get_top_n_stocks_by_metric(
+        df_sorted, params.portfolio_size, base_metric
+    )
+    share_allocation = get_share_allocation(
+        df_on_date, portfolio, 10000, StockBasketWeightApproach.EQUAL_WEIGHTING
+    )
+
+    def backtest(daily_values=False):
+        return compute_backtest_dfs(
+            base_metric,
+            test_metric,
+            stocks_universe,
+            StockBasketWeightApproach.EQUAL_WEIGHTING,
+            params.rebalance_days,
+            params.portfolio_size,
+            10000,
+            store,
+            base_rank_index,
+            test_rank_index,
+            save_to_disk=False,
+            daily_values=daily_values,
+        )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "daily_data.feather")
+        write_df_to_feather(df, filename)
+        mid_date = pd.Timestamp(date).to_pydatetime()
+        df_debug = backtest().df_debug
+        debug_filename = os.path.join(tmp_dir, "df_debug.feather")
+        write_df_to_feather(df_debug, debug_filename)
+
+        def sweep():
+            config = SweepConfig(
+                base_metric,
+                test_metric,
+                stocks_universe,
+                StockBasketWeightApproach.EQUAL_WEIGHTING,
+                10000,
+                base_path=tmp_dir,
+                env="benchmark",
+            )
+            results = run_sweep(
+                config,
+                [params.rebalance_days, 2 * params.rebalance_days],
+                [params.portfolio_size, 2 * params.portfolio_size],
+                store,
+                max_workers=params.sweep_workers,
+            )
+            assert all(r.succeeded for r in results)
+
+        benchmarks = {
+            "import_python": lambda: _import("sys"),
+            "import_backtest": lambda: _import("src.backtest"),
+            "import_sweep": lambda: _import("src.batch.sweep"),
+            "market_data_store_build": lambda: MarketDataStore(df),
+            "rank_index_build": lambda: RankIndex.build(store, base_metric),
+            "top_n_stocks_by_metric": lambda: get_top_n_stocks_by_metric(
+                sort_df_by_metric(
+                    filter_stocks_by_universe(df_on_date, stocks_universe),
+                    base_metric,
+                ),
+                params.portfolio_size,
+                base_metric,
+            ),
+            "top_n_stocks_by_rank": lambda: get_top_n_stocks_by_rank(
+                df_on_date,
+                base_rank_index.ranked_rows(store, date),
+                params.portfolio_size,
+                store.universe_membership.mask_on_date(date, stocks_universe),
+            ),
+            "last_available_prices": lambda: get_last_available_prices(
+                last_available_prices, portfolio
+            ),
+            "stock_basket_price": lambda: get_stock_basket_price(
+                df_on_date, last_available_prices, share_allocation
+            ),
+            "compute_backtest_dfs": backtest,
+            "compute_backtest_dfs_daily_values": lambda: backtest(daily_values=True),
+            "rolling_start_backtests": lambda: compute_rolling_start_backtests(
+                base_metric,
+                test_metric,
+                stocks_universe,
+                StockBasketWeightApproach.EQUAL_WEIGHTING,
+                [params.rebalance_days, 12 * params.rebalance_days],
+                [params.portfolio_size],
+                store,
+                start_every_days=params.rebalance_days,
+                base_rank_index=base_rank_index,
+                test_rank_index=test_rank_index,
+            ),
+            "feather_write": lambda: write_df_to_feather(df, filename),
+            "feather_read": lambda: read_df_from_feather(filename),
+            "feather_read_projected": lambda: MarketDataStore.from_feather(
+                filename, [base_metric, test_metric], start_date=mid_date
+            ),
+            "debug_feather_write": lambda: write_df_to_feather(
+                df_debug, debug_filename
+            ),
+            "debug_feather_read": lambda: read_df_from_feather(debug_filename),
+            "debug_per_ticker_read": lambda: read_debug_per_ticker_df(debug_filename),
+            "sweep": sweep,
+        }
+        if only is not None:
+            unknown = set(only) - set(benchmarks)
+            if unknown:
+                raise Exception(f"Unknown benchmarks {sorted(unknown)}")
+            benchmarks = {name: benchmarks[name] for name in only}
+
+        # The sweep is a whole grid of backtests, once is enough.
+        return {
+            name: _time(func, 1 if name == "sweep" else params.repeats)
+            for name, func in benchmarks.items()
+        }
+
+
+def save_results(
+    filename: str, params: BenchmarkParams, results: Dict[str, Timing]
+) -> None:
+    with open(filename, "w") as f:
+        json.dump(
+            {
+                "commit": _git_commit(),
+                "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                "params": dataclasses.asdict(params),
+                "results": {
+                    name: dataclasses.asdict(timing) for name, timing in results.items()
+                },
+            },
+            f,
+            indent=2,
+        )
+
+
+def compare_results(baseline_filename: str, filename: str) -> pd.DataFrame:
+    """
+    Min times of two saved runs side by side; `speedup` > 1 means `filename` is
+    faster than `baseline_filename`.
+    """
+    runs = []
+    for name in [baseline_filename, filename]:
+        with open(name) as f:
+            runs.append(json.load(f))
+    if runs[0]["params"] != runs[1]["params"]:
+        raise Exception("Benchmarks were run with different parameters.")
+    df = pd.DataFrame(
+        {
+            f'{label} ({run["commit"]})': {
+                benchmark: timing["min_s"]
+                for benchmark, timing in run["results"].items()
+            }
+            for run, label in zip(runs, ["baseline", "new"])
+        }
+    )
+    df["speedup"] = df.iloc[:, 0] / df.iloc[:, 1]
+    return df
@@ -0,0 +1,150 @@
+# Deterministic synthetic market data with the same schema as `daily_data`, so the
+# backtest can be benchmarked without the real (Sharadar) data.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.trading_calendar import TradingCalendar
+
+DAILY_DATA_COLUMNS = [
+    "date",
+    "ticker",
+    "price",
+    "marketcap",
+    "ev",
+    "evebit",
+    "pe",
+    "pb",
+]
+
+
+def generate_daily_data(
+    num_tickers: int = 500,
+    num_years: int = 5,
+    delisting_rate: float = 0.2,
+    seed: int = 0,
+    start_date: str = "2000-01-03",
+) -> pd.DataFrame:
+    """
+    Args:
+        num_tickers: Number of distinct tickers over the whole period.
+        num_years: Length of the period, in years of trading sessions.
+        delisting_rate: Fraction of the tickers that stop trading before the end
+            of the period (delisted or acquired).
+        seed: Same seed, same data.
+
+    Returns:
+        One row per (date, ticker) sorted by date, with dates as "%Y-%m-%d"
+        strings like the processed data. Market caps are spread over the small,
+        mid and large cap universes and some metrics are negative or missing,
+        like for real companies.
+    """
+    rng = np.random.default_rng(seed)
+    end_date = pd.Timestamp(start_date) + pd.DateOffset(years=num_years)
+    sessions = TradingCalendar.from_holiday_rules(start_date, end_date).sessions
+    num_sessions = len(sessions)
+
+    # A third of the tickers list after the start, `delisting_rate` stop early.
+    first = np.where(
+        rng.random(num_tickers) < 1 / 3,
+        rng.integers(0, num_sessions // 2, num_tickers),
+        0,
+    )
+    last = np.where(
+        rng.random(num_tickers) < delisting_rate,
+        first + rng.integers(1, num_sessions, num_tickers) // 2,
+        num_sessions,
+    )
+    last = np.clip(last, first + 1, num_sessions)
+    lengths = last - first
+
+    ticker_idx = np.repeat(np.arange(num_tickers), lengths)
+    session_idx = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    session_idx += first[ticker_idx]
+    num_rows = len(ticker_idx)
+
+    # Geometric random walk per ticker.
+    log_returns = rng.normal(0.0003, 0.02, num_rows)
+    log_returns[np.cumsum(lengths) - lengths] = 0
+    log_prices = np.cumsum(log_returns)
+    log_prices -= np.repeat(log_prices[np.cumsum(lengths) - lengths], lengths)
+    price = np.round(
+        rng.uniform(5, 100, num_tickers)[ticker_idx] * np.exp(log_prices), 2
+    )
+
+    # In billions: log-normal around $3B covers all the stock universes.
+    shares = (
+        rng.lognormal(np.log(3), 1.5, num_tickers) / price[np.cumsum(lengths) - lengths]
+    )
+    marketcap = shares[ticker_idx] * price
+    ev = marketcap * rng.uniform(0.6, 1.6, num_tickers)[ticker_idx]
+
+    def metric(mean: float, sd: float) -> np.ndarray:
+        # Drift slowly per ticker, with some negative and missing values.
+        base = rng.normal(mean, sd, num_tickers)[ticker_idx]
+        values = np.round(
+            base * np.exp(log_prices) + rng.normal(0, sd / 10, num_rows), 2
+        )
+        values[rng.random(num_rows) < 0.02] = np.nan
+        return values
+
+    df = pd.DataFrame(
+        {
+            "date": pd.DatetimeIndex(sessions[session_idx]).strftime("%Y-%m-%d"),
+            "ticker": np.char.add("T", np.char.zfill(ticker_idx.astype(str), 5)),
+            "price": price,
+            "marketcap": marketcap,
+            "ev": ev,
+            "evebit": metric(12, 8),
+            "pe": metric(15, 10),
+            "pb": metric(2, 1.5),
+        }
+    )
+    return df.sort_values(by=["date", "ticker"], kind="mergesort").reset_index(
+        drop=True
+    )
+
+
+def write_raw_exports(
+    df: pd.DataFrame, raw_dir: str, zipped: bool = False, suffix: str = ""
+) -> None:
+    """
+    Write `df` (see `generate_daily_data`) as the raw Sharadar exports the
+    processed data is built from (see `run_ingestion`): the daily metrics
+    ("SHARADAR_DAILY") and the equity prices ("SHARADAR_SEP").
+
+    Args:
+        zipped: Write zipped CSVs, like the bulk downloads, rather than CSVs.
+        suffix: Appended to the file names, e.g. to write an incremental export
+            next to a full one.
+    """
+    os.makedirs(raw_dir, exist_ok=True)
+    lastupdated = df["date"].max()
+    metric_columns = [
+        c for c in DAILY_DATA_COLUMNS if c not in ["date", "ticker", "price"]
+    ]
+    tables = {
+        "SHARADAR_DAILY": df[["ticker", "date"]]
+        .assign(lastupdated=lastupdated)
+        .join(df[metric_columns]),
+        "SHARADAR_SEP": df[["ticker", "date"]].assign(
+            close=df["price"], closeadj=df["price"], lastupdated=lastupdated
+        ),
+    }
+    for name, df_table in tables.items():
+        filename = os.path.join(raw_dir, f"{name}{suffix}.csv")
+        if zipped:
+            df_table.to_csv(
+                f"{filename}.zip",
+                index=False,
+                compression={
+                    "method": "zip",
+                    "archive_name": os.path.basename(filename),
+                },
+            )
+        else:
+            df_table.to_csv(filename, index=False)
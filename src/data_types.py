@@ -1,5 +1,7 @@
 import dataclasses
+import re
 from enum import Enum, auto
+from typing import Optional
 
 
 @dataclasses.dataclass
@@ -21,6 +23,64 @@ class StockRebalanceInstance:
     curr_price: float
 
 
+@dataclasses.dataclass(frozen=True)
+class MarketCapBand:
+    """
+    Stocks with a market cap (in the units of the `marketcap` column) between
+    `lower` and `upper`. Either bound can be None for an open ended band.
+    """
+
+    name: str
+    lower: Optional[float] = None
+    upper: Optional[float] = None
+    lower_inclusive: bool = True
+    upper_inclusive: bool = True
+
+    def __str__(self):
+        return self.name
+
+    def human_readable(self):
+        return self.name
+
+    def file_friendly(self):
+        # With the bounds, so bands of the same name are not saved as one
+        lower = "" if self.lower is None else self.lower
+        upper = "" if self.upper is None else self.upper
+        return (
+            f'{self.name.replace("/", "_")}'
+            f'{"[" if self.lower_inclusive else "("}{lower},{upper}'
+            f'{"]" if self.upper_inclusive else ")"}'
+        )
+
+    @classmethod
+    def from_file_friendly(cls, value: str) -> "MarketCapBand":
+        match = re.fullmatch(r"(.*)([\[(])([^,\[\]()]*),([^,\[\]()]*)([\])])", value)
+        if match is None:
+            raise Exception(f"Unsupported market cap band {value}")
+        name, left, lower, upper, right = match.groups()
+        return cls(
+            name,
+            float(lower) if lower else None,
+            float(upper) if upper else None,
+            left == "[",
+            right == "]",
+        )
+
+    def contains(self, marketcap):
+        mask = marketcap == marketcap  # Excludes NaNs
+        if self.lower is not None:
+            if self.lower_inclusive:
+                mask = mask & (marketcap >= self.lower)
+            else:
+                mask = mask & (marketcap > self.lower)
+        if self.upper is not None:
+            if self.upper_inclusive:
+                mask = mask & (marketcap <= self.upper)
+            else:
+                mask = mask & (marketcap < self.upper)
+        return mask
+
+
 class StockUniverse(Enum):
     SMALL = auto()  # < $1B
     MID = auto()  # $1B - $10B
@@ -36,10 +96,42 @@ class StockUniverse(Enum):
         else:
             raise Exception(f'Unsupported evaluation metric {self.value}')
 
+    def market_cap_band(self) -> MarketCapBand:
+        if self.value == StockUniverse.SMALL.value:
+            return MarketCapBand(str(self), upper=1, upper_inclusive=False)
+        elif self.value == StockUniverse.MID.value:
+            return MarketCapBand(str(self), lower=1, upper=10)
+        elif self.value == StockUniverse.LARGE.value:
+            return MarketCapBand(str(self), lower=10)
+        else:
+            raise Exception(f'Unsupported stock universe {self.value}')
+
+
+class ResultDetail(Enum):
+    NONE = auto()  # Only the portfolio values (`BackTestResult.df`)
+    SUMMARY = auto()  # Plus the portfolio values and closed tickers per rebalance
+    FULL = auto()  # Plus the per ticker prices per rebalance
+
 
 class StockBasketWeightApproach(Enum):
     EQUAL_WEIGHTING = auto()
-    MARKET_CAP_ADJUSTED = auto()  # Not supported yet
+    MARKET_CAP_ADJUSTED = auto()  # Proportional to the market cap
+    INVERSE_METRIC_RANK = auto()  # Proportional to 1 / rank by the metric
+    INVERSE_VOLATILITY = auto()  # Proportional to 1 / volatility of the daily returns
+
+
+@dataclasses.dataclass(frozen=True)
+class CappedWeighting:
+    """
+    The weights of `approach` with no stock weighing more than `max_weight`; the
+    excess is spread over the other stocks in proportion to their weights.
+    """
+
+    approach: StockBasketWeightApproach
+    max_weight: float
+
+    def __str__(self):
+        return f'{self.approach.name} (max {self.max_weight:.0%})'
 
 
 class EvaluationMetric(Enum):
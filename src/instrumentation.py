@@ -0,0 +1,90 @@
+import contextlib
+import dataclasses
+import json
+import time
+from typing import Dict, Iterator, Optional
+
+
+@dataclasses.dataclass
+class StageStats:
+    calls: int = 0
+    wall_time_s: float = 0.0
+    # Rows of the market data scanned (e.g. the rows of the dates looked up)
+    rows: int = 0
+
+
+class StageTimings:
+    """
+    Wall time, call count and rows scanned per stage of a backtest, recorded by
+    wrapping each stage in `with timings.stage(name, rows):`. Pass one to
+    `compute_backtest_dfs` (or set `SweepConfig.instrument`) to opt in; the
+    default `NO_TIMINGS` records nothing and costs a no-op context manager.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.stages: Dict[str, StageStats] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows: int = 0) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = StageStats()
+            stats.calls += 1
+            stats.wall_time_s += time.perf_counter() - start
+            stats.rows += rows
+
+    def merge(self, other: "StageTimings") -> None:
+        for name, other_stats in other.stages.items():
+            stats = self.stages.setdefault(name, StageStats())
+            stats.calls += other_stats.calls
+            stats.wall_time_s += other_stats.wall_time_s
+            stats.rows += other_stats.rows
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        return {name: dataclasses.asdict(stats) for name, stats in self.stages.items()}
+
+    @classmethod
+    def from_dict(cls, stages: Dict[str, Dict[str, float]]) -> "StageTimings":
+        timings = cls()
+        timings.stages = {name: StageStats(**stats) for name, stats in stages.items()}
+        return timings
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=1)
+
+    def summary(self) -> str:
+        """
+        One line per stage, slowest first.
+        """
+        lines = []
+        for name, stats in sorted(
+            self.stages.items(), key=lambda item: -item[1].wall_time_s
+        ):
+            lines.append(
+                f"{name:<24} {stats.wall_time_s:9.4f}s {stats.calls:8d} calls"
+                f" {stats.rows:12d} rows"
+            )
+        return "\n".join(lines)
+
+
+class _NoTimings(StageTimings):
+    enabled = False
+
+    def stage(self, name: str, rows: int = 0):
+        return _NO_STAGE
+
+
+_NO_STAGE = contextlib.nullcontext()
+
+# Shared by all the uninstrumented backtests
+NO_TIMINGS: StageTimings = _NoTimings()
+
+
+def as_timings(timings: Optional[StageTimings]) -> StageTimings:
+    return NO_TIMINGS if timings is None else timings
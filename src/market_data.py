@@ -0,0 +1,444 @@
+import datetime
+import hashlib
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from src.data_types import EvaluationMetric, MarketCapBand, StockUniverse
+from src.serialization_lib import (
+    read_df_from_feather,
+    read_feather_metadata,
+    write_df_to_feather,
+)
+from src.weighting import trailing_volatility
+
+# Columns every backtest needs, on top of the columns of the metrics it ranks by.
+MARKET_DATA_COLUMNS = ["date", "ticker", "price", "marketcap", "ev"]
+
+DateLike = Union[str, datetime.date, datetime.datetime, np.datetime64, pd.Timestamp]
+
+
+def to_datetime64(date: DateLike) -> np.datetime64:
+    return pd.Timestamp(date).to_datetime64()
+
+
+def _date_key(date: DateLike) -> int:
+    return int(to_datetime64(date).astype("datetime64[ns]").view(np.int64))
+
+
+def _column_hash(column: pd.Series) -> str:
+    """
+    SHA-256 of the raw bytes of a column, which is an order of magnitude faster
+    than hashing it value by value (`pd.util.hash_pandas_object`).
+    """
+    digest = hashlib.sha256(str(column.dtype).encode())
+    if not (
+        pd.api.types.is_string_dtype(column) or pd.api.types.is_object_dtype(column)
+    ):
+        digest.update(np.ascontiguousarray(column.values).view(np.uint8))
+        return digest.hexdigest()
+
+    # Strings: hash the Arrow offsets and character data of the (sliced) array
+    array = pa.chunked_array([pa.array(column, type=pa.large_string())])
+    array = array.combine_chunks()
+    validity, offsets, data = array.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[
+        array.offset : array.offset + len(array) + 1
+    ]
+    digest.update((offsets - offsets[0]).view(np.uint8))
+    if data is not None:
+        digest.update(memoryview(data)[offsets[0] : offsets[-1]])
+    if array.null_count:
+        digest.update(np.asarray(array.is_null()).view(np.uint8))
+    return digest.hexdigest()
+
+
+class LastAvailablePrices:
+    """
+    The last trade date and last price of every ticker, computed once from the
+    full data set so the price of a closed (delisted or acquired) ticker is a
+    constant-time lookup instead of a scan over the whole frame.
+    """
+
+    # The columns of the market data the table is built from
+    COLUMNS = ["ticker", "date", "price"]
+
+    def __init__(self, df: pd.DataFrame, data_fingerprint: Optional[str] = None):
+        # Accepts either the full, date sorted market data or a previously saved table
+        if "last_date" not in df:
+            assert df["date"].is_monotonic_increasing
+            df = df.drop_duplicates(subset="ticker", keep="last")
+            df = df[["ticker", "date", "price"]].rename(columns={"date": "last_date"})
+        self.df = df.set_index("ticker")[["last_date", "price"]]
+        # `MarketDataStore.fingerprint` of the `COLUMNS` the table was built
+        # from, to detect stale tables
+        self.data_fingerprint = data_fingerprint
+
+    @staticmethod
+    def filename(
+        base_path: str, daily_data: "MarketDataStore", env: str = "prod"
+    ) -> str:
+        """
+        Keyed by the date range of `daily_data`, so the table of a store read
+        for a window does not replace the one of the full data.
+        """
+        start_date = daily_data.start_date.strftime("%Y%m%d")
+        end_date = daily_data.end_date.strftime("%Y%m%d")
+        return os.path.join(
+            base_path, f"last_available_prices_{start_date}_{end_date}_{env}.feather"
+        )
+
+    def save(self, filename: str) -> None:
+        metadata = {}
+        if self.data_fingerprint is not None:
+            metadata["data_fingerprint"] = self.data_fingerprint
+        write_df_to_feather(self.df, filename, metadata)
+
+    @classmethod
+    def load(cls, filename: str) -> "LastAvailablePrices":
+        return cls(
+            read_df_from_feather(filename),
+            read_feather_metadata(filename).get("data_fingerprint"),
+        )
+
+    @classmethod
+    def load_or_build(
+        cls, daily_data: "MarketDataStore", base_path: str, env: str = "prod"
+    ) -> "LastAvailablePrices":
+        """
+        Load the table saved next to the processed data, rebuilding (and saving)
+        it if it is missing or was built from different prices (e.g. revised).
+        """
+        filename = LastAvailablePrices.filename(base_path, daily_data, env)
+        data_fingerprint = daily_data.fingerprint(LastAvailablePrices.COLUMNS)
+        if os.path.exists(filename):
+            last_available_prices = cls.load(filename)
+            if last_available_prices.data_fingerprint == data_fingerprint:
+                return last_available_prices
+        last_available_prices = cls(daily_data.df, data_fingerprint)
+        last_available_prices.save(filename)
+        return last_available_prices
+
+    def fingerprint(self) -> str:
+        """
+        The `data_fingerprint`, or a hash of the table itself for a table built
+        without one (e.g. from a frame of unknown origin).
+        """
+        if self.data_fingerprint is not None:
+            return self.data_fingerprint
+        columns = [self.df.index.to_series(), self.df["last_date"], self.df["price"]]
+        return hashlib.sha256(
+            ",".join(_column_hash(c) for c in columns).encode()
+        ).hexdigest()
+
+    def get_prices(self, tickers: List[str]) -> np.ndarray:
+        positions = self.df.index.get_indexer(tickers)
+        assert (positions != -1).all(), "Tickers never traded in the data."
+        return self.df["price"].values[positions]
+
+    def get_price(self, ticker: str) -> float:
+        return self.df["price"].values[self.df.index.get_loc(ticker)]
+
+
+class UniverseMembership:
+    """
+    Universe membership of every row of a `MarketDataStore`, computed once as a
+    bitmap: bit i of `bits[row]` is set if the row's market cap is in
+    `bands[i]`. Filtering a date by universe is then a mask AND rather than
+    market cap comparisons on every date slice.
+
+    Starts with the `StockUniverse` bands; user defined `MarketCapBand`s get a
+    bit the first time they are asked for.
+    """
+
+    def __init__(self, store: "MarketDataStore"):
+        self.store = store
+        self.bands: List[MarketCapBand] = []
+        self.bits = np.zeros(len(store), dtype=np.uint8)
+        for stocks_universe in StockUniverse:
+            self.add_band(stocks_universe.market_cap_band())
+
+    def add_band(self, band: MarketCapBand) -> int:
+        if band in self.bands:
+            return self.bands.index(band)
+        bit = len(self.bands)
+        if bit >= 8 * self.bits.itemsize:
+            if self.bits.itemsize == 8:
+                raise Exception("Too many market cap bands.")
+            self.bits = self.bits.astype(f"uint{16 * self.bits.itemsize}")
+        in_band = np.asarray(band.contains(self.store.df["marketcap"].values))
+        self.bits |= in_band.astype(self.bits.dtype) << bit
+        self.bands.append(band)
+        return bit
+
+    def mask_on_date(
+        self, date: DateLike, stocks_universe: Union[StockUniverse, MarketCapBand]
+    ) -> np.ndarray:
+        """
+        Which rows of `store.on_date(date)` are in `stocks_universe`.
+        """
+        if isinstance(stocks_universe, StockUniverse):
+            stocks_universe = stocks_universe.market_cap_band()
+        bit = self.add_band(stocks_universe)
+        bits = self.bits[self.store.row_range(date)]
+        return (bits & (1 << bit)) != 0
+
+
+class MarketDataStore:
+    """
+    Market data (e.g. `daily_data`) partitioned by date.
+
+    Built once: rows are stably sorted by a real datetime64 `date` column so that
+    every date occupies a contiguous row range, and a date -> row range offset
+    table is precomputed. Getting the rows for a date is then a dict lookup
+    followed by a positional slice (a view), instead of a string comparison over
+    the whole frame.
+
+    The sort is stable, so a frame that was pre-sorted by a metric (see
+    `sort_df_by_metric`) keeps that order within each date.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        if not pd.api.types.is_datetime64_dtype(df["date"]):
+            df = df.assign(date=pd.to_datetime(df["date"], format="%Y-%m-%d"))
+        if not df["date"].is_monotonic_increasing:
+            df = df.sort_values(by="date", kind="mergesort")
+        if df.index.equals(pd.RangeIndex(len(df))):
+            # Share the columns (e.g. memory mapped ones) rather than copy them
+            self.df = df.copy(deep=False)
+        else:
+            self.df = df.reset_index(drop=True)
+
+        row_dates = self.df["date"].values.astype("datetime64[ns]")
+        is_new_date = np.empty(len(row_dates), dtype=bool)
+        is_new_date[:1] = True
+        is_new_date[1:] = row_dates[1:] != row_dates[:-1]
+
+        # `offsets[i]:offsets[i + 1]` is the row range of `dates[i]`
+        starts = np.flatnonzero(is_new_date)
+        self.dates = row_dates[starts]
+        self.offsets = np.append(starts, len(row_dates)).astype(np.int64)
+        self._date_to_position = {
+            d: i for i, d in enumerate(self.dates.view(np.int64).tolist())
+        }
+        self._last_available_prices = None
+        self._universe_membership = None
+        self._ticker_codes = None
+        self._last_prices_by_code = None
+        self._volatility = None
+        # Content hash of each column (or column prefix), computed on first use
+        # by `fingerprint`
+        self.column_hashes: Dict[str, str] = {}
+
+    @classmethod
+    def from_feather(
+        cls,
+        filename: str,
+        metrics: List[EvaluationMetric],
+        start_date: Optional[datetime.datetime] = None,
+        end_date: Optional[datetime.datetime] = None,
+        memory_map: bool = True,
+    ) -> "MarketDataStore":
+        """
+        Load only the columns needed to backtest `metrics` (and optionally only
+        the rows in a date range) rather than the whole processed data set.
+        """
+        columns = MARKET_DATA_COLUMNS + [m.sorted_column() for m in metrics]
+        return cls(
+            read_df_from_feather(
+                filename,
+                columns=list(dict.fromkeys(columns)),
+                memory_map=memory_map,
+                start_date=start_date,
+                end_date=end_date,
+            )
+        )
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    @property
+    def start_date(self) -> datetime.datetime:
+        return pd.Timestamp(self.dates[0]).to_pydatetime()
+
+    @property
+    def end_date(self) -> datetime.datetime:
+        return pd.Timestamp(self.dates[-1]).to_pydatetime()
+
+    @property
+    def last_available_prices(self) -> LastAvailablePrices:
+        """
+        Built on first use unless set beforehand (e.g. loaded from disk).
+        """
+        if self._last_available_prices is None:
+            self._last_available_prices = LastAvailablePrices(
+                self.df, self.fingerprint(LastAvailablePrices.COLUMNS)
+            )
+        return self._last_available_prices
+
+    @last_available_prices.setter
+    def last_available_prices(self, last_available_prices: LastAvailablePrices):
+        self._last_available_prices = last_available_prices
+        self._last_prices_by_code = None
+
+    def last_available_prices_fingerprint(self) -> str:
+        """
+        `LastAvailablePrices.fingerprint` of `last_available_prices`, without
+        building it.
+        """
+        if self._last_available_prices is None:
+            return self.fingerprint(LastAvailablePrices.COLUMNS)
+        return self._last_available_prices.fingerprint()
+
+    @property
+    def universe_membership(self) -> UniverseMembership:
+        """
+        Built on first use.
+        """
+        if self._universe_membership is None:
+            self._universe_membership = UniverseMembership(self)
+        return self._universe_membership
+
+    def _factorize_tickers(self) -> None:
+        codes, tickers = pd.factorize(self.df["ticker"])
+        self._ticker_codes = codes.astype(np.int32)
+        self._tickers = np.asarray(tickers, dtype=object)
+        # Scratch table for `ticker_positions`, kept all -1 between calls
+        self._code_to_position = np.full(len(tickers), -1, dtype=np.int64)
+
+    @property
+    def ticker_codes(self) -> np.ndarray:
+        """
+        The ticker of every row as an int32 code into `tickers`, built on first
+        use, so holdings can be arrays of codes rather than lists of strings.
+        """
+        if self._ticker_codes is None:
+            self._factorize_tickers()
+        return self._ticker_codes
+
+    @property
+    def tickers(self) -> np.ndarray:
+        """
+        Every ticker in the data, indexed by ticker code.
+        """
+        if self._ticker_codes is None:
+            self._factorize_tickers()
+        return self._tickers
+
+    def codes_of(self, tickers: List[str]) -> np.ndarray:
+        codes = pd.Index(self.tickers).get_indexer(tickers)
+        assert (codes != -1).all(), "Tickers never traded in the data."
+        return codes.astype(np.int32)
+
+    def ticker_positions(self, date: DateLike, codes: np.ndarray) -> np.ndarray:
+        """
+        Positions within `on_date(date)` of the tickers `codes`, -1 for the
+        tickers not traded on `date`. Linear in the number of rows on `date`
+        (no per call index or hashing of the tickers).
+        """
+        date_codes = self.ticker_codes[self.row_range(date)]
+        self._code_to_position[date_codes] = np.arange(len(date_codes))
+        positions = self._code_to_position[codes]
+        self._code_to_position[date_codes] = -1
+        return positions
+
+    @property
+    def last_prices_by_code(self) -> np.ndarray:
+        """
+        `last_available_prices` indexed by ticker code.
+        """
+        if self._last_prices_by_code is None:
+            self._last_prices_by_code = self.last_available_prices.get_prices(
+                self.tickers
+            )
+        return self._last_prices_by_code
+
+    @property
+    def volatility(self) -> np.ndarray:
+        """
+        The `trailing_volatility` of every row, built on first use.
+        """
+        if self._volatility is None:
+            self._volatility = trailing_volatility(
+                self.ticker_codes, self.df["price"].values
+            )
+        return self._volatility
+
+    def prices_on_date(
+        self, date: DateLike, codes: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The prices of the tickers `codes` on `date` (see `get_ticker_prices`),
+        falling back to their last available price for the tickers not traded on
+        `date` (acquired or closed).
+
+        Returns:
+            The prices and a boolean mask of the tickers not traded on `date`.
+        """
+        positions = self.ticker_positions(date, codes)
+        missing = positions == -1
+        prices = self.df["price"].values[self.row_range(date)][positions]
+        prices[missing] = self.last_prices_by_code[codes[missing]]
+        return prices, missing
+
+    def fingerprint(
+        self, columns: List[str], end_date: Optional[DateLike] = None
+    ) -> str:
+        """
+        Hash of the content of `columns`, so results computed from them can be
+        told apart from results computed from different data. Only the columns a
+        computation reads are hashed, so e.g. loading an extra metric column does
+        not change the fingerprint.
+
+        Args:
+            end_date: Only hash the rows on or before this date (which must be in
+                the data), e.g. to check that appended data left the past as is.
+        """
+        num_rows = len(self)
+        if end_date is not None:
+            position = self.date_position(end_date)
+            if position is None:
+                raise Exception(f"No data on {end_date}")
+            num_rows = int(self.offsets[position + 1])
+
+        hash_keys = []
+        for column in columns:
+            hash_key = column if num_rows == len(self) else f"{column}[:{num_rows}]"
+            if hash_key not in self.column_hashes:
+                self.column_hashes[hash_key] = _column_hash(
+                    self.df[column].iloc[:num_rows]
+                )
+            hash_keys.append(hash_key)
+        return hashlib.sha256(
+            ",".join(
+                f"{column}:{self.column_hashes[hash_key]}"
+                for column, hash_key in zip(columns, hash_keys)
+            ).encode()
+        ).hexdigest()
+
+    def has_date(self, date: DateLike) -> bool:
+        return _date_key(date) in self._date_to_position
+
+    def date_position(self, date: DateLike) -> Optional[int]:
+        """
+        Index of `date` in `self.dates`, or None if the date is not in the data.
+        """
+        return self._date_to_position.get(_date_key(date))
+
+    def row_range(self, date: DateLike) -> slice:
+        """
+        Row range of `date` in `self.df`. Empty if the date is not in the data.
+        """
+        position = self.date_position(date)
+        if position is None:
+            return slice(0, 0)
+        return slice(int(self.offsets[position]), int(self.offsets[position + 1]))
+
+    def on_date(self, date: DateLike) -> pd.DataFrame:
+        """
+        All rows for `date` as a view of `self.df`; empty if the date is missing.
+        """
+        return self.df.iloc[self.row_range(date)]
@@ -0,0 +1,186 @@
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.backtest import DAYS_PER_YEAR, BackTestResult
+
+PERFORMANCE_STATS = [
+    "cagr",
+    "annual_volatility",
+    "sharpe",
+    "max_drawdown",
+    "turnover",
+    "hit_rate",
+]
+
+
+def _forward_fill(values: np.ndarray) -> np.ndarray:
+    """
+    Forward fill the NaNs of every row of `values`, leaving the leading NaNs.
+    """
+    last_valid = np.where(np.isnan(values), 0, np.arange(values.shape[1]))
+    np.maximum.accumulate(last_valid, axis=1, out=last_valid)
+    return np.take_along_axis(values, last_valid, axis=1)
+
+
+def performance_stats(
+    dates: np.ndarray,
+    values: np.ndarray,
+    turnover: Optional[np.ndarray] = None,
+    risk_free_rate: float = 0.0,
+) -> pd.DataFrame:
+    """
+    Performance statistics of many strategies at once, from the matrix of their
+    values (one row per strategy, one column per date, NaN where a strategy has
+    no value, e.g. between its rebalance dates).
+
+    Returns are taken between consecutive values of a strategy and annualized by
+    the number of returns per year of the strategy, so rebalance values and daily
+    values (see `BackTestResult.df_daily`) can be compared.
+
+    Args:
+        dates: Sorted, one per column of `values`.
+        turnover: Aligned with `values`, the fraction of the portfolio traded on
+            each date (see `Portfolio.turnover`), NaN when not rebalancing.
+        risk_free_rate: Annual, subtracted from the annual return for `sharpe`.
+
+    Returns:
+        One row per strategy with the `PERFORMANCE_STATS` columns. Drawdown,
+        volatility and turnover are fractions, `turnover` per year.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    num_strategies, num_dates = values.shape
+    strategies = np.arange(num_strategies)
+    is_valid = ~np.isnan(values)
+
+    # First and last value of every strategy, and the years between them
+    first = np.argmax(is_valid, axis=1)
+    last = num_dates - 1 - np.argmax(is_valid[:, ::-1], axis=1)
+    days = np.asarray(dates, dtype="datetime64[D]").astype(np.float64)
+    years = (days[last] - days[first]) / DAYS_PER_YEAR
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cagr = (values[strategies, last] / values[strategies, first]) ** (1 / years) - 1
+
+        # Returns between consecutive values of each strategy
+        filled = _forward_fill(values)
+        returns = np.full(values.shape, np.nan)
+        returns[:, 1:] = filled[:, 1:] / filled[:, :-1] - 1
+        returns[~is_valid] = np.nan
+        returns[strategies, first] = np.nan
+        num_returns = np.sum(~np.isnan(returns), axis=1)
+        returns_per_year = num_returns / years
+
+        annual_volatility = np.nanstd(returns, axis=1, ddof=1) * np.sqrt(
+            returns_per_year
+        )
+        annual_return = np.nanmean(returns, axis=1) * returns_per_year
+        sharpe = (annual_return - risk_free_rate) / annual_volatility
+        hit_rate = np.sum(returns > 0, axis=1) / num_returns
+
+        # The leading NaNs are before the strategy starts, not a drawdown
+        filled = np.where(np.isnan(filled), values[strategies, first][:, None], filled)
+        max_drawdown = 1 - np.min(
+            filled / np.maximum.accumulate(filled, axis=1), axis=1
+        )
+
+        if turnover is None:
+            annual_turnover = np.full(num_strategies, np.nan)
+        else:
+            annual_turnover = np.nansum(turnover, axis=1) / years
+
+    return pd.DataFrame(
+        {
+            "cagr": cagr,
+            "annual_volatility": annual_volatility,
+            "sharpe": sharpe,
+            "max_drawdown": max_drawdown,
+            "turnover": annual_turnover,
+            "hit_rate": hit_rate,
+        },
+        columns=PERFORMANCE_STATS,
+    )
+
+
+def stack_results(
+    results: List[BackTestResult], daily_values: bool = True
+) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stack the base and test portfolio values of `results` into one matrix over
+    the union of their dates.
+
+    Args:
+        daily_values: Use the daily values of the results that have them (see
+            `BackTestResult.df_daily`) rather than their rebalance values.
+
+    Returns:
+        A frame describing each row of the matrix (the backtest parameters, the
+        metric and whether it is the "base" or "test" portfolio), the dates, the
+        values and the turnover matrix (see `performance_stats`).
+    """
+    strategies = []
+    # (dates, values) of every strategy, and of its turnover
+    value_series = []
+    turnover_series = []
+    for result in results:
+        df_values = result.df
+        if daily_values and result.df_daily is not None:
+            df_values = result.df_daily.rename(
+                columns={"base_value": "base_price", "test_value": "test_price"}
+            )
+        for portfolio, metric in [
+            ("base", result.base_metric),
+            ("test", result.test_metric),
+        ]:
+            strategies.append(
+                {
+                    "metric": str(metric),
+                    "portfolio": portfolio,
+                    "rebalance_days": result.rebalance_days,
+                    "portfolio_size": result.portfolio_size,
+                    "stocks_universe": str(result.stocks_universe),
+                }
+            )
+            value_series.append(
+                (df_values.index.values, df_values[f"{portfolio}_price"].values)
+            )
+            turnover_column = f"{portfolio}_turnover"
+            if turnover_column in result.df:
+                turnover_series.append(
+                    (result.df.index.values, result.df[turnover_column].values)
+                )
+            else:
+                turnover_series.append((result.df.index.values[:0], []))
+
+    dates = np.unique(
+        np.concatenate(
+            [d.astype("datetime64[ns]") for d, _ in value_series + turnover_series]
+        )
+    )
+    values = np.full((len(strategies), len(dates)), np.nan)
+    turnover = np.full((len(strategies), len(dates)), np.nan)
+    for i in range(len(strategies)):
+        for matrix, (series_dates, series_values) in [
+            (values, value_series[i]),
+            (turnover, turnover_series[i]),
+        ]:
+            matrix[i, np.searchsorted(dates, series_dates)] = series_values
+    return pd.DataFrame(strategies), dates, values, turnover
+
+
+def compare_performance(
+    results: Iterable[BackTestResult],
+    daily_values: bool = True,
+    risk_free_rate: float = 0.0,
+) -> pd.DataFrame:
+    """
+    `performance_stats` of the base and test portfolios of every backtest (e.g.
+    all the cells of a sweep), computed in one pass over their stacked values.
+
+    Returns:
+        One row per portfolio: its parameters followed by its statistics.
+    """
+    df_strategies, dates, values, turnover = stack_results(list(results), daily_values)
+    df_stats = performance_stats(dates, values, turnover, risk_free_rate)
+    return pd.concat([df_strategies, df_stats], axis=1)
@@ -0,0 +1,193 @@
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from src.data_types import ShareAllocation, StockRebalanceInstance
+from src.market_data import DateLike, MarketDataStore
+
+
+class Portfolio:
+    """
+    Holdings as parallel NumPy arrays: ticker codes (see
+    `MarketDataStore.ticker_codes`), number of shares and the price each
+    holding was bought at. Valuing and rebalancing a portfolio is array math on
+    these rather than loops over `ShareAllocation`s, which it converts to and
+    from for compatibility.
+    """
+
+    def __init__(
+        self,
+        tickers: np.ndarray,
+        codes: np.ndarray,
+        num_shares: np.ndarray,
+        entry_prices: np.ndarray,
+    ):
+        # Every ticker by code, shared with the store (not copied)
+        self.tickers = tickers
+        self.codes = codes
+        self.num_shares = num_shares
+        self.entry_prices = entry_prices
+
+    @classmethod
+    def buy(
+        cls,
+        tickers: np.ndarray,
+        codes: np.ndarray,
+        prices: np.ndarray,
+        investment_amount: float,
+        weights: Optional[np.ndarray] = None,
+    ) -> "Portfolio":
+        """
+        Invest `investment_amount` in the tickers `codes` at `prices`, split by
+        `weights` (equally by default, like `get_share_allocation`).
+        """
+        if len(codes) == 0:
+            raise Exception("No stocks to buy.")
+        if weights is None:
+            num_shares = (investment_amount / len(codes)) / prices
+        else:
+            num_shares = investment_amount * weights / prices
+        return cls(tickers, codes, num_shares, prices)
+
+    @classmethod
+    def from_share_allocation(
+        cls,
+        store: MarketDataStore,
+        share_allocation: List[ShareAllocation],
+        date: DateLike,
+    ) -> "Portfolio":
+        """
+        The portfolio of `share_allocation`, bought on `date`.
+        """
+        codes = store.codes_of([alloc.ticker for alloc in share_allocation])
+        prices, _ = store.prices_on_date(date, codes)
+        num_shares = np.array([alloc.num_shares for alloc in share_allocation])
+        return cls(store.tickers, codes, num_shares, prices)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def ticker_list(self) -> List[str]:
+        return list(self.tickers[self.codes])
+
+    def to_share_allocation(self) -> List[ShareAllocation]:
+        return [
+            ShareAllocation(t, n)
+            for t, n in zip(self.ticker_list(), self.num_shares.tolist())
+        ]
+
+    def to_stock_rebalance_instances(
+        self, prev_prices: np.ndarray, prices: np.ndarray
+    ) -> List[StockRebalanceInstance]:
+        """
+        The previous and current price of every holding, sorted by ticker like
+        `get_per_stock_change`.
+        """
+        tickers = self.tickers[self.codes]
+        order = np.argsort(tickers, kind="stable")
+        return [
+            StockRebalanceInstance(t, p, c)
+            for t, p, c in zip(
+                tickers[order].tolist(),
+                prev_prices[order].tolist(),
+                prices[order].tolist(),
+            )
+        ]
+
+    def value(self, prices: np.ndarray) -> float:
+        """
+        The value at `prices` (aligned with the holdings), rounded to cents like
+        `get_stock_basket_price`.
+        """
+        return round(float(np.sum(prices * self.num_shares)), 2)
+
+    def mark_to_market(
+        self, store: MarketDataStore, date: DateLike
+    ) -> Tuple[float, Set[str], np.ndarray]:
+        """
+        Value the holdings at their prices on `date`, or their last available
+        price for the tickers that closed.
+
+        Returns:
+            The value, the closed tickers and the price of every holding.
+        """
+        prices, missing = store.prices_on_date(date, self.codes)
+        closed = set(self.tickers[self.codes[missing]])
+        return self.value(prices), closed, prices
+
+    def daily_values(
+        self,
+        store: MarketDataStore,
+        start_date: DateLike,
+        end_date: Optional[DateLike] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Value the holdings on every date of `store` from `start_date` up to (but
+        excluding) `end_date`, or through the last date if None: a (date x
+        holding) price matrix, pivoted from the rows of those dates, times the
+        number of shares. Prices of holdings that stop trading are carried
+        forward from their last trade.
+
+        Returns:
+            The dates and the values on them.
+        """
+        start = store.date_position(start_date)
+        end = len(store.dates) if end_date is None else store.date_position(end_date)
+        rows = slice(store.offsets[start], store.offsets[end])
+
+        # Holding of every row of the period, -1 for the stocks not held
+        holding_of_code = np.full(len(self.tickers), -1, dtype=np.int64)
+        holding_of_code[self.codes] = np.arange(len(self.codes))
+        holdings = holding_of_code[store.ticker_codes[rows]]
+        held_rows = np.flatnonzero(holdings != -1)
+        date_positions = (
+            np.searchsorted(store.offsets, rows.start + held_rows, side="right")
+            - 1
+            - start
+        )
+
+        prices = np.full((end - start, len(self.codes)), np.nan)
+        prices[date_positions, holdings[held_rows]] = store.df["price"].values[rows][
+            held_rows
+        ]
+        # Forward fill along the dates, from the entry prices
+        prices[0] = np.where(np.isnan(prices[0]), self.entry_prices, prices[0])
+        last_traded = np.where(
+            np.isnan(prices), 0, np.arange(len(prices))[:, np.newaxis]
+        )
+        np.maximum.accumulate(last_traded, axis=0, out=last_traded)
+        prices = prices[last_traded, np.arange(len(self.codes))]
+
+        return store.dates[start:end], np.round(prices @ self.num_shares, 2)
+
+    def rebalance(
+        self,
+        codes: np.ndarray,
+        prices: np.ndarray,
+        investment_amount: float,
+        weights: Optional[np.ndarray] = None,
+    ) -> "Portfolio":
+        """
+        The portfolio after selling everything and buying `codes` at `prices`.
+        """
+        return Portfolio.buy(self.tickers, codes, prices, investment_amount, weights)
+
+    def turnover(self, new_portfolio: "Portfolio", prices: np.ndarray) -> float:
+        """
+        Fraction of the portfolio traded to rebalance into `new_portfolio`: half
+        the sum of the absolute weight changes, with the holdings valued at
+        `prices` and the new ones at their entry prices.
+        """
+        codes = np.concatenate([self.codes, new_portfolio.codes])
+        values = np.concatenate(
+            [
+                -prices * self.num_shares / np.sum(prices * self.num_shares),
+                new_portfolio.entry_prices
+                * new_portfolio.num_shares
+                / np.sum(new_portfolio.entry_prices * new_portfolio.num_shares),
+            ]
+        )
+        unique_codes, inverse = np.unique(codes, return_inverse=True)
+        weight_changes = np.zeros(len(unique_codes))
+        np.add.at(weight_changes, inverse, values)
+        return float(np.sum(np.abs(weight_changes)) / 2)
@@ -0,0 +1,174 @@
+import os
+import tempfile
+from typing import List, Optional
+
+import numpy as np
+
+from src.backtest_helpers import get_metric_mask, get_metric_mask_columns
+from src.data_types import EvaluationMetric
+from src.market_data import DateLike, MarketDataStore
+
+
+class RankIndex:
+    """
+    For every date of a `MarketDataStore`, the rows eligible for `metric` (see
+    `get_metric_mask`) ordered by the metric, as int32 positions within that
+    date's slice. Ties are broken by the order of the rows in the store.
+
+    This replaces keeping a full copy of the data sorted by each metric: it is
+    built once (one vectorized sort), persisted next to the processed data, and
+    selecting the top N stocks on a date becomes a slice of a precomputed array.
+
+    An index is only valid for a store with the same dates and rows per date,
+    and the same content of the columns it was built from (see `columns`).
+    """
+
+    def __init__(
+        self,
+        metric: EvaluationMetric,
+        store_dates: np.ndarray,
+        store_offsets: np.ndarray,
+        offsets: np.ndarray,
+        positions: np.ndarray,
+        data_fingerprint: Optional[str] = None,
+    ):
+        self.metric = metric
+        # The layout and the `MarketDataStore.fingerprint` of the `columns` of the
+        # store the index was built from, to detect stale indexes.
+        self.store_dates = store_dates
+        self.store_offsets = store_offsets
+        self.data_fingerprint = data_fingerprint
+        # `positions[offsets[i]:offsets[i + 1]]` are the ranked rows of date i
+        self.offsets = offsets
+        self.positions = positions
+
+    @staticmethod
+    def columns(metric: EvaluationMetric) -> List[str]:
+        """
+        The columns of the store the index of `metric` is built from: the rows
+        (tickers) it points to, the metric and the columns of its mask.
+        """
+        return list(
+            dict.fromkeys(
+                ["ticker", metric.sorted_column()] + get_metric_mask_columns(metric)
+            )
+        )
+
+    @classmethod
+    def build(cls, store: MarketDataStore, metric: EvaluationMetric) -> "RankIndex":
+        eligible = np.flatnonzero(get_metric_mask(store.df, metric).values)
+        row_date_positions = np.repeat(
+            np.arange(len(store.dates)), np.diff(store.offsets)
+        )[eligible]
+        metric_values = store.df[metric.sorted_column()].values[eligible]
+
+        # Sort by date, then by metric. lexsort is stable.
+        order = np.lexsort((metric_values, row_date_positions))
+        rows = eligible[order]
+        row_date_positions = row_date_positions[order]
+
+        positions = (rows - store.offsets[row_date_positions]).astype(np.int32)
+        offsets = np.searchsorted(
+            row_date_positions, np.arange(len(store.dates) + 1)
+        ).astype(np.int64)
+        return cls(
+            metric,
+            store.dates,
+            store.offsets,
+            offsets,
+            positions,
+            store.fingerprint(RankIndex.columns(metric)),
+        )
+
+    def is_valid_for(self, store: MarketDataStore) -> bool:
+        return (
+            np.array_equal(self.store_dates, store.dates)
+            and np.array_equal(self.store_offsets, store.offsets)
+            and self.data_fingerprint
+            == store.fingerprint(RankIndex.columns(self.metric))
+        )
+
+    def ranked_rows(self, store: MarketDataStore, date: DateLike) -> np.ndarray:
+        """
+        Positions within `store.on_date(date)` of the eligible stocks, best first.
+        """
+        position = store.date_position(date)
+        if position is None:
+            return self.positions[:0]
+        return self.positions[self.offsets[position] : self.offsets[position + 1]]
+
+    @staticmethod
+    def filename(
+        base_path: str,
+        metric: EvaluationMetric,
+        store: MarketDataStore,
+        env: str = "prod",
+    ) -> str:
+        """
+        Keyed by the date range of `store`, so the index of a store read for a
+        window does not replace the one of the full data.
+        """
+        start_date = store.start_date.strftime("%Y%m%d")
+        end_date = store.end_date.strftime("%Y%m%d")
+        return os.path.join(
+            base_path,
+            f"rank_index_{metric.file_friendly()}_{start_date}_{end_date}_{env}.npz",
+        )
+
+    def save(self, filename: str) -> None:
+        # Written under a temporary name and then renamed, so a sweep loading
+        # the index never reads a partly written file.
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(filename),
+            prefix=f".{os.path.basename(filename)}.",
+            suffix=".tmp",
+            delete=False,
+        ) as f:
+            np.savez(
+                f,
+                store_dates=self.store_dates.view(np.int64),
+                store_offsets=self.store_offsets,
+                offsets=self.offsets,
+                positions=self.positions,
+                data_fingerprint=np.array(self.data_fingerprint or ""),
+            )
+        os.replace(f.name, filename)
+
+    @classmethod
+    def load(cls, filename: str, metric: EvaluationMetric) -> "RankIndex":
+        with np.load(filename) as data:
+            return cls(
+                metric,
+                data["store_dates"].view("datetime64[ns]"),
+                data["store_offsets"],
+                data["offsets"],
+                data["positions"],
+                # Indexes saved before fingerprints are rebuilt
+                (
+                    str(data["data_fingerprint"]) or None
+                    if "data_fingerprint" in data.files
+                    else None
+                ),
+            )
+
+    @classmethod
+    def load_or_build(
+        cls,
+        store: MarketDataStore,
+        metric: EvaluationMetric,
+        base_path: str,
+        env: str = "prod",
+    ) -> "RankIndex":
+        """
+        Load the index saved next to the processed data, rebuilding (and saving)
+        it if it is missing or was built from different data (e.g. revised
+        metrics with the same rows).
+        """
+        filename = RankIndex.filename(base_path, metric, store, env)
+        if os.path.exists(filename):
+            rank_index = cls.load(filename, metric)
+            if rank_index.is_valid_for(store):
+                return rank_index
+        rank_index = cls.build(store, metric)
+        rank_index.save(filename)
+        return rank_index
@@ -0,0 +1,356 @@
+import dataclasses
+import datetime
+import functools
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Callable, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from src.data_types import (
+    CappedWeighting,
+    EvaluationMetric,
+    MarketCapBand,
+    ResultDetail,
+    ShareAllocation,
+    StockBasketWeightApproach,
+    StockUniverse,
+)
+from src.market_data import MARKET_DATA_COLUMNS, DateLike, MarketDataStore
+from src.rank_index import RankIndex
+from src.serialization_lib import read_result_df_from_feather, write_df_to_feather
+
+DEFAULT_MAX_SIZE_BYTES = 10 * 1024**3
+
+_RESULT_FILENAMES = {
+    "df_res": "df_res.feather",
+    "df_debug": "df_debug.feather",
+    "df_daily": "df_daily.feather",
+}
+_CHECKPOINT_FILENAME = "checkpoint.json"
+# The key of the entry holding the results up to a checkpoint
+_RESULT_KEY_FILENAME = "result_key"
+
+
+@functools.lru_cache(maxsize=None)
+def code_version() -> str:
+    """
+    Hash of the source of the `src` modules, so results cached by an older
+    version of the backtest are not reused. Any change invalidates the cache,
+    which is cheaper than reusing a result the change would have altered.
+    """
+    digest = hashlib.sha256()
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))):
+        with open(filename, "rb") as f:
+            digest.update(os.path.basename(filename).encode())
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _backtest_columns(
+    base_metric: EvaluationMetric, test_metric: EvaluationMetric
+) -> List[str]:
+    columns = MARKET_DATA_COLUMNS + [
+        base_metric.sorted_column(),
+        test_metric.sorted_column(),
+    ]
+    return list(dict.fromkeys(columns))
+
+
+def _hash(inputs: List[str]) -> str:
+    return hashlib.sha256("\n".join(inputs).encode()).hexdigest()
+
+
+def _rank_index_fingerprint(
+    daily_data: MarketDataStore,
+    metric: EvaluationMetric,
+    rank_index: Optional[RankIndex],
+) -> str:
+    if rank_index is None:
+        # The fingerprint of the index `compute_backtest_dfs` builds
+        return daily_data.fingerprint(RankIndex.columns(metric))
+    return str(rank_index.data_fingerprint)
+
+
+def backtest_cache_key(
+    daily_data: MarketDataStore,
+    base_metric: EvaluationMetric,
+    test_metric: EvaluationMetric,
+    stocks_universe: Union[StockUniverse, MarketCapBand],
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+    rebalance_days: int,
+    portfolio_size: int,
+    initial_portfolio_value: int,
+    detail: ResultDetail,
+    daily_values: bool = False,
+    base_rank_index: Optional[RankIndex] = None,
+    test_rank_index: Optional[RankIndex] = None,
+) -> str:
+    """
+    Hash of everything a `compute_backtest_dfs` result depends on: the content of
+    the columns it reads, the fingerprints of the tables derived from them (the
+    rank indexes, passed in or built from `daily_data`, and the last available
+    prices), all of its parameters and the code version.
+    """
+    return _hash(
+        [
+            daily_data.fingerprint(_backtest_columns(base_metric, test_metric)),
+            _rank_index_fingerprint(daily_data, base_metric, base_rank_index),
+            _rank_index_fingerprint(daily_data, test_metric, test_rank_index),
+            daily_data.last_available_prices_fingerprint(),
+            backtest_checkpoint_key(
+                base_metric,
+                test_metric,
+                stocks_universe,
+                weight_strategy,
+                rebalance_days,
+                portfolio_size,
+                initial_portfolio_value,
+                detail,
+                daily_values,
+            ),
+        ]
+    )
+
+
+def backtest_checkpoint_key(
+    base_metric: EvaluationMetric,
+    test_metric: EvaluationMetric,
+    stocks_universe: Union[StockUniverse, MarketCapBand],
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+    rebalance_days: int,
+    portfolio_size: int,
+    initial_portfolio_value: int,
+    detail: ResultDetail,
+    daily_values: bool = False,
+) -> str:
+    """
+    Like `backtest_cache_key` but without the data, which a checkpoint records
+    itself (see `BacktestCheckpoint.data_fingerprint`), so a backtest on more
+    data finds the checkpoint of the same backtest on less data.
+    """
+    return _hash(
+        [
+            "checkpoint",
+            repr(base_metric),
+            repr(test_metric),
+            repr(stocks_universe),
+            repr(weight_strategy),
+            repr(rebalance_days),
+            repr(portfolio_size),
+            repr(initial_portfolio_value),
+            repr(detail),
+            repr(daily_values),
+            code_version(),
+        ]
+    )
+
+
+def backtest_data_fingerprint(
+    daily_data: MarketDataStore,
+    base_metric: EvaluationMetric,
+    test_metric: EvaluationMetric,
+    end_date: DateLike,
+) -> str:
+    """
+    Fingerprint of the data a backtest read up to `end_date`.
+    """
+    return daily_data.fingerprint(
+        _backtest_columns(base_metric, test_metric), end_date=end_date
+    )
+
+
+@dataclasses.dataclass
+class BacktestCheckpoint:
+    """
+    The state of `compute_backtest_dfs` right after its last rebalance, to
+    extend the backtest when new trading days are appended to the data.
+    """
+
+    # The last rebalance date and the number of rebalances up to it
+    date: datetime.datetime
+    num_rebalances: int
+    # `backtest_data_fingerprint` up to `date`, to detect revised past data
+    data_fingerprint: str
+    base_share_allocation: List[ShareAllocation]
+    test_share_allocation: List[ShareAllocation]
+    base_portfolio_value: float
+    test_portfolio_value: float
+    base_price: float
+    test_price: float
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {**dataclasses.asdict(self), "date": self.date.isoformat()}, indent=1
+        )
+
+    @classmethod
+    def from_json(cls, s: str) -> "BacktestCheckpoint":
+        fields = json.loads(s)
+        fields["date"] = datetime.datetime.fromisoformat(fields["date"])
+        for key in ["base_share_allocation", "test_share_allocation"]:
+            fields[key] = [ShareAllocation(**a) for a in fields[key]]
+        return cls(**fields)
+
+
+class ResultCache:
+    """
+    Backtest results on disk, content addressed by `backtest_cache_key`, so a
+    result is reused only if it was computed from the same data, parameters and
+    code. Each entry is a directory holding the result DataFrames. Entries saved
+    with `put_checkpoint` (keyed by `backtest_checkpoint_key`) hold a
+    `BacktestCheckpoint` to extend the backtest from and the key of the entry
+    holding the results up to it, so the results are only stored once.
+
+    The cache is bounded to `max_size_bytes`: when a new entry makes it larger,
+    the least recently used entries (by the entry directory's modification time,
+    touched on every hit) are evicted. A checkpoint whose results were evicted
+    is a miss. Entries are written to a temporary directory and renamed into
+    place, so concurrent processes (e.g. sweep workers) can share a cache.
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.isdir(self._entry_dir(key))
+
+    def get(
+        self, key: str
+    ) -> Optional[Tuple[pd.DataFrame, Optional[pd.DataFrame], Optional[pd.DataFrame]]]:
+        """
+        The (df_res, df_debug, df_daily) saved under `key`, or None on a miss.
+        df_debug and df_daily are None if they were not saved (see
+        `ResultDetail.NONE` and the `daily_values` of `compute_backtest_dfs`).
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            dfs = []
+            for name, filename in _RESULT_FILENAMES.items():
+                filename = os.path.join(entry_dir, filename)
+                if name == "df_res" or os.path.exists(filename):
+                    dfs.append(read_result_df_from_feather(filename))
+                else:
+                    dfs.append(None)
+            os.utime(entry_dir)
+        except FileNotFoundError:
+            # Missing, or evicted by another process while being read
+            return None
+        return tuple(dfs)
+
+    def get_checkpoint(self, key: str) -> Optional[
+        Tuple[
+            BacktestCheckpoint,
+            pd.DataFrame,
+            Optional[pd.DataFrame],
+            Optional[pd.DataFrame],
+        ]
+    ]:
+        """
+        The checkpoint saved under `key` with the (df_res, df_debug, df_daily)
+        up to it, or None on a miss.
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, _CHECKPOINT_FILENAME)) as f:
+                checkpoint = BacktestCheckpoint.from_json(f.read())
+            with open(os.path.join(entry_dir, _RESULT_KEY_FILENAME)) as f:
+                result_key = f.read()
+            os.utime(entry_dir)
+        except FileNotFoundError:
+            return None
+        dfs = self.get(result_key)
+        if dfs is None:
+            return None
+        return (checkpoint, *dfs)
+
+    def put(
+        self,
+        key: str,
+        df_res: pd.DataFrame,
+        df_debug: Optional[pd.DataFrame],
+        df_daily: Optional[pd.DataFrame] = None,
+    ) -> None:
+        def write(entry_dir: str) -> None:
+            for df, filename in zip(
+                [df_res, df_debug, df_daily], _RESULT_FILENAMES.values()
+            ):
+                if df is not None:
+                    write_df_to_feather(df, os.path.join(entry_dir, filename))
+
+        self._put(key, write, replace=False)
+
+    def put_checkpoint(
+        self, key: str, checkpoint: BacktestCheckpoint, result_key: str
+    ) -> None:
+        """
+        Save `checkpoint`, whose results up to it were saved with `put` under
+        `result_key`, replacing the previous checkpoint saved under `key`.
+        """
+
+        def write(entry_dir: str) -> None:
+            with open(os.path.join(entry_dir, _CHECKPOINT_FILENAME), "w") as f:
+                f.write(checkpoint.to_json())
+            with open(os.path.join(entry_dir, _RESULT_KEY_FILENAME), "w") as f:
+                f.write(result_key)
+
+        self._put(key, write, replace=True)
+
+    def _put(self, key: str, write: Callable[[str], None], replace: bool) -> None:
+        entry_dir = self._entry_dir(key)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        old_dir = tmp_dir + "-old"
+        try:
+            write(tmp_dir)
+            # Checkpoints are replaced; move the previous one out of the way.
+            if replace and key in self:
+                os.rename(entry_dir, old_dir)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process put the same entry first
+            if key not in self:
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        self.evict()
+
+    def size_bytes(self) -> int:
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if key.startswith(".tmp-"):
+                continue
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(entry_dir, filename))
+                    for filename in os.listdir(entry_dir)
+                )
+                entries.append((os.path.getmtime(entry_dir), key, size))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict(self) -> None:
+        """
+        Delete least recently used entries until the cache fits in `max_size_bytes`.
+        """
+        entries = sorted(self._entries())
+        size = sum(size for _, _, size in entries)
+        for _, key, entry_size in entries:
+            if size <= self.max_size_bytes:
+                break
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            size -= entry_size
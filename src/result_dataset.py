@@ -0,0 +1,252 @@
+# All the results of the sweeps as one Arrow dataset per table (df_res, df_debug,
+# df_daily), partitioned by the backtest parameters, instead of one feather file
+# per table and cell.
+
+import os
+import queue
+import shutil
+import threading
+from typing import Dict, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+
+from src.backtest import BackTestResult
+from src.data_types import EvaluationMetric, MarketCapBand, StockUniverse
+from src.serialization_lib import arrow_table_to_df, write_df_to_feather
+
+RESULT_TABLES = ["df_res", "df_debug", "df_daily"]
+
+# Directory levels of every cell, e.g.
+# df_res/base_metric=EV_EBIT/test_metric=P_B/stocks_universe=LARGE/rebalance_days=90/portfolio_size=10/part-0.feather
+PARTITION_COLUMNS = [
+    "base_metric",
+    "test_metric",
+    "stocks_universe",
+    "rebalance_days",
+    "portfolio_size",
+]
+
+_PART_FILENAME = "part-0.feather"
+
+PartitionValue = Union[EvaluationMetric, StockUniverse, MarketCapBand, int, str]
+
+
+def result_dataset_dir(base_path: str, env: str = "prod") -> str:
+    return os.path.join(base_path, f"results_{env}")
+
+
+def _partition_value(value: PartitionValue) -> str:
+    if isinstance(value, (EvaluationMetric, MarketCapBand)):
+        return value.file_friendly()
+    if isinstance(value, StockUniverse):
+        return value.name
+    return str(value).replace("/", "_")
+
+
+def _cell_dir(dataset_dir: str, table: str, result: BackTestResult) -> str:
+    return os.path.join(
+        dataset_dir,
+        table,
+        *[
+            f"{column}={_partition_value(getattr(result, column))}"
+            for column in PARTITION_COLUMNS
+        ],
+    )
+
+
+def _remove_cell(dataset_dir: str, cell_dir: str) -> None:
+    shutil.rmtree(cell_dir, ignore_errors=True)
+    # Up to the table directory, so a table without cells is not scanned
+    directory = os.path.dirname(cell_dir)
+    while directory != dataset_dir:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            # Not empty (or already gone)
+            break
+        directory = os.path.dirname(directory)
+
+
+def write_result(dataset_dir: str, result: BackTestResult) -> None:
+    """
+    Write (or replace) the tables of a backtest into their partition of the
+    dataset. Files are written under a hidden name and then renamed, so scans
+    never see a partly written cell.
+    """
+    for table in RESULT_TABLES:
+        df = {
+            "df_res": result.df,
+            "df_debug": result.df_debug,
+            "df_daily": result.df_daily,
+        }[table]
+        cell_dir = _cell_dir(dataset_dir, table, result)
+        if df is None:
+            # Or the table of a previous run of the cell would be read back
+            _remove_cell(dataset_dir, cell_dir)
+            continue
+        os.makedirs(cell_dir, exist_ok=True)
+        tmp_filename = os.path.join(cell_dir, f".{_PART_FILENAME}.tmp")
+        write_df_to_feather(df, tmp_filename)
+        os.replace(tmp_filename, os.path.join(cell_dir, _PART_FILENAME))
+
+
+def read_results(
+    dataset_dir: str,
+    table: str = "df_res",
+    columns: Optional[List[str]] = None,
+    **filters: Union[PartitionValue, List[PartitionValue]],
+) -> pd.DataFrame:
+    """
+    Any slice of the sweeps in one scan of the dataset, reading only the files
+    of the partitions matching `filters`, e.g.
+    `read_results(dir, base_metric=EvaluationMetric.EV_EBIT, rebalance_days=[90, 180])`.
+
+    Args:
+        table: One of `RESULT_TABLES`.
+        columns: Only read these columns (besides the date and the partition
+            columns).
+        filters: A value, or a list of values, per partition column.
+
+    Returns:
+        One row per (cell, date): the partition columns, the date ("date") and
+        the columns of the table.
+    """
+    import pyarrow.dataset as ds
+
+    unknown = set(filters) - set(PARTITION_COLUMNS)
+    if unknown:
+        raise Exception(f"Cannot filter by {sorted(unknown)}, only {PARTITION_COLUMNS}")
+    table_dir = os.path.join(dataset_dir, table)
+    if not os.path.isdir(table_dir):
+        raise Exception(f"No {table} results in {dataset_dir}")
+
+    dataset = ds.dataset(table_dir, format="ipc", partitioning="hive")
+    expression = None
+    for column, values in filters.items():
+        if not isinstance(values, list):
+            values = [values]
+        # Partition values are parsed back as integers or strings
+        if pa.types.is_integer(dataset.schema.field(column).type):
+            values = [int(v) for v in values]
+        else:
+            values = [_partition_value(v) for v in values]
+        column_expression = ds.field(column).isin(values)
+        expression = (
+            column_expression if expression is None else expression & column_expression
+        )
+    if columns is not None:
+        columns = PARTITION_COLUMNS + ["index"] + columns
+    df = arrow_table_to_df(dataset.to_table(columns=columns, filter=expression))
+    df.rename(columns={"index": "date"}, inplace=True)
+    return df[PARTITION_COLUMNS + [c for c in df.columns if c not in PARTITION_COLUMNS]]
+
+
+def _parse_partition(column: str, value: Union[str, int]) -> PartitionValue:
+    if column in ["base_metric", "test_metric"]:
+        return EvaluationMetric[value]
+    if column == "stocks_universe":
+        if value in StockUniverse.__members__:
+            return StockUniverse[value]
+        return MarketCapBand.from_file_friendly(value)
+    return int(value)
+
+
+def load_results(
+    dataset_dir: str,
+    with_debug: bool = False,
+    **filters: Union[PartitionValue, List[PartitionValue]],
+) -> List[BackTestResult]:
+    """
+    The backtests of the cells matching `filters` (see `read_results`), with
+    their daily values if they were saved and, if asked, their df_debug, like
+    `load_backtest_result` for every cell at once (one scan per table).
+    """
+    tables = ["df_res", "df_daily"] + (["df_debug"] if with_debug else [])
+    cells: Dict[tuple, Dict[str, pd.DataFrame]] = {}
+    for table in tables:
+        if table != "df_res" and not os.path.isdir(os.path.join(dataset_dir, table)):
+            continue
+        df = read_results(dataset_dir, table, **filters)
+        for key, df_cell in df.groupby(PARTITION_COLUMNS, sort=True, observed=True):
+            df_cell = df_cell.drop(columns=PARTITION_COLUMNS).set_index("date")
+            df_cell.index.name = None
+            cells.setdefault(key, {})[table] = df_cell
+
+    results = []
+    for key, dfs in cells.items():
+        if "df_res" not in dfs:
+            continue
+        params = {
+            column: _parse_partition(column, value)
+            for column, value in zip(PARTITION_COLUMNS, key)
+        }
+        results.append(
+            BackTestResult(
+                dfs["df_res"],
+                dfs.get("df_debug"),
+                params["base_metric"],
+                params["test_metric"],
+                params["rebalance_days"],
+                params["portfolio_size"],
+                params["stocks_universe"],
+                dfs.get("df_daily"),
+            )
+        )
+    return results
+
+
+class ResultWriter:
+    """
+    Writes backtest results into the dataset from a background thread, so the
+    code computing them (e.g. `run_sweep`) does not wait on the disk. At most
+    `max_pending` results are queued, after which `submit` waits for the thread
+    to catch up rather than holding every result in memory.
+
+    Use as a context manager, or `close` it to wait for the pending writes.
+    """
+
+    def __init__(self, dataset_dir: str, max_pending: int = 16):
+        self.dataset_dir = dataset_dir
+        self._queue: "queue.Queue[Optional[BackTestResult]]" = queue.Queue(
+            maxsize=max_pending
+        )
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(
+            target=self._write_results, name="ResultWriter", daemon=True
+        )
+        self._thread.start()
+
+    def _write_results(self) -> None:
+        while True:
+            result = self._queue.get()
+            if result is None:
+                return
+            # After an error, keep draining the queue so `submit` never blocks
+            if self._error is None:
+                try:
+                    write_result(self.dataset_dir, result)
+                except BaseException as e:
+                    self._error = e
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise Exception(
+                f"Failed to write a result to {self.dataset_dir}"
+            ) from self._error
+
+    def submit(self, result: BackTestResult) -> None:
+        self._raise_error()
+        self._queue.put(result)
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -1,9 +1,24 @@
-from typing import List
+import datetime
+import os
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Union
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
 
-from src.data_types import *
+# pyarrow.compute and pyarrow.dataset are slow to import and only needed for the
+# per ticker debug data and filtered reads, so they are imported where used
+# rather than by every process reading or writing whole files (e.g. workers).
+if TYPE_CHECKING:
+    import pyarrow.dataset as ds
+
+from src.data_types import (
+    EvaluationMetric,
+    MarketCapBand,
+    StockRebalanceInstance,
+    StockUniverse,
+)
 
 
 def get_feather_filename(
@@ -12,9 +27,12 @@ def get_feather_filename(
     test_metric: EvaluationMetric,
     rebalance_days: int,
     portfolio_size: int,
-    stocks_universe: StockUniverse,
+    stocks_universe: Union[StockUniverse, MarketCapBand],
     env: str = "prod",
 ) -> str:
+    universe = str(stocks_universe)
+    if isinstance(stocks_universe, MarketCapBand):
+        universe = stocks_universe.file_friendly()
     return (
         f"{prefix}:"
         f'{str(base_metric).replace("/", "_")}_VS'
@@ -22,65 +40,310 @@ def get_feather_filename(
         f'{str(test_metric).replace("/", "_")}:'
         f"rebalanced_every_{rebalance_days}:"
         f"portfolio_size_{portfolio_size}:"
-        f"{str(stocks_universe)}:"
+        f"{universe}:"
         f"{env}"
         f".feather"
     )
 
 
-def serialize_portfolio(inputs: List[StockRebalanceInstance]) -> List[str]:
+# Per ticker debug data (lists of `StockRebalanceInstance`) is stored as native
+# Arrow list<struct> columns rather than strings, so it keeps its types and can be
+# flattened into a long (date, ticker) table without parsing.
+STOCK_REBALANCE_INSTANCE_TYPE = pa.struct(
+    [
+        ("ticker", pa.string()),
+        ("prev_price", pa.float64()),
+        ("curr_price", pa.float64()),
+    ]
+)
+
+
+def _list_offsets(lists: pd.Series) -> pa.Array:
+    lengths = np.fromiter((len(v) for v in lists), dtype=np.int32, count=len(lists))
+    return pa.array(np.concatenate([[0], np.cumsum(lengths, dtype=np.int32)]))
+
+
+def portfolio_to_arrow(portfolios: pd.Series) -> pa.Array:
     """
-    Helper so DataFrame column can be stored as a feather or HDF file.
+    Lists of `StockRebalanceInstance` as a list<struct> array.
     """
-    return [f"{i.ticker}:{i.prev_price}:{i.curr_price}" for i in inputs]
+    flat = [i for portfolio in portfolios for i in portfolio]
+    values = pa.StructArray.from_arrays(
+        [
+            pa.array([i.ticker for i in flat], type=pa.string()),
+            pa.array([i.prev_price for i in flat], type=pa.float64()),
+            pa.array([i.curr_price for i in flat], type=pa.float64()),
+        ],
+        fields=list(STOCK_REBALANCE_INSTANCE_TYPE),
+    )
+    return pa.ListArray.from_arrays(_list_offsets(portfolios), values)
 
 
-def deserialize_portfolio(inputs: List[StockRebalanceInstance]) -> None:
+def tickers_to_arrow(tickers: pd.Series) -> pa.Array:
     """
-    Helper to deserialize portfolio from a previously saved feather or HDF file.
+    Collections (e.g. sets) of tickers as a list<string> array.
+    """
+    flat = [ticker for row in tickers for ticker in sorted(row)]
+    return pa.ListArray.from_arrays(
+        _list_offsets(tickers), pa.array(flat, type=pa.string())
+    )
+
+
+def _split_lists(array: pa.ChunkedArray, values: List) -> List[List]:
+    offsets = np.asarray(array.combine_chunks().offsets)
+    offsets = offsets - offsets[0]
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def deserialize_portfolio(inputs: List[str]) -> List[StockRebalanceInstance]:
+    """
+    Helper to read the "ticker:prev_price:curr_price" strings that older
+    versions stored per ticker debug data as.
     """
     r = []
     for t in inputs:
-        split = t.split(":")
-        r.append(
-            StockRebalanceInstance(
-                split[0],
-                float(split[1]) if split[1] != np.nan else np.nan,
-                float(split[2]) if split[2] != np.nan else np.nan,
-            )
-        )
+        ticker, prev_price, curr_price = t.split(":")
+        # float("nan") parses to NaN
+        r.append(StockRebalanceInstance(ticker, float(prev_price), float(curr_price)))
     return r
 
 
-COLUMN_TO_FEATHER_SERIALIZATION_MAPPING = {
-    "base_portfolio_tickers_closed": list,
-    "base_portfolio_per_ticker_data": serialize_portfolio,
-    "new_base_portfolio_per_ticker_data": serialize_portfolio,
+def portfolio_from_arrow(array: pa.ChunkedArray) -> List[List[StockRebalanceInstance]]:
+    import pyarrow.compute as pc
+
+    if pa.types.is_string(array.type.value_type):
+        return [deserialize_portfolio(inputs) for inputs in array.to_pylist()]
+    tickers, prev_prices, curr_prices = pc.list_flatten(
+        array.combine_chunks()
+    ).flatten()
+    instances = [
+        StockRebalanceInstance(*i)
+        for i in zip(
+            tickers.to_pylist(),
+            prev_prices.to_numpy(zero_copy_only=False).tolist(),
+            curr_prices.to_numpy(zero_copy_only=False).tolist(),
+        )
+    ]
+    return _split_lists(array, instances)
+
+
+def tickers_from_arrow(array: pa.ChunkedArray) -> List[Set[str]]:
+    import pyarrow.compute as pc
+
+    tickers = pc.list_flatten(array.combine_chunks()).to_pylist()
+    return [set(row) for row in _split_lists(array, tickers)]
+
+
+COLUMN_TO_ARROW_MAPPING = {
+    "base_portfolio_tickers_closed": tickers_to_arrow,
+    "base_portfolio_per_ticker_data": portfolio_to_arrow,
+    "new_base_portfolio_per_ticker_data": portfolio_to_arrow,
 }
 
 
-def write_df_to_feather(df_orig: pd.DataFrame, filename: str):
-    df = df_orig.copy()
-    for key, ser_func in COLUMN_TO_FEATHER_SERIALIZATION_MAPPING.items():
-        if key in df:
-            df[key] = df[key].map(ser_func)
-    df = df.reset_index()
-    if "date" not in df.columns and df.dtypes["index"] == "datetime64[ns]":
+def write_df_to_feather(
+    df_orig: pd.DataFrame, filename: str, metadata: Optional[Dict[str, str]] = None
+):
+    """
+    Args:
+        metadata: Saved with the schema of the file, see `read_feather_metadata`.
+    """
+    df = df_orig.reset_index()
+    if (
+        "date" not in df.columns
+        and "index" in df.columns
+        and df.dtypes["index"] == "datetime64[ns]"
+    ):
         df.rename({"index": "date"}, inplace=True)
-    df.to_feather(filename)
+    special_columns = [c for c in df.columns if c in COLUMN_TO_ARROW_MAPPING]
+    table = pa.Table.from_pandas(df.drop(columns=special_columns), preserve_index=False)
+    for key in special_columns:
+        table = table.add_column(
+            list(df.columns).index(key), key, COLUMN_TO_ARROW_MAPPING[key](df[key])
+        )
+    if metadata:
+        table = table.replace_schema_metadata(
+            {
+                **(table.schema.metadata or {}),
+                **{k.encode(): v.encode() for k, v in metadata.items()},
+            }
+        )
+    feather.write_feather(table, filename)
 
 
-COLUMN_TO_FEATHER_DESERIALIZATION_MAPPING = {
-    "base_portfolio_tickers_closed": set,
-    "base_portfolio_per_ticker_data": deserialize_portfolio,
-    "new_base_portfolio_per_ticker_data": deserialize_portfolio,
+def read_feather_metadata(filename: str) -> Dict[str, str]:
+    """
+    The `metadata` a file was written with by `write_df_to_feather`, read from
+    its schema only.
+    """
+    with pa.memory_map(filename) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    return {k.decode(): v.decode() for k, v in metadata.items() if k != b"pandas"}
+
+
+COLUMN_FROM_ARROW_MAPPING = {
+    "base_portfolio_tickers_closed": tickers_from_arrow,
+    "base_portfolio_per_ticker_data": portfolio_from_arrow,
+    "new_base_portfolio_per_ticker_data": portfolio_from_arrow,
 }
 
 
-def read_df_from_feather(filename: str):
-    df = pd.read_feather(filename)
-    for key, deser_func in COLUMN_TO_FEATHER_DESERIALIZATION_MAPPING.items():
-        if key in df:
-            df[key] = df[key].map(deser_func)
-    return df
+def _date_filter(
+    schema: pa.Schema,
+    start_date: Optional[datetime.datetime],
+    end_date: Optional[datetime.datetime],
+    date_column: str = "date",
+) -> Optional["ds.Expression"]:
+    import pyarrow.dataset as ds
+
+    date_type = schema.field(date_column).type
+
+    def to_scalar(date: datetime.datetime) -> pa.Scalar:
+        # Raw exports store dates as "%Y-%m-%d" strings, which sort like dates.
+        if pa.types.is_string(date_type) or pa.types.is_large_string(date_type):
+            return pa.scalar(date.strftime("%Y-%m-%d"), type=date_type)
+        return pa.scalar(pd.Timestamp(date), type=date_type)
+
+    expression = None
+    if start_date is not None:
+        expression = ds.field(date_column) >= to_scalar(start_date)
+    if end_date is not None:
+        end_expression = ds.field(date_column) <= to_scalar(end_date)
+        expression = (
+            end_expression if expression is None else expression & end_expression
+        )
+    return expression
+
+
+def read_df_from_feather(
+    filename: str,
+    columns: Optional[List[str]] = None,
+    memory_map: bool = False,
+    start_date: Optional[datetime.datetime] = None,
+    end_date: Optional[datetime.datetime] = None,
+):
+    """
+    Args:
+        filename: A feather file, or a directory of them (e.g. the dataset
+            partitioned by year that `run_ingestion` writes).
+        columns: Only read these columns.
+        memory_map: Memory map the file instead of reading it into memory, so
+            only the columns (and row ranges) read are loaded from disk. The
+            DataFrame still holds a copy of them, see `_load_memory_mapped` in
+            `src.batch.sweep` to share columns between processes.
+        start_date: Only read rows on or after this date (inclusive).
+        end_date: Only read rows on or before this date (inclusive).
+    """
+    if start_date is not None or end_date is not None or os.path.isdir(filename):
+        # Scan the file batch by batch, dropping rows outside the date range
+        # before they are accumulated, so the full file is never materialized.
+        import pyarrow.dataset as ds
+        from pyarrow.fs import LocalFileSystem
+
+        dataset = ds.dataset(
+            filename, format="ipc", filesystem=LocalFileSystem(use_mmap=memory_map)
+        )
+        table = dataset.to_table(
+            columns=columns,
+            filter=_date_filter(dataset.schema, start_date, end_date),
+        )
+    else:
+        table = feather.read_table(filename, columns=columns, memory_map=memory_map)
+
+    return arrow_table_to_df(table, memory_map)
     # return df.set_index("date")
+
+
+def arrow_table_to_df(table: pa.Table, memory_map: bool = False) -> pd.DataFrame:
+    """
+    Convert a table written by `write_df_to_feather` (e.g. read from a dataset)
+    back to the DataFrame it was written from.
+    """
+    special_columns = [c for c in table.column_names if c in COLUMN_FROM_ARROW_MAPPING]
+    df = table.drop(special_columns).to_pandas(split_blocks=memory_map)
+    for key in special_columns:
+        df.insert(
+            table.column_names.index(key),
+            key,
+            pd.Series(COLUMN_FROM_ARROW_MAPPING[key](table[key]), dtype=object),
+        )
+    return df
+
+
+def read_result_df_from_feather(filename: str) -> pd.DataFrame:
+    """
+    Read a backtest result (e.g. df_res) back with its date index, which
+    `write_df_to_feather` saves as an "index" column.
+    """
+    df = read_df_from_feather(filename)
+    df.set_index("index", inplace=True)
+    df.index.name = None
+    return df
+
+
+def read_debug_per_ticker_df(
+    filename: str,
+    column: str = "base_portfolio_per_ticker_data",
+    start_date: Optional[datetime.datetime] = None,
+    end_date: Optional[datetime.datetime] = None,
+    tickers: Optional[List[str]] = None,
+    memory_map: bool = True,
+) -> pd.DataFrame:
+    """
+    The per ticker data of a saved `df_debug` in long format, without building
+    `StockRebalanceInstance`s.
+
+    Args:
+        column: The per ticker data column to read.
+        start_date: Only read rebalances on or after this date (inclusive).
+        end_date: Only read rebalances on or before this date (inclusive).
+        tickers: Only read these tickers.
+
+    Returns:
+        One row per (date, ticker), with columns date (the rebalance date),
+        ticker, prev_price, curr_price and closed (the ticker closed before the
+        rebalance, see `base_portfolio_tickers_closed`).
+    """
+    # Filter the rebalances while scanning, then flatten the list<struct> column
+    # (slices of the memory mapped struct children) and filter the tickers in
+    # Arrow, so only the selected rows are converted to pandas.
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    from pyarrow.fs import LocalFileSystem
+
+    dataset = ds.dataset(
+        filename, format="ipc", filesystem=LocalFileSystem(use_mmap=memory_map)
+    )
+    table = dataset.to_table(
+        columns=["curr_date", "base_portfolio_tickers_closed", column],
+        filter=_date_filter(dataset.schema, start_date, end_date, "curr_date"),
+    )
+    if pa.types.is_string(table.schema.field(column).type.value_type):
+        raise Exception(f"{filename} was saved by an older version, re-save it.")
+
+    lists = table[column].combine_chunks()
+    parents = pc.list_parent_indices(lists)
+    ticker, prev_price, curr_price = pc.list_flatten(lists).flatten()
+    df = pa.table(
+        {
+            "date": table["curr_date"].take(parents),
+            "ticker": ticker,
+            "prev_price": prev_price,
+            "curr_price": curr_price,
+        }
+    )
+    if tickers is not None:
+        df = df.filter(pc.is_in(ticker, value_set=pa.array(tickers, pa.string())))
+    df = df.to_pandas()
+
+    closed_lists = table["base_portfolio_tickers_closed"].combine_chunks()
+    closed = pd.DataFrame(
+        {
+            "date": table["curr_date"].take(pc.list_parent_indices(closed_lists)),
+            "ticker": pc.list_flatten(closed_lists),
+        }
+    )
+    df["closed"] = pd.MultiIndex.from_frame(df[["date", "ticker"]]).isin(
+        pd.MultiIndex.from_frame(closed)
+    )
+    return df
@@ -0,0 +1,172 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.backtest import DAYS_PER_YEAR, BackTestResult
+
+SIGNIFICANCE_STATS = ["excess_return", "information_ratio"]
+
+
+def excess_log_returns(
+    result: BackTestResult, daily_values: bool = True
+) -> Tuple[np.ndarray, float]:
+    """
+    The per period log return of the base portfolio minus the one of the test
+    portfolio, between the dates both have a value.
+
+    Args:
+        daily_values: Use the daily values if the result has them (see
+            `BackTestResult.df_daily`) rather than the rebalance values.
+
+    Returns:
+        The excess returns and the number of periods per year.
+    """
+    if daily_values and result.df_daily is not None:
+        df = result.df_daily[["base_value", "test_value"]]
+    else:
+        df = result.df[["base_price", "test_price"]]
+    values = df.dropna().values.astype(np.float64)
+    dates = np.asarray(df.dropna().index.values, dtype="datetime64[D]")
+    log_returns = np.diff(np.log(values), axis=0)
+    years = (dates[-1] - dates[0]).astype(np.float64) / DAYS_PER_YEAR
+    return log_returns[:, 0] - log_returns[:, 1], len(log_returns) / years
+
+
+def _block_sums(values: np.ndarray, block_length: int) -> np.ndarray:
+    # Sum of the circular block starting at every period
+    wrapped = np.concatenate([values, values[: block_length - 1]])
+    sums = np.concatenate([[0], np.cumsum(wrapped)])
+    return sums[block_length:] - sums[: len(values)]
+
+
+def block_bootstrap(
+    excess: np.ndarray,
+    periods_per_year: float,
+    num_resamples: int = 10_000,
+    block_length: Optional[int] = None,
+    confidence: float = 0.95,
+    seed: Optional[np.random.SeedSequence] = None,
+) -> pd.DataFrame:
+    """
+    Circular block bootstrap of the annualized mean (`excess_return`) and of the
+    annualized mean over standard deviation (`information_ratio`) of per period
+    excess returns. Blocks of `block_length` consecutive periods keep their
+    serial correlation.
+
+    Both statistics only need the sum and the sum of squares of each resample,
+    which are the sums of those of its blocks, so a resample costs one lookup
+    per block rather than one per period.
+
+    Args:
+        block_length: Defaults to the cube root of the number of periods.
+        seed: Same seed, same resamples.
+
+    Returns:
+        One row per statistic (`SIGNIFICANCE_STATS`), with its observed value,
+        its percentile confidence interval and the two sided p-value of it being
+        0, from the bootstrap distribution centered on the observed value.
+    """
+    num_periods = len(excess)
+    if num_periods < 2:
+        raise Exception(f"Cannot bootstrap {num_periods} returns.")
+    if block_length is None:
+        block_length = max(1, int(round(num_periods ** (1 / 3))))
+    block_length = min(block_length, num_periods)
+    num_blocks = -(-num_periods // block_length)
+    resample_length = num_blocks * block_length
+
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, num_periods, (num_resamples, num_blocks))
+    sums = _block_sums(excess, block_length)[starts].sum(axis=1)
+    squared_sums = _block_sums(excess**2, block_length)[starts].sum(axis=1)
+
+    def statistics(total, squared_total, n):
+        mean = total / n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sd = np.sqrt(np.maximum(squared_total - n * mean**2, 0) / (n - 1))
+            return (
+                mean * periods_per_year,
+                mean / sd * np.sqrt(periods_per_year),
+            )
+
+    observed = statistics(np.sum(excess), np.sum(excess**2), num_periods)
+    resampled = statistics(sums, squared_sums, resample_length)
+
+    rows = []
+    alpha = (1 - confidence) / 2
+    for name, value, values in zip(SIGNIFICANCE_STATS, observed, resampled):
+        values = values[np.isfinite(values)]
+        rows.append(
+            {
+                "statistic": name,
+                "observed": value,
+                "ci_low": np.quantile(values, alpha),
+                "ci_high": np.quantile(values, 1 - alpha),
+                "p_value": (1 + np.sum(np.abs(values - value) >= abs(value)))
+                / (1 + len(values)),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def _bootstrap_result(
+    result: BackTestResult,
+    num_resamples: int,
+    block_length: Optional[int],
+    confidence: float,
+    daily_values: bool,
+    seed: np.random.SeedSequence,
+) -> pd.DataFrame:
+    excess, periods_per_year = excess_log_returns(result, daily_values)
+    df = block_bootstrap(
+        excess, periods_per_year, num_resamples, block_length, confidence, seed
+    )
+    df.insert(0, "num_returns", len(excess))
+    for column, value in reversed(
+        [
+            ("base_metric", str(result.base_metric)),
+            ("test_metric", str(result.test_metric)),
+            ("rebalance_days", result.rebalance_days),
+            ("portfolio_size", result.portfolio_size),
+            ("stocks_universe", str(result.stocks_universe)),
+        ]
+    ):
+        df.insert(0, column, value)
+    return df
+
+
+def compare_significance(
+    results: Iterable[BackTestResult],
+    num_resamples: int = 10_000,
+    block_length: Optional[int] = None,
+    confidence: float = 0.95,
+    daily_values: bool = True,
+    seed: int = 0,
+    max_workers: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Whether the base portfolio of every backtest (e.g. all the cells of a sweep)
+    significantly out-performs its test portfolio (e.g. EV/EBIT vs P/B), by
+    `block_bootstrap` of their excess returns (see `excess_log_returns`).
+
+    Every backtest gets its own stream of `seed`, so the results do not depend
+    on how they are spread over `max_workers` processes (by default, none).
+
+    Returns:
+        One row per backtest and statistic: the backtest parameters followed by
+        the `block_bootstrap` columns.
+    """
+    results = list(results)
+    seeds = np.random.SeedSequence(seed).spawn(len(results))
+    args = [
+        (result, num_resamples, block_length, confidence, daily_values, s)
+        for result, s in zip(results, seeds)
+    ]
+    if max_workers is None:
+        dfs: List[pd.DataFrame] = [_bootstrap_result(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            dfs = list(executor.map(_bootstrap_result, *zip(*args)))
+    return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,96 @@
+import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.market_data import DateLike, MarketDataStore, to_datetime64
+
+
+class TradingCalendar:
+    """
+    Sorted trading sessions, usually the distinct dates of the data itself, so a
+    date snapped to a session is guaranteed to have data (unlike a holiday rule
+    based work day, e.g. Good Friday is not a `holidays.US()` holiday).
+    """
+
+    def __init__(self, sessions: np.ndarray):
+        self.sessions = np.unique(np.asarray(sessions, dtype="datetime64[ns]"))
+
+    @classmethod
+    def from_store(cls, store: MarketDataStore) -> "TradingCalendar":
+        return cls(store.dates)
+
+    @classmethod
+    def from_holiday_rules(
+        cls,
+        start_date: DateLike,
+        end_date: DateLike,
+        country_holidays: Optional[dict] = None,
+    ) -> "TradingCalendar":
+        """
+        Fallback for when there is no data to take the sessions from: weekdays
+        that are not holidays (`holidays.US()` unless `country_holidays` is given).
+        """
+        days = pd.bdate_range(start_date, end_date)
+        if country_holidays is None:
+            import holidays
+
+            country_holidays = holidays.US(years=range(days[0].year, days[-1].year + 1))
+        holiday_dates = np.array(list(country_holidays.keys()), dtype="datetime64[D]")
+        is_holiday = np.isin(days.values.astype("datetime64[D]"), holiday_dates)
+        return cls(days.values[~is_holiday])
+
+    def previous_sessions(self, dates: np.ndarray) -> np.ndarray:
+        """
+        The latest session on or before each of `dates`, by binary search.
+        """
+        dates = np.asarray(dates, dtype="datetime64[ns]")
+        positions = np.searchsorted(self.sessions, dates, side="right") - 1
+        if (positions < 0).any():
+            raise Exception(f"Dates before the first session {self.sessions[0]}")
+        return self.sessions[positions]
+
+    def previous_session(self, date: DateLike) -> datetime.datetime:
+        session = self.previous_sessions(np.array([to_datetime64(date)]))[0]
+        return pd.Timestamp(session).to_pydatetime()
+
+    def rebalance_schedules(
+        self,
+        start_date: DateLike,
+        end_date: DateLike,
+        rebalance_days: List[int],
+    ) -> Dict[int, List[datetime.datetime]]:
+        """
+        For each rebalance period, the dates `start_date + k * period` before
+        `end_date` snapped to the previous session (like `get_rebalance_dates`),
+        for all the periods in one vectorized search. Dates that snap to the same
+        session are only kept once.
+        """
+        start = to_datetime64(start_date).astype("datetime64[D]")
+        end = to_datetime64(end_date).astype("datetime64[D]")
+        periods = np.asarray(rebalance_days, dtype=np.int64)
+        span_days = int((end - start).astype(np.int64))
+
+        # Number of k with k * period < span_days, i.e. ceil(span_days / period)
+        counts = np.maximum(-(-span_days // periods), 0)
+        group_starts = np.cumsum(counts) - counts
+        k = np.arange(counts.sum()) - np.repeat(group_starts, counts)
+        targets = start + (k * np.repeat(periods, counts)).astype("timedelta64[D]")
+        sessions = self.previous_sessions(targets)
+
+        schedules = {}
+        for period, group_start, count in zip(rebalance_days, group_starts, counts):
+            schedule = sessions[group_start : group_start + count]
+            is_new = np.empty(len(schedule), dtype=bool)
+            is_new[:1] = True
+            is_new[1:] = schedule[1:] != schedule[:-1]
+            schedules[period] = list(pd.DatetimeIndex(schedule[is_new]).to_pydatetime())
+        return schedules
+
+    def rebalance_schedule(
+        self, start_date: DateLike, end_date: DateLike, rebalance_days: int
+    ) -> List[datetime.datetime]:
+        return self.rebalance_schedules(start_date, end_date, [rebalance_days])[
+            rebalance_days
+        ]
@@ -0,0 +1,134 @@
+from typing import Optional, Union
+
+import numpy as np
+
+from src.data_types import CappedWeighting, StockBasketWeightApproach
+
+# Number of daily returns `trailing_volatility` looks back over (about 3 months)
+VOLATILITY_WINDOW = 63
+
+
+def trailing_volatility(
+    codes: np.ndarray, prices: np.ndarray, window: int = VOLATILITY_WINDOW
+) -> np.ndarray:
+    """
+    For every row, the standard deviation of the daily returns of its ticker over
+    the last `window` returns up to and including the row (NaN with fewer than
+    two). Computed for all tickers at once from running sums.
+
+    ASSUMPTION: the rows are sorted by date, `codes` are their ticker codes.
+    """
+    # Rows grouped by ticker, in date order within each ticker
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+    sorted_prices = prices[order].astype(np.float64)
+    n = len(order)
+
+    is_first = np.empty(n, dtype=bool)
+    is_first[:1] = True
+    is_first[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    group_starts = np.maximum.accumulate(np.where(is_first, np.arange(n), 0))
+
+    returns = np.zeros(n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns[1:] = sorted_prices[1:] / sorted_prices[:-1] - 1
+    is_valid = ~is_first & np.isfinite(returns)
+    returns[~is_valid] = 0
+
+    # Sums over the window [lo, hi) of each row, clipped to the ticker's rows
+    hi = np.arange(1, n + 1)
+    lo = np.maximum(hi - window, group_starts)
+    sums = np.concatenate([[0], np.cumsum(returns)])
+    squared_sums = np.concatenate([[0], np.cumsum(returns**2)])
+    counts = np.concatenate([[0], np.cumsum(is_valid)])
+    count = counts[hi] - counts[lo]
+    total = sums[hi] - sums[lo]
+    squared_total = squared_sums[hi] - squared_sums[lo]
+
+    volatility = np.full(n, np.nan)
+    enough = count >= 2
+    variance = (squared_total[enough] - total[enough] ** 2 / count[enough]) / (
+        count[enough] - 1
+    )
+    volatility[enough] = np.sqrt(np.maximum(variance, 0))
+
+    res = np.empty(n)
+    res[order] = volatility
+    return res
+
+
+def _normalize(scores: np.ndarray) -> np.ndarray:
+    """
+    `scores` scaled to sum to 1. Missing (NaN) or non positive scores get the
+    median of the others, and all stocks the same weight if none is usable.
+    """
+    if len(scores) == 0:
+        # Left to `Portfolio.buy` to reject
+        return np.asarray(scores, dtype=np.float64)
+    usable = np.isfinite(scores) & (scores > 0)
+    if not usable.any():
+        return np.full(len(scores), 1 / len(scores))
+    if not usable.all():
+        scores = np.where(usable, scores, np.median(scores[usable]))
+    return scores / np.sum(scores)
+
+
+def cap_weights(weights: np.ndarray, max_weight: float) -> np.ndarray:
+    """
+    Clip `weights` (summing to 1) to `max_weight`, spreading the excess over the
+    uncapped weights in proportion to them until none is above the cap.
+    """
+    if len(weights) == 0:
+        return weights
+    if max_weight * len(weights) < 1:
+        raise Exception(
+            f"Cannot cap {len(weights)} weights to {max_weight}, they would sum to less than 1."
+        )
+    weights = weights.copy()
+    capped = np.zeros(len(weights), dtype=bool)
+    # Each pass caps at least one more weight
+    while (weights > max_weight + 1e-12).any():
+        capped |= weights >= max_weight
+        excess = 1 - max_weight * np.sum(capped)
+        weights[capped] = max_weight
+        weights[~capped] *= excess / np.sum(weights[~capped])
+    return weights
+
+
+def get_basket_weights(
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+    marketcap: np.ndarray,
+    volatility: Optional[np.ndarray] = None,
+) -> Optional[np.ndarray]:
+    """
+    The weight of every stock of a basket, in one array operation.
+
+    Args:
+        marketcap: Of the stocks, ordered best first by the metric they were
+            selected by (the order `INVERSE_METRIC_RANK` weighs by).
+        volatility: Of the stocks (see `trailing_volatility`), only needed for
+            `INVERSE_VOLATILITY`.
+
+    Returns:
+        The weights, summing to 1, or None for `EQUAL_WEIGHTING` so equal weight
+        baskets keep their faster path (see `Portfolio.buy`).
+    """
+    if isinstance(weight_strategy, CappedWeighting):
+        weights = get_basket_weights(weight_strategy.approach, marketcap, volatility)
+        if weights is None:
+            weights = _normalize(np.ones(len(marketcap)))
+        return cap_weights(weights, weight_strategy.max_weight)
+
+    if weight_strategy.value == StockBasketWeightApproach.EQUAL_WEIGHTING.value:
+        return None
+    elif weight_strategy.value == StockBasketWeightApproach.MARKET_CAP_ADJUSTED.value:
+        return _normalize(np.asarray(marketcap, dtype=np.float64))
+    elif weight_strategy.value == StockBasketWeightApproach.INVERSE_METRIC_RANK.value:
+        return _normalize(1 / np.arange(1, len(marketcap) + 1))
+    elif weight_strategy.value == StockBasketWeightApproach.INVERSE_VOLATILITY.value:
+        if volatility is None:
+            raise Exception(f"{weight_strategy} needs the volatility of the stocks.")
+        with np.errstate(divide="ignore"):
+            return _normalize(1 / np.asarray(volatility, dtype=np.float64))
+    else:
+        raise Exception(f"Unsupported weight strategy {weight_strategy}")
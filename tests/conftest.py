@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.benchmark.synthetic_data import generate_daily_data
+
+
+@pytest.fixture(scope="session")
+def daily_data() -> pd.DataFrame:
+    """
+    Small synthetic market data, with noise below the cent added to the metrics
+    so no two stocks tie on a date and any sort ranks them the same way. Shared
+    by the tests, which must not modify it.
+    """
+    df = generate_daily_data(num_tickers=200, num_years=3)
+    rng = np.random.default_rng(0)
+    for column in ["evebit", "pe", "pb"]:
+        df[column] += rng.uniform(0, 0.01, len(df))
+    return df
@@ -0,0 +1,188 @@
+import datetime
+import os
+from typing import Union
+
+import pandas as pd
+import pytest
+
+from src.backtest import compute_backtest_dfs, load_backtest_result
+from src.backtest_helpers import (
+    filter_df_by_date,
+    filter_stocks_by_universe,
+    get_metric_mask,
+    get_rebalance_dates,
+    get_share_allocation,
+    get_stock_basket_price,
+    get_top_n_stocks_by_metric,
+    sort_df_by_metric,
+)
+from src.data_types import (
+    CappedWeighting,
+    EvaluationMetric,
+    MarketCapBand,
+    ResultDetail,
+    StockBasketWeightApproach,
+    StockUniverse,
+)
+from src.market_data import MarketDataStore
+from src.rank_index import RankIndex
+
+
+def _helper_backtest(
+    df: pd.DataFrame,
+    base_metric: EvaluationMetric,
+    test_metric: EvaluationMetric,
+    stocks_universe: Union[StockUniverse, MarketCapBand],
+    weight_strategy: Union[StockBasketWeightApproach, CappedWeighting],
+    rebalance_days: int,
+    portfolio_size: int,
+    initial_portfolio_value: int,
+) -> pd.DataFrame:
+    """
+    The df_res of the backtest computed with the helpers on a DataFrame, like
+    `compute_backtest_dfs` did before the market data store, rank indexes,
+    trading calendar and array backed portfolios.
+    """
+    rebalance_dates = get_rebalance_dates(
+        datetime.datetime.strptime(df["date"].min(), "%Y-%m-%d"),
+        datetime.datetime.strptime(df["date"].max(), "%Y-%m-%d"),
+        datetime.timedelta(days=rebalance_days),
+    )
+    metrics = {"base": base_metric, "test": test_metric}
+    portfolio_values = {name: initial_portfolio_value for name in metrics}
+    share_allocations = {}
+    prices = {}
+    res = {}
+    for date in rebalance_dates:
+        df_date = filter_df_by_date(df, date)
+        row = {}
+        for name in share_allocations:
+            price, _ = get_stock_basket_price(df_date, df, share_allocations[name])
+            portfolio_values[name] = round(
+                portfolio_values[name] * price / prices[name], 2
+            )
+            row[f"{name}_price_prev"] = prices[name]
+            row[f"{name}_price"] = price
+        for name, metric in metrics.items():
+            df_sorted = filter_stocks_by_universe(
+                sort_df_by_metric(df_date, metric), stocks_universe
+            )
+            share_allocations[name] = get_share_allocation(
+                df_date,
+                get_top_n_stocks_by_metric(df_sorted, portfolio_size, metric),
+                portfolio_values[name],
+                weight_strategy,
+            )
+            prices[name], _ = get_stock_basket_price(
+                df_date, df, share_allocations[name]
+            )
+        if not row:
+            row = {"base_price": prices["base"], "test_price": prices["test"]}
+        res[date] = row
+    return pd.DataFrame.from_dict(res, orient="index")
+
+
+@pytest.mark.parametrize(
+    "weight_strategy",
+    [
+        StockBasketWeightApproach.EQUAL_WEIGHTING,
+        StockBasketWeightApproach.MARKET_CAP_ADJUSTED,
+        StockBasketWeightApproach.INVERSE_METRIC_RANK,
+        CappedWeighting(StockBasketWeightApproach.MARKET_CAP_ADJUSTED, 0.3),
+    ],
+)
+@pytest.mark.parametrize(
+    "stocks_universe",
+    [StockUniverse.MID, MarketCapBand("2B to 20B", 2, 20)],
+)
+@pytest.mark.parametrize("rebalance_days", [30, 182])
+def test_backtest_equals_helper_backtest(
+    daily_data, weight_strategy, stocks_universe, rebalance_days
+):
+    parameters = (
+        EvaluationMetric.EV_EBIT,
+        EvaluationMetric.P_B,
+        stocks_universe,
+        weight_strategy,
+        rebalance_days,
+        5,
+        10_000,
+    )
+    expected = _helper_backtest(daily_data, *parameters)
+
+    result = compute_backtest_dfs(
+        *parameters, MarketDataStore(daily_data), save_to_disk=False
+    )
+
+    pd.testing.assert_frame_equal(
+        result.df[expected.columns], expected, check_exact=True
+    )
+
+
+@pytest.mark.parametrize(
+    "metric", [EvaluationMetric.EV_EBIT, EvaluationMetric.P_E, EvaluationMetric.P_B]
+)
+def test_rank_index_ranks_like_sort_df_by_metric(daily_data, metric):
+    store = MarketDataStore(daily_data)
+    rank_index = RankIndex.build(store, metric)
+
+    for date in store.dates[::25]:
+        df_date = store.on_date(date)
+        # Ties may be ordered differently by the two sorts
+        assert not df_date[metric.sorted_column()].dropna().duplicated().any()
+        df_sorted = sort_df_by_metric(df_date, metric)
+        expected = df_sorted[get_metric_mask(df_sorted, metric)]["ticker"]
+
+        ranked_rows = rank_index.ranked_rows(store, date)
+
+        assert list(df_date["ticker"].values[ranked_rows]) == list(expected)
+
+
+@pytest.mark.parametrize("rebalance_days", [30, 182])
+def test_daily_values_equal_the_values_on_rebalance_dates(daily_data, rebalance_days):
+    store = MarketDataStore(daily_data)
+
+    result = compute_backtest_dfs(
+        EvaluationMetric.EV_EBIT,
+        EvaluationMetric.P_B,
+        StockUniverse.MID,
+        StockBasketWeightApproach.MARKET_CAP_ADJUSTED,
+        rebalance_days,
+        5,
+        10_000,
+        store,
+        save_to_disk=False,
+        daily_values=True,
+    )
+
+    df_daily = result.df_daily
+    assert list(df_daily.index) == list(pd.DatetimeIndex(store.dates))
+    assert df_daily.notna().all().all()
+    for name in ["base", "test"]:
+        assert list(df_daily.loc[result.df.index, f"{name}_value"]) == list(
+            result.df[f"{name}_price"]
+        )
+
+
+def test_saving_less_detail_removes_stale_tables(daily_data, tmp_path):
+    parameters = (
+        EvaluationMetric.EV_EBIT,
+        EvaluationMetric.P_B,
+        StockUniverse.MID,
+        StockBasketWeightApproach.EQUAL_WEIGHTING,
+        90,
+        5,
+        10_000,
+        MarketDataStore(daily_data),
+    )
+    compute_backtest_dfs(*parameters, base_path=str(tmp_path), daily_values=True)
+    assert len(os.listdir(tmp_path)) == 3
+
+    compute_backtest_dfs(*parameters, base_path=str(tmp_path), detail=ResultDetail.NONE)
+
+    assert len(os.listdir(tmp_path)) == 1
+    result = load_backtest_result(
+        *parameters[:2], 90, 5, StockUniverse.MID, str(tmp_path), with_debug=True
+    )
+    assert result.df_debug is None
+    assert result.df_daily is None
@@ -0,0 +1,120 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from src.batch.ingestion import IngestionConfig, _ticker_buckets, run_ingestion
+from src.serialization_lib import read_df_from_feather
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "ingestion")
+NUM_BUCKETS = 4
+
+
+@pytest.fixture
+def config(tmp_path) -> IngestionConfig:
+    raw_dir = str(tmp_path / "raw")
+    shutil.copytree(FIXTURE_DIR, raw_dir)
+    return IngestionConfig(
+        raw_dir, str(tmp_path / "out"), env="test", num_buckets=NUM_BUCKETS
+    )
+
+
+def _read_export(filename: str) -> pd.DataFrame:
+    return pd.read_csv(filename, dtype={"ticker": str, "date": str, "lastupdated": str})
+
+
+def _write_export(df: pd.DataFrame, filename: str) -> None:
+    df.to_csv(filename, index=False)
+    # The exports are fingerprinted by size and modification time
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def _expected(raw_dir: str) -> pd.DataFrame:
+    tables = []
+    for name in ["SHARADAR_DAILY", "SHARADAR_SEP"]:
+        filenames = sorted(f for f in os.listdir(raw_dir) if f.startswith(name))
+        tables.append(
+            pd.concat(
+                [_read_export(os.path.join(raw_dir, f)) for f in filenames]
+            ).drop_duplicates(subset=["date", "ticker"], keep="last")
+        )
+    metrics, prices = tables
+    df = metrics.merge(prices[["ticker", "date", "closeadj"]], on=["date", "ticker"])
+    df = df.rename(columns={"closeadj": "price"})
+    return df.sort_values(by=["date", "ticker"]).reset_index(drop=True)
+
+
+def _assert_output(config: IngestionConfig) -> None:
+    expected = _expected(config.raw_dir)
+    for filename in [config.dataset_dir, config.monolithic_filename]:
+        df = read_df_from_feather(filename).reset_index(drop=True)
+        pd.testing.assert_frame_equal(
+            df.astype({"ticker": object, "date": object, "lastupdated": object}),
+            expected,
+            check_dtype=False,
+        )
+
+
+def _bucket(ticker: str) -> int:
+    return int(_ticker_buckets(pd.Series([ticker]), NUM_BUCKETS)[0])
+
+
+def test_first_run(config):
+    result = run_ingestion(config, max_workers=2)
+
+    assert result.staged_sources == [
+        "metrics/SHARADAR_DAILY.csv",
+        "prices/SHARADAR_SEP.csv",
+    ]
+    assert result.written_years == ["2019", "2020"]
+    assert result.wrote_monolithic
+    _assert_output(config)
+
+
+def test_rerun_without_changes(config):
+    run_ingestion(config, max_workers=2)
+    # Touching an export restages it, but its buckets hash the same
+    os.utime(os.path.join(config.raw_dir, "SHARADAR_DAILY.csv"))
+
+    result = run_ingestion(config, max_workers=2)
+
+    assert result.joined_buckets == []
+    assert result.written_years == []
+    assert not result.wrote_monolithic
+    _assert_output(config)
+
+
+def test_changed_export(config):
+    run_ingestion(config, max_workers=2)
+    filename = os.path.join(config.raw_dir, "SHARADAR_SEP.csv")
+    df = _read_export(filename)
+    df.loc[(df["ticker"] == "KO") & (df["date"] >= "2020"), "closeadj"] *= 2
+    _write_export(df, filename)
+
+    result = run_ingestion(config, max_workers=2)
+
+    assert result.staged_sources == ["prices/SHARADAR_SEP.csv"]
+    assert result.joined_buckets == [_bucket("KO")]
+    assert result.wrote_monolithic
+    _assert_output(config)
+
+
+def test_removed_export(config):
+    run_ingestion(config, max_workers=2)
+    df = _read_export(os.path.join(config.raw_dir, "SHARADAR_SEP.csv"))
+    filename = os.path.join(config.raw_dir, "SHARADAR_SEP_2.csv")
+    df_update = df[df["ticker"] == "XOM"].assign(closeadj=1.0)
+    _write_export(df_update, filename)
+    run_ingestion(config, max_workers=2)
+    _assert_output(config)
+
+    os.remove(filename)
+    result = run_ingestion(config, max_workers=2)
+
+    assert result.staged_sources == []
+    assert result.joined_buckets == [_bucket("XOM")]
+    _assert_output(config)
+    df_output = read_df_from_feather(config.monolithic_filename)
+    assert (df_output.loc[df_output["ticker"] == "XOM", "price"] > 1).all()
@@ -0,0 +1,173 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import backtest as backtest_module
+from src.backtest import compute_backtest_dfs
+from src.data_types import (
+    EvaluationMetric,
+    ResultDetail,
+    StockBasketWeightApproach,
+    StockUniverse,
+)
+from src.market_data import MarketDataStore
+from src.rank_index import RankIndex
+from src.result_cache import ResultCache, backtest_cache_key
+
+# (base_metric, test_metric, stocks_universe, weight_strategy, rebalance_days,
+# portfolio_size, initial_portfolio_value)
+PARAMETERS = (
+    EvaluationMetric.EV_EBIT,
+    EvaluationMetric.P_B,
+    StockUniverse.MID,
+    StockBasketWeightApproach.EQUAL_WEIGHTING,
+    90,
+    5,
+    10_000,
+)
+
+
+def _backtest(daily_data, portfolio_size: int = 5, **kwargs):
+    parameters = PARAMETERS[:5] + (portfolio_size,) + PARAMETERS[6:]
+    return compute_backtest_dfs(*parameters, daily_data, save_to_disk=False, **kwargs)
+
+
+def _cache_key(store: MarketDataStore) -> str:
+    return backtest_cache_key(store, *PARAMETERS, ResultDetail.FULL)
+
+
+def _revised(df: pd.DataFrame, column: str) -> pd.DataFrame:
+    df = df.copy()
+    df.loc[len(df) // 2, column] *= 2
+    return df
+
+
+def test_cache_hit(daily_data, tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path))
+    store = MarketDataStore(daily_data)
+    result = _backtest(store, cache=cache)
+    assert _cache_key(store) in cache
+
+    def build(*args):
+        raise AssertionError("A cache hit does not rank the stocks.")
+
+    monkeypatch.setattr(RankIndex, "build", build)
+    cached = _backtest(MarketDataStore(daily_data), cache=cache)
+
+    pd.testing.assert_frame_equal(cached.df, result.df)
+    assert list(cached.df_debug.index) == list(result.df_debug.index)
+
+
+def test_cache_miss(daily_data, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    store = MarketDataStore(daily_data)
+    _backtest(store, cache=cache)
+
+    result = _backtest(store, portfolio_size=10, cache=cache)
+
+    assert len(os.listdir(tmp_path)) == 4
+    pd.testing.assert_frame_equal(
+        result.df, _backtest(store, portfolio_size=10).df, check_exact=True
+    )
+
+
+@pytest.mark.parametrize("column", ["price", "marketcap", "ev", "evebit", "pb"])
+def test_cache_key_changes_with_the_data_read(daily_data, column):
+    key = _cache_key(MarketDataStore(daily_data))
+
+    assert _cache_key(MarketDataStore(_revised(daily_data, column))) != key
+
+
+def test_cache_key_ignores_the_data_not_read(daily_data):
+    key = _cache_key(MarketDataStore(daily_data))
+
+    assert _cache_key(MarketDataStore(_revised(daily_data, "pe"))) == key
+
+
+def test_revised_data_is_recomputed(daily_data, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    _backtest(MarketDataStore(daily_data), cache=cache)
+    revised = MarketDataStore(_revised(daily_data, "price"))
+
+    result = _backtest(revised, cache=cache)
+
+    pd.testing.assert_frame_equal(result.df, _backtest(revised).df, check_exact=True)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    df_res = pd.DataFrame({"base_price": np.arange(1000.0)})
+    cache.put("a", df_res, None)
+    entry_size = cache.size_bytes()
+    cache.max_size_bytes = int(2.5 * entry_size)
+    cache.put("b", df_res, None)
+    # Put in order, whatever the resolution of the modification times
+    now = time.time()
+    for age, key in [(20, "a"), (10, "b")]:
+        os.utime(os.path.join(cache.cache_dir, key), (now - age, now - age))
+
+    assert cache.get("a") is not None
+    cache.put("c", df_res, None)
+
+    assert "a" in cache and "c" in cache
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.size_bytes() <= cache.max_size_bytes
+
+
+def _first_rows(df: pd.DataFrame, fraction: float) -> pd.DataFrame:
+    dates = df["date"].unique()
+    return df[df["date"] <= dates[int(len(dates) * fraction)]]
+
+
+@pytest.mark.parametrize("rebalance_days", [30, 90, 365])
+def test_resumed_backtest_equals_full_recompute(
+    daily_data, tmp_path, monkeypatch, rebalance_days
+):
+    cache = ResultCache(str(tmp_path))
+    parameters = PARAMETERS[:4] + (rebalance_days,) + PARAMETERS[5:]
+
+    def backtest(df: pd.DataFrame, **kwargs):
+        return compute_backtest_dfs(
+            *parameters,
+            MarketDataStore(df),
+            save_to_disk=False,
+            daily_values=True,
+            **kwargs,
+        )
+
+    backtest(_first_rows(daily_data, 0.6), cache=cache)
+    full = backtest(daily_data)
+    selections = []
+    buy_top_n_stocks = backtest_module._buy_top_n_stocks
+
+    def spy(*args):
+        selections.append(args[1])
+        return buy_top_n_stocks(*args)
+
+    monkeypatch.setattr(backtest_module, "_buy_top_n_stocks", spy)
+    resumed = backtest(daily_data, cache=cache)
+
+    # Only the rebalances after the checkpoint are computed
+    assert 0 < len(selections) < 2 * len(full.df)
+    assert min(selections) > full.df.index[0]
+    pd.testing.assert_frame_equal(resumed.df, full.df, check_exact=True)
+    pd.testing.assert_frame_equal(resumed.df_daily, full.df_daily, check_exact=True)
+    assert list(resumed.df_debug.index) == list(full.df_debug.index)
+
+
+def test_revised_past_data_is_recomputed(daily_data, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    _backtest(MarketDataStore(_first_rows(daily_data, 0.6)), cache=cache)
+    # Revised before the checkpoint
+    revised = daily_data.copy()
+    revised.loc[len(daily_data) // 4, "price"] *= 2
+
+    result = _backtest(MarketDataStore(revised), cache=cache)
+
+    pd.testing.assert_frame_equal(
+        result.df, _backtest(MarketDataStore(revised)).df, check_exact=True
+    )
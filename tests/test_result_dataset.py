@@ -0,0 +1,123 @@
+import dataclasses
+import os
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+from src.backtest import compute_backtest_dfs
+from src.data_types import (
+    EvaluationMetric,
+    MarketCapBand,
+    StockBasketWeightApproach,
+    StockUniverse,
+)
+from src.market_data import MarketDataStore
+from src.result_dataset import ResultWriter, load_results, read_results, write_result
+
+# Same name, different bounds
+NARROW_BAND = MarketCapBand("Mid", lower=2, upper=5)
+WIDE_BAND = MarketCapBand("Mid", lower=1, upper=20, upper_inclusive=False)
+
+
+@pytest.fixture(scope="module")
+def results(daily_data):
+    store = MarketDataStore(daily_data)
+    return [
+        compute_backtest_dfs(
+            EvaluationMetric.EV_EBIT,
+            EvaluationMetric.P_B,
+            stocks_universe,
+            StockBasketWeightApproach.EQUAL_WEIGHTING,
+            rebalance_days,
+            5,
+            10_000,
+            store,
+            save_to_disk=False,
+            daily_values=True,
+        )
+        for stocks_universe in [StockUniverse.MID, NARROW_BAND, WIDE_BAND]
+        for rebalance_days in [90, 365]
+    ]
+
+
+def _key(result):
+    return result.stocks_universe, result.rebalance_days
+
+
+def _assert_results_equal(loaded, expected, with_debug: bool = True) -> None:
+    assert Counter(map(_key, loaded)) == Counter(map(_key, expected))
+    loaded = {_key(r): r for r in loaded}
+    for result in expected:
+        got = loaded[_key(result)]
+        assert got.stocks_universe == result.stocks_universe
+        assert got.base_metric == result.base_metric
+        assert got.portfolio_size == result.portfolio_size
+        pd.testing.assert_frame_equal(got.df, result.df, check_freq=False)
+        if result.df_daily is None:
+            assert got.df_daily is None
+        else:
+            pd.testing.assert_frame_equal(
+                got.df_daily, result.df_daily, check_freq=False
+            )
+        if not with_debug:
+            assert got.df_debug is None
+        elif result.df_debug is None:
+            assert got.df_debug is None
+        else:
+            assert list(got.df_debug.index) == list(result.df_debug.index)
+
+
+def test_round_trip(results, tmp_path):
+    with ResultWriter(str(tmp_path)) as writer:
+        for result in results:
+            writer.submit(result)
+
+    _assert_results_equal(load_results(str(tmp_path), with_debug=True), results)
+
+
+def test_bands_of_the_same_name_are_kept_apart(results, tmp_path):
+    for result in results:
+        write_result(str(tmp_path), result)
+
+    df = read_results(str(tmp_path), stocks_universe=NARROW_BAND, rebalance_days=90)
+
+    expected = [
+        r
+        for r in results
+        if r.stocks_universe == NARROW_BAND and r.rebalance_days == 90
+    ]
+    assert len(df) == len(expected[0].df)
+    _assert_results_equal(
+        load_results(str(tmp_path), stocks_universe=WIDE_BAND),
+        [r for r in results if r.stocks_universe == WIDE_BAND],
+        with_debug=False,
+    )
+
+
+def test_rewriting_a_result_without_a_table_removes_it(results, tmp_path):
+    for result in results:
+        write_result(str(tmp_path), result)
+    rewritten = [
+        dataclasses.replace(result, df_debug=None, df_daily=None)
+        for result in results[:2]
+    ]
+
+    for result in rewritten:
+        write_result(str(tmp_path), result)
+
+    _assert_results_equal(
+        load_results(str(tmp_path), with_debug=True), rewritten + results[2:]
+    )
+
+    # Without any cell left, the tables are gone rather than empty
+    for result in results[2:]:
+        write_result(
+            str(tmp_path), dataclasses.replace(result, df_debug=None, df_daily=None)
+        )
+
+    assert sorted(os.listdir(tmp_path)) == ["df_res"]
+    assert all(
+        r.df_daily is None and r.df_debug is None
+        for r in load_results(str(tmp_path), with_debug=True)
+    )
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from src.backtest import compute_backtest_dfs
+from src.data_types import (
+    CappedWeighting,
+    EvaluationMetric,
+    MarketCapBand,
+    StockBasketWeightApproach,
+)
+from src.market_data import MarketDataStore
+from src.portfolio import Portfolio
+from src.weighting import get_basket_weights
+
+WEIGHT_STRATEGIES = [
+    StockBasketWeightApproach.EQUAL_WEIGHTING,
+    StockBasketWeightApproach.MARKET_CAP_ADJUSTED,
+    StockBasketWeightApproach.INVERSE_METRIC_RANK,
+    StockBasketWeightApproach.INVERSE_VOLATILITY,
+    CappedWeighting(StockBasketWeightApproach.EQUAL_WEIGHTING, 0.3),
+    CappedWeighting(StockBasketWeightApproach.MARKET_CAP_ADJUSTED, 0.3),
+]
+
+
+@pytest.mark.parametrize("weight_strategy", WEIGHT_STRATEGIES)
+def test_weights_sum_to_one(weight_strategy):
+    marketcap = np.array([5.0, 1.0, np.nan, 2.0, 0.5])
+    volatility = np.array([0.02, 0.01, 0.03, np.nan, 0.05])
+
+    weights = get_basket_weights(weight_strategy, marketcap, volatility)
+
+    if weight_strategy == StockBasketWeightApproach.EQUAL_WEIGHTING:
+        assert weights is None
+    else:
+        assert np.isclose(weights.sum(), 1)
+        assert (weights > 0).all()
+
+
+@pytest.mark.parametrize("weight_strategy", WEIGHT_STRATEGIES)
+def test_empty_basket_is_not_bought(weight_strategy):
+    empty = np.array([], dtype=np.float64)
+
+    weights = get_basket_weights(weight_strategy, empty, empty)
+
+    assert weights is None or len(weights) == 0
+    with pytest.raises(Exception, match="No stocks to buy."):
+        Portfolio.buy(np.array([]), np.array([], dtype=np.int32), empty, 100, weights)
+
+
+@pytest.mark.parametrize("weight_strategy", WEIGHT_STRATEGIES)
+def test_backtest_of_an_empty_universe(daily_data, weight_strategy):
+    nothing = MarketCapBand("Above 1000T", lower=1e6)
+
+    with pytest.raises(Exception, match="No stocks to buy."):
+        compute_backtest_dfs(
+            EvaluationMetric.EV_EBIT,
+            EvaluationMetric.P_B,
+            nothing,
+            weight_strategy,
+            90,
+            5,
+            10_000,
+            MarketDataStore(daily_data),
+            save_to_disk=False,
+        )